@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+
+"""
+Measures how many events per second can be encoded into JSON lines.
+
+Compares the old way of encoding events (two json.dumps calls spliced
+together) with dbxlogger.encoder.EventEncoder for each available backend.
+
+    python benchmarks/encode_events.py -n 200000
+"""
+
+import argparse
+import datetime
+import json
+import math
+import numbers
+import os
+import sys
+import time
+
+# run from anywhere without installing dbxlogger
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dbxlogger.encoder import EventEncoder, encode_datetime, orjson
+
+
+class OldEncoder(json.JSONEncoder):
+    """DBXEncoder as it was before EventEncoder: json's defaults (NaN is
+    written as a bare NaN) and no retry."""
+
+    def default(self, obj):
+        if isinstance(obj, numbers.Number):
+            if math.isnan(obj):
+                return {"_dbx": "nan"}
+            if math.isinf(obj):
+                return {"_dbx": "-inf" if obj < 0 else "inf"}
+        if isinstance(obj, datetime.datetime):
+            return encode_datetime(obj)
+        if hasattr(obj, "__dbx_encode__"):
+            return obj.__dbx_encode__()
+        return super().default(obj)
+
+
+def old_encode(event_name, data):
+    # what FileLogWriter.log used to do for every event
+    if "event" in data:
+        del data["event"]
+    encoded = json.dumps(data, sort_keys=True, cls=OldEncoder)
+    event_encoded = json.dumps({"event": event_name})
+    return event_encoded[:-1] + ", " + encoded[1:]
+
+
+PAYLOADS = {
+    "flat": lambda i: {"loss": 0.25 + i, "acc": 0.5, "lr": 0.001, "step": i},
+    "nested": lambda i: {"train": {"loss": 0.25, "acc": [0.1, 0.2, 0.3]}, "step": i},
+    "datetime": lambda i: {"at": datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc), "step": i},
+    # a diverged run: every event has a NaN, written as {"_dbx": "nan"}
+    "nonfinite": lambda i: {"loss": float("nan"), "acc": 0.5, "lr": 0.001, "step": i},
+}
+
+
+def bench(encode, payload, n):
+    events = [("epoch/%d/batch/stats" % (i % 100), payload(i)) for i in range(n)]
+    start = time.perf_counter()
+    for name, data in events:
+        encode(name, data)
+    return n / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", type=int, default=100000, help="events per run")
+    args = parser.parse_args()
+
+    encoders = [("old", old_encode), ("json", EventEncoder().encode)]
+    if orjson is not None:
+        encoders.append(("orjson", EventEncoder(backend="orjson").encode))
+
+    # sanity check: new default encoder must produce the same bytes, except
+    # for NaN which the old one wrote as invalid JSON
+    for payload_name, payload in PAYLOADS.items():
+        if payload_name == "nonfinite":
+            continue
+        assert old_encode("a/b", payload(1)) == EventEncoder().encode("a/b", payload(1))
+
+    for payload_name, payload in PAYLOADS.items():
+        for name, encode in encoders:
+            rate = bench(encode, payload, args.n)
+            print("%-10s %-8s %12.0f events/s" % (payload_name, name, rate))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+
+"""
+Measures the per-call overhead of the Logger API itself (event names,
+contexts, events with durations), without encoding or I/O: events go to a
+writer that drops them.
+
+    python benchmarks/logger_overhead.py -n 200000 --depth 8
+"""
+
+import argparse
+import os
+import sys
+import time
+
+# run from anywhere without installing dbxlogger
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dbxlogger.logger import Logger
+
+
+class NullWriter:
+    def log(self, event, data):
+        pass
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def bench(name, fn, n):
+    start = time.perf_counter_ns()
+    for _ in range(n):
+        fn()
+    per_call = (time.perf_counter_ns() - start) / n
+    print("%-28s %8.0f ns/call" % (name, per_call))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", type=int, default=200000, help="calls per measurement")
+    parser.add_argument("--depth", type=int, default=8, help="context path depth")
+    args = parser.parse_args()
+
+    root = Logger(writer=NullWriter())
+    deep = root.sub("/".join("level%d" % i for i in range(args.depth)))
+    data = {"loss": 0.5}
+
+    bench("log (root)", lambda: root.log("stats", data), args.n)
+    bench("log (depth %d)" % args.depth, lambda: deep.log("stats", data), args.n)
+    bench("log nested name", lambda: deep.log("batch/7/stats", data), args.n)
+    bench("sub + log", lambda: deep.sub("batch/7")("stats", data), args.n)
+    bench("parent", lambda: deep.parent(), args.n)
+    bench("root", lambda: deep.root(), args.n)
+
+    def at():
+        with deep.at("eval"):
+            deep("stats", data)
+    bench("at + log", at, args.n)
+
+    def event():
+        ev = deep.new_event("stats")
+        deep(ev, {"loss": 0.5})
+    bench("new_event + log", event, args.n)
+
+
+if __name__ == "__main__":
+    main()
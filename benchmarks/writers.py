@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+
+"""
+Logging throughput and latency for each log writer.
+
+For every combination of writer, payload, queue size and context depth it
+logs -n events and measures:
+
+    events_per_sec      events logged / time until the log is closed (so
+                        background writers must have written everything)
+    p50_us, p99_us      latency of a single log() call in the caller
+    producer_cpu_s      CPU time of the thread calling log()
+    writer_cpu_s        CPU time of writer threads and processes
+
+One JSON object per configuration is written to --out (JSON lines, default
+stdout) with the git commit and python version, so results of different
+commits can be compared. A table goes to stderr.
+
+    python benchmarks/writers.py -n 20000 --out results.jsonl
+    python benchmarks/writers.py --writers thread,subprocess --payloads flat --queue-sizes 100,10000
+"""
+
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+# run from anywhere without installing dbxlogger
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dbxlogger.aio import AsyncLogger
+from dbxlogger.logger import Logger
+from dbxlogger.repo import RefFile
+
+_LARGE = [0.5 * j for j in range(1000)]
+
+# payloads are built before the measurement starts; only encoding (and the
+# hash lookup for RefFile) is measured
+PAYLOADS = {
+    "flat": lambda i, ctx: {"loss": 0.25 + i, "acc": 0.5, "lr": 0.001, "step": i},
+    "nested": lambda i, ctx: {"train": {"loss": 0.25, "acc": [0.1, 0.2, 0.3], "grad": {"norm": 1.5, "max": 3.0}}, "step": i},
+    "datetime": lambda i, ctx: {"at": datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc), "step": i},
+    # a new RefFile per event; the file is hashed once, after that the hash
+    # comes from the (in-memory) hash cache, see dbxlogger.hashcache
+    "reffile": lambda i, ctx: {"ref": RefFile(ctx["reffile"]), "step": i},
+    "large": lambda i, ctx: {"values": _LARGE, "step": i},
+}
+
+# writer name -> (Logger constructor, name of its queue size argument or
+# None, extra writer arguments)
+WRITERS = {
+    "file": (Logger.new, None, {}),
+    "file-buffered": (Logger.new, None, {"buffered": True}),
+    "thread": (Logger.new_thread, "queue_size", {}),
+    "subprocess": (Logger.new_subprocess, "buffer_size", {}),
+    "async": (AsyncLogger.new, "queue_size", {}),
+}
+
+# queue sizes are in events for thread/async and in KiB of ring buffer for
+# subprocess
+DEFAULT_QUEUE_SIZES = "1000,100000"
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    i = min(len(sorted_values) - 1, int(round(p / 100 * (len(sorted_values) - 1))))
+    return sorted_values[i]
+
+
+def children_cpu():
+    r = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return r.ru_utime + r.ru_stime
+
+
+def run_sync(logger, events):
+    latencies = []
+    append = latencies.append
+    clock = time.perf_counter_ns
+    for data in events:
+        start = clock()
+        logger("stats", data)
+        append(clock() - start)
+    logger.close()
+    return latencies
+
+
+def run_async(logger, events):
+    async def main():
+        latencies = []
+        clock = time.perf_counter_ns
+        for data in events:
+            start = clock()
+            await logger("stats", data)
+            latencies.append(clock() - start)
+        await logger.close()
+        return latencies
+    return asyncio.run(main())
+
+
+def bench(writer, payload_name, queue_size, depth, n, ctx):
+    new, queue_arg, kwargs = WRITERS[writer]
+    kwargs = dict(kwargs)
+    if queue_arg == "buffer_size":
+        kwargs[queue_arg] = queue_size * 1024
+    elif queue_arg is not None:
+        kwargs[queue_arg] = queue_size
+
+    path = os.path.join(ctx["dir"], "bench.log.jsonl")
+    payload = PAYLOADS[payload_name]
+    events = [payload(i, ctx) for i in range(n)]
+
+    wall = time.perf_counter()
+    thread_cpu = time.thread_time()
+    process_cpu = time.process_time()
+    child_cpu = children_cpu()
+
+    logger = new(path, **kwargs)
+    if depth:
+        logger = logger.sub("/".join("level%d" % i for i in range(depth)))
+
+    if writer == "async":
+        latencies = run_async(logger, events)
+    else:
+        latencies = run_sync(logger, events)
+
+    wall = time.perf_counter() - wall
+    producer_cpu = time.thread_time() - thread_cpu
+    writer_cpu = (time.process_time() - process_cpu - producer_cpu) + (children_cpu() - child_cpu)
+    size = os.path.getsize(path)
+    os.remove(path)
+
+    latencies.sort()
+    return {
+        "writer": writer,
+        "payload": payload_name,
+        "queue_size": queue_size if queue_arg is not None else None,
+        "depth": depth,
+        "events": n,
+        "bytes": size,
+        "seconds": round(wall, 6),
+        "events_per_sec": round(n / wall, 1),
+        "p50_us": round(percentile(latencies, 50) / 1000, 3),
+        "p99_us": round(percentile(latencies, 99) / 1000, 3),
+        "max_us": round(latencies[-1] / 1000, 3),
+        "producer_cpu_s": round(producer_cpu, 6),
+        "writer_cpu_s": round(max(writer_cpu, 0.0), 6),
+    }
+
+
+def git_commit():
+    try:
+        out = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)))
+        return out.stdout.decode().strip() or None
+    except OSError:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", type=int, default=20000, help="events per configuration")
+    parser.add_argument("--writers", default=",".join(WRITERS))
+    parser.add_argument("--payloads", default=",".join(PAYLOADS))
+    parser.add_argument("--queue-sizes", default=DEFAULT_QUEUE_SIZES,
+        help="events for thread and async writers, KiB for subprocess")
+    parser.add_argument("--depths", default="0,8", help="context path depths")
+    parser.add_argument("--out", default=None, help="JSON lines output (default stdout)")
+    args = parser.parse_args()
+
+    writers = args.writers.split(",")
+    payloads = args.payloads.split(",")
+    queue_sizes = [int(q) for q in args.queue_sizes.split(",")]
+    depths = [int(d) for d in args.depths.split(",")]
+    for w in writers:
+        if w not in WRITERS:
+            parser.error("unknown writer %s" % w)
+    for p in payloads:
+        if p not in PAYLOADS:
+            parser.error("unknown payload %s" % p)
+
+    tmp = tempfile.mkdtemp(prefix="dbxbench")
+    reffile = os.path.join(tmp, "ref.bin")
+    with open(reffile, "wb") as f:
+        f.write(os.urandom(4096))
+    ctx = {"dir": tmp, "reffile": reffile}
+
+    common = {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "time": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+    }
+
+    out = open(args.out, "a") if args.out else sys.stdout
+    print("%-14s %-9s %7s %5s %12s %9s %9s %9s %9s" % ("writer", "payload", "queue",
+        "depth", "events/s", "p50 us", "p99 us", "prod cpu", "wrt cpu"), file=sys.stderr)
+    try:
+        for writer in writers:
+            # queue size only matters for the background writers
+            sizes = queue_sizes if WRITERS[writer][1] is not None else [None]
+            for payload in payloads:
+                for queue_size in sizes:
+                    for depth in depths:
+                        result = bench(writer, payload, queue_size, depth, args.n, ctx)
+                        result.update(common)
+                        out.write(json.dumps(result, sort_keys=True) + "\n")
+                        out.flush()
+                        print("%-14s %-9s %7s %5d %12.0f %9.1f %9.1f %9.3f %9.3f" % (
+                            writer, payload, queue_size if queue_size is not None else "-",
+                            depth, result["events_per_sec"], result["p50_us"],
+                            result["p99_us"], result["producer_cpu_s"],
+                            result["writer_cpu_s"]), file=sys.stderr)
+    finally:
+        if args.out:
+            out.close()
+        shutil.rmtree(tmp)
+
+
+if __name__ == "__main__":
+    main()
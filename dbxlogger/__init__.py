@@ -16,6 +16,7 @@ import datetime
 
 from .args import add_arguments_to
 from .logger import Logger
+from .aio import AsyncLogger
 from .exp import Exp, exp_from_args
 from .repo import RefFile, get_repo
 
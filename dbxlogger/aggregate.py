@@ -0,0 +1,305 @@
+"""
+Aggregate metrics over many experiments of a repo, grouped by params.
+
+    from dbxlogger.aggregate import aggregate
+
+    table = aggregate("./output",
+        by=["lr", "batch_size"],
+        metrics={"test_acc": "last", "best_val": ("val_acc", "max")},
+        events="epoch/*/eval",
+        kind="train.py")
+    print(table)
+
+Experiments are selected with the repo catalog (see
+:py:meth:`dbxlogger.catalog.Catalog.find`, extra keyword arguments go there).
+Each experiment's log is read on a pool of processes and reduced to one
+value per metric:
+
+    last, first, min, max, mean, count
+    ("at", step)    the value at a step: the value of the "step" key of the
+                    event, or with step_key=None the n-th (0-based) value
+
+Then the values of the experiments in each group are combined into the
+`stats` (count, mean, std, min, max) and returned as a :py:class:`Table`
+with a row per group.
+"""
+
+import math
+import multiprocessing
+import numbers
+import os
+import sys
+
+from .catalog import Catalog, flatten_params
+from .reader import read_log, log_path
+
+REDUCERS = set(["last", "first", "min", "max", "mean", "count"])
+STATS = set(["count", "mean", "std", "min", "max"])
+
+
+def _parse_metrics(metrics):
+    """Normalize the metrics argument into {name: (key, reducer, at)}."""
+    if isinstance(metrics, str):
+        metrics = [metrics]
+    if not isinstance(metrics, dict):
+        metrics = {m: "last" for m in metrics}
+
+    parsed = {}
+    for name, spec in metrics.items():
+        key = name
+        if isinstance(spec, str):
+            reducer = spec
+        elif len(spec) == 2 and spec[0] == "at":
+            reducer = spec
+        else:
+            key, reducer = spec
+
+        at = None
+        if isinstance(reducer, (tuple, list)):
+            if reducer[0] != "at":
+                raise Exception("unknown reducer %r for metric %s" % (reducer, name))
+            at = reducer[1]
+            reducer = "at"
+        elif reducer not in REDUCERS:
+            raise Exception("unknown reducer %r for metric %s" % (reducer, name))
+        parsed[name] = (key, reducer, at)
+    return parsed
+
+
+def _is_number(v):
+    return isinstance(v, numbers.Number) and not isinstance(v, bool)
+
+
+class _Reduce:
+    """Running reduction of one metric over the events of one log."""
+
+    def __init__(self, reducer, at=None):
+        self.reducer = reducer
+        self.at = at
+        self.value = 0 if reducer == "count" else None
+        self.n = 0
+
+    def add(self, value, step):
+        r = self.reducer
+        if r == "last":
+            self.value = value
+        elif r == "first":
+            if self.n == 0:
+                self.value = value
+        elif r == "at":
+            if step == self.at:
+                self.value = value
+        elif r == "count":
+            self.value = self.n + 1
+        elif not _is_number(value) or value != value:
+            # min, max and mean only use numbers and leave out NaN
+            return
+        elif r == "min":
+            if self.value is None or value < self.value:
+                self.value = value
+        elif r == "max":
+            if self.value is None or value > self.value:
+                self.value = value
+        elif r == "mean":
+            # running mean, no need to keep the values around
+            self.value = value if self.n == 0 else self.value + (value - self.value) / (self.n + 1)
+        self.n += 1
+
+
+def _reduce_log(args):
+    """Reduce the log of one experiment. Runs in the worker processes."""
+    path, metrics, events, name, step_key = args
+    reducers = {m: _Reduce(reducer, at) for m, (key, reducer, at) in metrics.items()}
+    keys = set(key for key, _, _ in metrics.values())
+    if step_key is not None:
+        keys.add(step_key)
+
+    try:
+        evs = read_log(log_path(path, name), events=events, keys=list(keys))
+        steps = {}
+        for ev in evs:
+            for m, (key, _, _) in metrics.items():
+                if key not in ev:
+                    continue
+                if step_key is None:
+                    step = steps.get(key, 0)
+                    steps[key] = step + 1
+                else:
+                    step = ev.get(step_key)
+                reducers[m].add(ev[key], step)
+    except FileNotFoundError:
+        # experiment without this log
+        pass
+    except Exception as e:
+        # a corrupt or unreadable log should not fail the whole aggregate,
+        # the experiment counts as one without values
+        print("WARN: dbxlogger could not aggregate %s: %r" % (path, e), file=sys.stderr)
+        reducers = {m: _Reduce(reducer, at) for m, (key, reducer, at) in metrics.items()}
+
+    return path, {m: r.value for m, r in reducers.items()}
+
+
+def _combine(values, stat):
+    nums = [v for v in values if _is_number(v) and not math.isnan(v)]
+    if stat == "count":
+        return len(nums)
+    if not nums:
+        return None
+    if stat == "min":
+        return min(nums)
+    if stat == "max":
+        return max(nums)
+    mean = math.fsum(nums) / len(nums)
+    if stat == "mean":
+        return mean
+    if stat == "std":
+        # sample standard deviation, like numpy's std(ddof=1)
+        if len(nums) < 2:
+            return None
+        return math.sqrt(math.fsum((v - mean) ** 2 for v in nums) / (len(nums) - 1))
+    raise Exception("unknown stat %s" % stat)
+
+
+def _group_value(v):
+    """Make a param value usable as (part of) a group key: lists become
+    tuples, other unhashable values their repr."""
+    if isinstance(v, list):
+        return tuple(_group_value(x) for x in v)
+    try:
+        hash(v)
+    except TypeError:
+        return repr(v)
+    return v
+
+
+def _sort_key(group):
+    # params of different types (or None) can't be compared directly
+    return tuple((v is None, type(v).__name__ if not _is_number(v) else "", v if v is not None else 0)
+        for v in group)
+
+
+class Table:
+    """Result of aggregate(): a list of rows (tuples) with named columns.
+
+    Columns are the `by` params, "n" (number of experiments in the group)
+    and "<metric>.<stat>" for each metric and stat.
+    """
+
+    def __init__(self, columns, rows):
+        self.columns = columns
+        self.rows = rows
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def __getitem__(self, i):
+        return self.rows[i]
+
+    def column(self, name):
+        """All the values of a column."""
+        i = self.columns.index(name)
+        return [row[i] for row in self.rows]
+
+    def to_dicts(self):
+        return [dict(zip(self.columns, row)) for row in self.rows]
+
+    def to_pandas(self):
+        import pandas
+        return pandas.DataFrame(self.rows, columns=self.columns)
+
+    def __str__(self):
+        def fmt(v):
+            if isinstance(v, float):
+                return "%.6g" % v
+            return str(v)
+        cells = [list(self.columns)] + [[fmt(v) for v in row] for row in self.rows]
+        widths = [max(len(r[i]) for r in cells) for i in range(len(self.columns))]
+        return "\n".join("  ".join(c.rjust(w) for c, w in zip(r, widths)) for r in cells)
+
+    def __repr__(self):
+        return "Table(columns=%r, rows=%d)" % (self.columns, len(self.rows))
+
+
+def aggregate(repo, metrics, by=(), events=None, stats=("mean", "std", "count"),
+        name=None, step_key="step", processes=None, refresh=True, catalog=None, **find):
+    """Reduce metrics in the logs of the selected experiments of repo and
+    combine them by group. Returns a Table.
+
+    repo: a LocalRepo or its path
+    metrics: a key name, a list of key names (reduced with "last") or a dict
+        of output name to reducer (for a key of the same name) or to
+        (key, reducer)
+    by: param names (flattened, "optim.lr") to group by; experiments without
+        a param are grouped under None and list values become tuples
+    events: only use these events of the logs (see reader.event_filter)
+    stats: how to combine the values of a group, any of count, mean, std
+        (sample), min and max; None and NaN values are left out
+    name: log name (default log.jsonl)
+    step_key: event key with the step for ("at", step) reducers
+    processes: size of the process pool (default: number of CPUs)
+    refresh: refresh the catalog before selecting experiments
+    catalog: an already open Catalog of repo
+    find: experiment selection, passed to Catalog.find (kind, params, ...)
+    """
+    metrics = _parse_metrics(metrics)
+    if isinstance(by, str):
+        by = [by]
+    for stat in stats:
+        if stat not in STATS:
+            raise Exception("unknown stat %s" % stat)
+
+    own_catalog = catalog is None
+    if own_catalog:
+        catalog = Catalog(repo)
+    try:
+        if refresh:
+            catalog.refresh()
+        entries = catalog.find(**find)
+        groups_of = {}
+        for e in entries:
+            # the values from meta.json, the catalog's params table has
+            # booleans as integers and lists as JSON
+            params = catalog.meta(e).get("params")
+            params = flatten_params(params) if isinstance(params, dict) else {}
+            groups_of[e.path] = tuple(_group_value(params.get(k)) for k in by)
+    finally:
+        if own_catalog:
+            catalog.close()
+
+    tasks = [(e.path, metrics, events, name, step_key) for e in entries]
+    if processes is None:
+        processes = os.cpu_count() or 1
+
+    values = {}
+    if processes == 1 or len(tasks) <= 1:
+        results = map(_reduce_log, tasks)
+        for path, reduced in results:
+            values[path] = reduced
+    else:
+        with multiprocessing.Pool(min(processes, len(tasks))) as pool:
+            for path, reduced in pool.imap_unordered(_reduce_log, tasks, chunksize=4):
+                values[path] = reduced
+
+    groups = {}
+    for path, reduced in values.items():
+        groups.setdefault(groups_of[path], []).append(reduced)
+
+    columns = list(by) + ["n"]
+    for m in metrics:
+        for stat in stats:
+            columns.append("%s.%s" % (m, stat))
+
+    rows = []
+    for group in sorted(groups, key=_sort_key):
+        reduced = groups[group]
+        row = list(group) + [len(reduced)]
+        for m in metrics:
+            vals = [r[m] for r in reduced]
+            for stat in stats:
+                row.append(_combine(vals, stat))
+        rows.append(tuple(row))
+
+    return Table(columns, rows)
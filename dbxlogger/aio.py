@@ -0,0 +1,253 @@
+"""
+asyncio support: :py:class:`AsyncLogger` has the same API as
+:py:class:`dbxlogger.Logger` but `log()`, `flush()` and `close()` are
+coroutines, so logging never does file I/O on the event loop.
+
+    async with AsyncLogger.new("log.jsonl") as log:
+        await log("start", {"timestamp": dbx.now()})
+        with log.at("eval"):
+            await log("batch", {"acc": acc})
+"""
+
+import asyncio
+import contextlib
+import sys
+
+from .encoder import copy_arrays
+from .logger import Logger, LogContext, FileLogWriter
+
+
+class AsyncLogWriter:
+    """Queues events on the event loop and writes them from a writer task.
+
+    The writer task takes up to batch_size queued events at once and writes
+    them with a (buffered) FileLogWriter on the loop's default executor, with
+    one flush per batch. log() only waits when queue_size events are pending.
+    Numpy arrays and torch tensors in the data are copied when logged.
+
+    The writer task is started on first use, so the writer can be created
+    outside a running loop but must then only be used from one loop.
+    """
+
+    def __init__(self, file_path, mode="w", queue_size=10000, batch_size=1024, **writer_kwargs):
+        """file_path, mode and writer_kwargs are passed to FileLogWriter."""
+        writer_kwargs.setdefault("buffered", True)
+        self._writer = FileLogWriter(file_path, mode, **writer_kwargs)
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+
+        self._queue = None
+        self._task = None
+        self._closed = False
+        # error of a failed batch, raised by the next log(), flush() or close()
+        self._error = None
+
+    def _start(self):
+        if self._task is None:
+            self._queue = asyncio.Queue(self.queue_size)
+            self._task = asyncio.get_running_loop().create_task(self._writer_main())
+
+    async def _writer_main(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except asyncio.QueueEmpty:
+                    break
+
+            # close() puts None after the last event
+            closing = batch[-1] is None
+            events = batch[:-1] if closing else batch
+            try:
+                if events:
+                    await loop.run_in_executor(None, self._write_batch, events)
+            except Exception as e:
+                # keep consuming the queue so flush() and close() don't hang,
+                # the error is raised from the next log(), flush() or close()
+                if self._error is None:
+                    self._error = e
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+            if closing:
+                return
+
+    def _write_batch(self, events):
+        for event, data in events:
+            try:
+                self._writer.log(event, data)
+            except Exception as e:
+                # a bad event should not stop the writer task
+                print("WARN: dbxlogger could not write event %s: %r" % (event, e), file=sys.stderr)
+        self._writer.flush()
+
+    def _raise_error(self):
+        if self._error is not None:
+            e, self._error = self._error, None
+            raise e
+
+    async def log(self, event, data):
+        if self._closed:
+            raise Exception("cannot log to a closed AsyncLogWriter")
+        self._raise_error()
+        self._start()
+        await self._queue.put((event, copy_arrays(data)))
+
+    def log_nowait(self, event, data):
+        """Queue an event without waiting. Raises asyncio.QueueFull if the
+        queue is full. Must be called from the event loop thread."""
+        if self._closed:
+            raise Exception("cannot log to a closed AsyncLogWriter")
+        self._raise_error()
+        self._start()
+        self._queue.put_nowait((event, copy_arrays(data)))
+
+    async def flush(self):
+        """Wait until all events logged so far are written and flushed.
+        Raises the error of a failed write or flush since the last call."""
+        if self._queue is not None:
+            await self._queue.join()
+        self._raise_error()
+
+    async def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        if self._task is not None:
+            await self._queue.put(None)
+            await self._task
+        await asyncio.get_running_loop().run_in_executor(None, self._writer.close)
+        self._raise_error()
+
+
+class _PendingEvents:
+    """Sync writer that collects what is logged to it while collecting is
+    set. Otherwise, when the exit handlers close the windows, events go
+    straight to file_writer, which is flushed at exit."""
+
+    def __init__(self, file_writer):
+        self.events = []
+        self.collecting = False
+        self._file_writer = file_writer
+
+    def log(self, event, data):
+        if self.collecting:
+            self.events.append((event, data))
+        else:
+            self._file_writer.log(event, data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class AsyncWindowedLogWriter:
+    """The async version of dbxlogger.downsample.WindowedLogWriter: windows
+    are kept by a WindowedLogWriter and the summaries are logged to writer
+    (an AsyncLogWriter) when they are written. Use AsyncLogger.windowed().
+
+    If it isn't closed, the windows still open at exit (or on SIGTERM) are
+    written like with WindowedLogWriter, straight to the file of writer:
+    events still queued in writer when the loop stopped are lost, so these
+    summaries can come without the events before them.
+    """
+
+    def __init__(self, writer, close_writer=True, **windowed_kwargs):
+        from .downsample import WindowedLogWriter
+        self._writer = writer
+        self.close_writer = close_writer
+        self._pending = _PendingEvents(writer._writer)
+        self._windowed = WindowedLogWriter(self._pending, close_writer=False, **windowed_kwargs)
+
+    @property
+    def writer(self):
+        return self._writer
+
+    async def _drain(self):
+        events, self._pending.events = self._pending.events, []
+        for event, data in events:
+            await self._writer.log(event, data)
+
+    @contextlib.contextmanager
+    def _collecting(self):
+        self._pending.collecting = True
+        try:
+            yield
+        finally:
+            self._pending.collecting = False
+
+    async def log(self, event, data):
+        with self._collecting():
+            self._windowed.log(event, data)
+        if self._pending.events:
+            await self._drain()
+
+    def log_nowait(self, event, data):
+        with self._collecting():
+            self._windowed.log(event, data)
+        events, self._pending.events = self._pending.events, []
+        for event, data in events:
+            self._writer.log_nowait(event, data)
+
+    async def flush(self, flush_windows=False):
+        with self._collecting():
+            self._windowed.flush(flush_windows)
+        await self._drain()
+        await self._writer.flush()
+
+    async def close(self):
+        with self._collecting():
+            self._windowed.close()
+        await self._drain()
+        if self.close_writer:
+            await self._writer.close()
+
+
+class AsyncLogger(Logger):
+    """A :py:class:`dbxlogger.Logger` with awaitable `log()`, `flush()` and
+    `close()`. Contexts, `sub()`, `at()`, `at_iter()`, `new_event()` and
+    `windowed()` work exactly like in Logger; the writer must be an
+    AsyncLogWriter (or an AsyncWindowedLogWriter wrapping one).
+
+    Use it as `async with` to flush and close the log on exit.
+    """
+
+    def new(file_path, mode="w", context=None, **writer_kwargs):
+        """Create a new async logger at the given file path. writer_kwargs are
+        passed to AsyncLogWriter."""
+        if context is None:
+            context = LogContext()
+        w = AsyncLogWriter(file_path, mode, **writer_kwargs)
+        return AsyncLogger(writer=w, context=context)
+
+    async def __call__(self, event, data=None):
+        """Handy shortcut for calling await .log(event, data)."""
+        await self.log(event, data)
+
+    async def log(self, event, data=None):
+        event, data = self._event_and_data(event, data)
+        await self.writer.log(event, data)
+
+    def log_nowait(self, event, data=None):
+        """Like log() but doesn't wait, see AsyncLogWriter.log_nowait."""
+        event, data = self._event_and_data(event, data)
+        self.writer.log_nowait(event, data)
+
+    async def flush(self):
+        await self.writer.flush()
+
+    async def close(self):
+        await self.writer.close()
+
+    def _windowed_writer(self, **kwargs):
+        return AsyncWindowedLogWriter(self.writer, **kwargs)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
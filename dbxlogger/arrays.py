@@ -0,0 +1,380 @@
+"""
+Load metric series from a log straight into NumPy arrays.
+
+    from dbxlogger.arrays import read_arrays
+
+    a = read_arrays("output/abc/log.jsonl", "epoch/{epoch}/batch/{batch}/stats", ["train_loss"])
+    plt.plot(a["batch"], a["train_loss"])
+
+The event pattern names path components in braces; they are returned as
+int64 arrays. A {field} only matches a component made of the digits 0-9, so
+an event like "epoch/final/batch/0/stats" doesn't match
+"epoch/{epoch}/batch/{batch}/stats" and is skipped. Every requested key is
+returned as a float64 array, one value per matching event: NaN if the event
+doesn't have the key or it isn't a number, NaN and infinities encoded as
+`{"_dbx": ...}` are decoded, booleans become 0 and 1.
+
+Lines are never turned into dicts. The log is read in large blocks and each
+block is handled as a whole with NumPy operations on the raw bytes: event
+names are matched component by component, and the values of the requested
+top-level keys are located, gathered into fixed width byte arrays and
+converted in one go. Only lines with nested objects (where a nested key
+could have the same name), escaped event names or lines not written by
+FileLogWriter are decoded with json.
+
+Requires numpy.
+"""
+
+import fnmatch
+import json
+import re
+
+import numpy as np
+
+from .reader import dbx_object_hook, log_path, _matching_ranges
+
+_BLOCK_SIZE = 16 * 1024 * 1024
+
+# values longer than this are not numbers
+_MAX_VALUE_WIDTH = 32
+
+_FIELD = re.compile(r"\{(\w+)\}")
+_DIGITS = re.compile(r"[0-9]+")
+
+_NAN = float("nan")
+
+# raw values that are not plain numbers; {"_dbx": ...} values end at the
+# first "}" so the closing brace is not part of them
+_TOKENS = {
+    b"null": _NAN,
+    b"true": 1.0,
+    b"false": 0.0,
+    b'{"_dbx": "nan"': _NAN,
+    b'{"_dbx":"nan"': _NAN,
+    b'{"_dbx": "inf"': float("inf"),
+    b'{"_dbx":"inf"': float("inf"),
+    b'{"_dbx": "-inf"': float("-inf"),
+    b'{"_dbx":"-inf"': float("-inf"),
+}
+
+_DBX_FLOAT_OBJECTS = [t + b"}" for t in _TOKENS if t.startswith(b"{")]
+
+_NEWLINE, _QUOTE, _COMMA, _BACKSLASH, _SPACE, _LBRACE, _RBRACE, _SLASH = b'\n",\\ {}/'
+
+
+class _Pattern:
+    """An event pattern like "epoch/{epoch}/batch/{batch}/stats". Each path
+    component is a literal, a {field} (digits only), * or a glob like "ep*"
+    (fnmatch syntax, matched within the component)."""
+
+    def __init__(self, pattern):
+        self.glob = []
+        self.fields = []
+        # (kind, value) per path component, kind is "literal", "field",
+        # "any" or None if only match() can match it
+        self.components = []
+        # (field name, None) or (None, compiled glob) per path component
+        self._matchers = []
+        for part in pattern.split("/"):
+            m = _FIELD.fullmatch(part)
+            if m:
+                self.glob.append("*")
+                self.fields.append(m.group(1))
+                self.components.append(("field", m.group(1)))
+                self._matchers.append((m.group(1), None))
+                continue
+            # the same glob is used to select index runs, so both agree on
+            # what a component matches
+            self.glob.append(part)
+            self._matchers.append((None, re.compile(fnmatch.translate(part))))
+            if part == "*":
+                self.components.append(("any", None))
+            elif any(c in part for c in "*?[{"):
+                self.components.append((None, part))
+            else:
+                self.components.append(("literal", part.encode()))
+        self.glob = "/".join(self.glob)
+        self.simple = all(kind is not None for kind, _ in self.components)
+
+    def match(self, name):
+        """Return {field: component} if the event name matches, else None."""
+        parts = name.split("/")
+        if len(parts) != len(self._matchers):
+            return None
+        fields = {}
+        for part, (field, glob) in zip(parts, self._matchers):
+            if field is not None:
+                if not _DIGITS.fullmatch(part):
+                    return None
+                fields[field] = part
+            elif glob.fullmatch(part) is None:
+                return None
+        return fields
+
+
+def _find_literal(arr, literal):
+    """Positions where the bytes of literal start in arr."""
+    n = len(literal)
+    # start from the second byte, the first one is always a quote
+    pos = np.flatnonzero(arr[1:len(arr) - n + 1] == literal[1])
+    for i in range(2, n):
+        pos = pos[arr[pos + i] == literal[i]]
+    pos = pos[arr[pos] == literal[0]]
+    return pos
+
+
+def _gather(arr, start, end, width):
+    """Fixed width bytes array of arr[start:end] for every start, end."""
+    cols = np.arange(width)
+    if len(start) and int(start.max()) + width <= len(arr):
+        # copy whole rows out of a strided view instead of single bytes
+        windows = np.lib.stride_tricks.as_strided(arr, shape=(len(arr) - width + 1, width), strides=(1, 1))
+        chunk = windows[start]
+    else:
+        chunk = arr[np.minimum(start[:, None] + cols, len(arr) - 1)]
+    chunk[cols >= (end - start)[:, None]] = 0
+    return chunk.view("S%d" % width).reshape(len(start))
+
+
+def _to_float(raw):
+    out = np.full(len(raw), _NAN)
+    numeric = np.ones(len(raw), dtype=bool)
+    for token, value in _TOKENS.items():
+        mask = raw == token
+        if mask.any():
+            out[mask] = value
+            numeric &= ~mask
+    # strings, lists and anything too long are not numbers
+    first = raw.view(np.uint8).reshape(len(raw), -1)[:, 0] if len(raw) else raw
+    numeric &= (first != _QUOTE) & (first != ord("[")) & (first != _LBRACE) & (raw != b"")
+    try:
+        out[numeric] = raw[numeric].astype(np.float64)
+    except ValueError:
+        # something else that isn't a number (e.g. a value cut at a comma)
+        out[numeric] = [_raw_float(r) for r in raw[numeric]]
+    return out
+
+
+def _raw_float(r):
+    try:
+        return float(r)
+    except ValueError:
+        return _NAN
+
+
+def _value(v):
+    if isinstance(v, (bool, int, float)):
+        return float(v)
+    return _NAN
+
+
+def _key_values(arr, line_starts, delims, key, lines):
+    """Value of top-level key for the lines selected by the mask lines (NaN
+    where missing). Other lines are never parsed."""
+    literal = b'"' + json.dumps(key)[1:-1].encode() + b'":'
+    pos = _find_literal(arr, literal)
+    # keys inside strings are escaped
+    pos = pos[arr[pos - 1] != _BACKSLASH]
+    line = np.searchsorted(line_starts, pos, "right") - 1
+    pos = pos[lines[line]]
+
+    start = pos + len(literal)
+    start += arr[np.minimum(start, len(arr) - 1)] == _SPACE
+    end = delims[np.searchsorted(delims, start)]
+    width = min(int((end - start).max()) if len(pos) else 1, _MAX_VALUE_WIDTH)
+    too_long = (end - start) > width
+    raw = _gather(arr, start, end, max(width, 1))
+    raw[too_long] = b""
+
+    out = np.full(len(line_starts) - 1, _NAN)
+    out[np.searchsorted(line_starts, pos, "right") - 1] = _to_float(raw)
+    return out[lines]
+
+
+def _nested_lines(arr, line_starts):
+    """Lines with objects other than {"_dbx": "nan"} and friends."""
+    braces = np.flatnonzero(arr == _LBRACE)
+    width = max(len(t) for t in _DBX_FLOAT_OBJECTS)
+    window = _gather(arr, braces, braces + width, width)
+    dbx = np.zeros(len(braces), dtype=bool)
+    for t in _DBX_FLOAT_OBJECTS:
+        dbx |= np.char.startswith(window, t)
+    counts = np.bincount(np.searchsorted(line_starts, braces[~dbx], "right") - 1,
+        minlength=len(line_starts) - 1)
+    return counts > 1
+
+
+def _parse_slow(lines, pattern, keys, matched=None):
+    """Decode lines with json. Returns (fields, keys) lists of arrays for the
+    matching lines; matched[i] is set for matching lines if given."""
+    field_values = [[] for _ in pattern.fields]
+    key_values = [[] for _ in keys]
+    for i, line in enumerate(lines):
+        ev = json.loads(line, object_hook=dbx_object_hook)
+        m = pattern.match(ev.get("event", ""))
+        if m is None:
+            continue
+        if matched is not None:
+            matched[i] = True
+        for values, field in zip(field_values, pattern.fields):
+            values.append(int(m[field]))
+        for values, key in zip(key_values, keys):
+            values.append(_value(ev.get(key)))
+    return ([np.array(v, dtype=np.int64) for v in field_values],
+        [np.array(v, dtype=np.float64) for v in key_values])
+
+
+def _is_digits(raw, length):
+    """Whether each of the (zero padded) byte strings raw, of the given
+    lengths, is only digits."""
+    if not len(raw):
+        return np.ones(0, dtype=bool)
+    u = raw.view(np.uint8).reshape(len(raw), -1)
+    digit = (u >= ord("0")) & (u <= ord("9"))
+    return (digit | (np.arange(u.shape[1]) >= length[:, None])).all(axis=1) & (length > 0)
+
+
+def _match_events(arr, name_start, name_end, pattern):
+    """Match the event names arr[name_start:name_end] against pattern.
+    Returns (indices of the matching names, list of int64 arrays with the
+    fields of the matching names)."""
+    if not pattern.simple:
+        width = max(int((name_end - name_start).max()), 1)
+        names = _gather(arr, name_start, name_end, width).tolist()
+        found = [pattern.match(n.decode()) for n in names]
+        idx = np.array([i for i, m in enumerate(found) if m is not None], dtype=np.int64)
+        fields = [np.array([int(found[i][f]) for i in idx], dtype=np.int64) for f in pattern.fields]
+        return idx, fields
+
+    slashes = np.flatnonzero(arr == _SLASH)
+    first = np.searchsorted(slashes, name_start)
+    nparts = np.searchsorted(slashes, name_end) - first + 1
+    idx = np.flatnonzero(nparts == len(pattern.components))
+    first = first[idx]
+
+    last = len(pattern.components) - 1
+    spans = []
+    for k, (kind, value) in enumerate(pattern.components):
+        start = name_start[idx] if k == 0 else slashes[first + k - 1] + 1
+        end = name_end[idx] if k == last else slashes[first + k]
+        if kind == "literal":
+            ok = (end - start) == len(value)
+            if len(value):
+                ok &= _gather(arr, start, end, len(value)) == value
+            idx, first = idx[ok], first[ok]
+            spans = [(s[ok], e[ok]) for s, e in spans]
+        elif kind == "field":
+            spans.append((start, end))
+
+    raws = []
+    ok = np.ones(len(idx), dtype=bool)
+    for start, end in spans:
+        width = max(int((end - start).max()) if len(start) else 1, 1)
+        raw = _gather(arr, start, end, width)
+        ok &= _is_digits(raw, end - start)
+        raws.append(raw)
+    return idx[ok], [raw[ok].astype(np.int64) for raw in raws]
+
+
+def _parse_block(block, pattern, keys):
+    # the padding lets _gather read past the last line
+    buf = b"\n" + block + bytes(_MAX_VALUE_WIDTH)
+    arr = np.frombuffer(buf, dtype=np.uint8)
+    line_starts = np.flatnonzero(arr == _NEWLINE)
+    starts = line_starts[:-1] + 1
+    nlines = len(starts)
+    if nlines == 0:
+        return None
+
+    # every line written by FileLogWriter starts with {"event": "name"
+    space = arr[np.minimum(starts + 9, len(arr) - 1)] == _SPACE
+    name_start = starts + 10 + space
+    plain = ((_gather(arr, starts, starts + 9, 9) == b'{"event":') &
+        (arr[np.minimum(name_start - 1, len(arr) - 1)] == _QUOTE))
+
+    quotes = np.flatnonzero(arr == _QUOTE)
+    name_end = quotes[np.minimum(np.searchsorted(quotes, name_start), len(quotes) - 1)]
+    backslashes = np.flatnonzero(arr == _BACKSLASH)
+    plain &= np.searchsorted(backslashes, name_start) == np.searchsorted(backslashes, name_end)
+    plain &= name_end < line_starts[1:]
+
+    plain_idx = np.flatnonzero(plain)
+    found, field_arrays = _match_events(arr, name_start[plain_idx], name_end[plain_idx], pattern)
+    matched = np.zeros(nlines, dtype=bool)
+    matched[plain_idx[found]] = True
+
+    # lines that aren't plain can't be checked without decoding them
+    slow = ~plain | (matched & _nested_lines(arr, line_starts))
+    fast = matched & ~slow
+    if not fast.any() and not slow.any():
+        return None
+
+    keep = ~slow[matched]
+    field_arrays = [a[keep] for a in field_arrays]
+
+    delims = np.flatnonzero((arr == _COMMA) | (arr == _RBRACE) | (arr == _NEWLINE))
+    key_arrays = [_key_values(arr, line_starts, delims, k, fast) for k in keys]
+
+    if not slow.any():
+        return field_arrays, key_arrays
+
+    # decode the slow lines and put everything back in log order
+    slow_idx = np.flatnonzero(slow)
+    lines = [buf[line_starts[i] + 1:line_starts[i + 1]] for i in slow_idx]
+    slow_matched = np.zeros(len(lines), dtype=bool)
+    slow_fields, slow_keys = _parse_slow(lines, pattern, keys, slow_matched)
+
+    order = np.argsort(np.concatenate([np.flatnonzero(fast), slow_idx[slow_matched]]), kind="stable")
+    field_arrays = [np.concatenate([a, b])[order] for a, b in zip(field_arrays, slow_fields)]
+    key_arrays = [np.concatenate([a, b])[order] for a, b in zip(key_arrays, slow_keys)]
+    return field_arrays, key_arrays
+
+
+def _blocks(f, ranges):
+    """Yield blocks of whole lines from the byte ranges of f."""
+    for start, stop in ranges:
+        f.seek(start)
+        remaining = stop - start
+        carry = b""
+        while remaining > 0:
+            data = f.read(min(_BLOCK_SIZE, remaining))
+            if not data:
+                break
+            remaining -= len(data)
+            data = carry + data
+            nl = data.rfind(b"\n")
+            if nl < 0:
+                carry = data
+                continue
+            carry = data[nl + 1:]
+            yield data[:nl + 1]
+        # a partial last line in carry is not part of the log yet
+
+
+def read_arrays(source, pattern, keys, name=None, use_index=True):
+    """Return a dict of NumPy arrays: one int64 array per field of pattern
+    and one float64 array per key, with one element per matching event.
+
+    source: anything read_log() accepts except file objects
+    pattern: event name pattern, with {field} for path components to return
+        and * for components to ignore
+    keys: top-level keys of the event data to return
+    name: log name when source is an experiment
+    use_index: use the sidecar index of the log if there is one
+    """
+    pattern = _Pattern(pattern)
+
+    parts = []
+    path = log_path(source, name)
+    with open(path, "rb") as f:
+        for block in _blocks(f, _matching_ranges(path, pattern.glob, use_index)):
+            parsed = _parse_block(block, pattern, keys)
+            if parsed is not None:
+                parts.append(parsed)
+
+    result = {}
+    for i, field in enumerate(pattern.fields):
+        result[field] = np.concatenate([p[0][i] for p in parts] + [np.empty(0, dtype=np.int64)])
+    for i, key in enumerate(keys):
+        result[key] = np.concatenate([p[1][i] for p in parts] + [np.empty(0, dtype=np.float64)])
+    return result
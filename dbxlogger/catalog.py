@@ -0,0 +1,425 @@
+"""
+A catalog of the experiments in a :py:class:`dbxlogger.repo.LocalRepo`,
+kept in a SQLite file in the repo (`.dbxcatalog.sqlite`).
+
+Finding experiments by reading every meta.json is slow on big repos. The
+catalog keeps the interesting meta fields and the params (flattened,
+"optim.lr" for {"optim": {"lr": ...}}) in indexed tables:
+
+    from dbxlogger.catalog import Catalog
+
+    cat = Catalog("./output")
+    cat.refresh()
+    for e in cat.find(kind="train.py", params={"lr": 0.1, "optimizer": ["adam", "sgd"]}):
+        print(e.id, e.path, cat.params(e))
+
+refresh() is incremental: a directory is only listed again if its mtime
+changed and an experiment is only read again if its meta.json changed (mtime
+or size), so on a repo that didn't change it costs a stat per experiment.
+Experiments are directories with a meta.json; directories without one are
+groups (experiment names) and are searched for experiments. Entries
+starting with a dot (like the repo's object store) are ignored. The
+environment (env) of meta.json is not kept, it's large and rarely searched.
+
+For anything find() can't express, the SQLite connection is available as
+`Catalog.db` (see the tables in _SCHEMA).
+"""
+
+import collections
+import datetime
+import json
+import os
+import sqlite3
+import time
+
+from .reader import dbx_object_hook
+
+CATALOG_FILENAME = ".dbxcatalog.sqlite"
+CATALOG_VERSION = 2
+
+# directories modified less than this long ago are listed on every refresh
+_MTIME_SLACK_NS = 2 * 10**9
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS dirs (
+    path TEXT PRIMARY KEY,
+    parent TEXT,
+    mtime_ns INTEGER
+);
+CREATE INDEX IF NOT EXISTS dirs_parent ON dirs (parent);
+
+CREATE TABLE IF NOT EXISTS exps (
+    rowid INTEGER PRIMARY KEY,
+    path TEXT UNIQUE NOT NULL,
+    parent TEXT NOT NULL,
+    id TEXT,
+    name TEXT,
+    kind TEXT,
+    created_at TEXT,
+    created_ts REAL,
+    hostname TEXT,
+    script TEXT,
+    git_branch TEXT,
+    git_commit TEXT,
+    git_commit_long TEXT,
+    git_dirty INTEGER,
+    meta TEXT,
+    meta_mtime_ns INTEGER,
+    meta_size INTEGER
+);
+CREATE INDEX IF NOT EXISTS exps_parent ON exps (parent);
+CREATE INDEX IF NOT EXISTS exps_id ON exps (id);
+CREATE INDEX IF NOT EXISTS exps_name ON exps (name);
+CREATE INDEX IF NOT EXISTS exps_kind ON exps (kind);
+CREATE INDEX IF NOT EXISTS exps_created_ts ON exps (created_ts);
+CREATE INDEX IF NOT EXISTS exps_git_commit ON exps (git_commit);
+
+CREATE TABLE IF NOT EXISTS params (
+    exp INTEGER NOT NULL,
+    key TEXT NOT NULL,
+    value
+);
+CREATE INDEX IF NOT EXISTS params_key_value ON params (key, value);
+CREATE INDEX IF NOT EXISTS params_exp ON params (exp);
+"""
+
+# created_at is ordered by its timestamp, the strings may not all have the
+# same format
+_ORDER_COLUMNS = {"created_at": "created_ts", "id": "id", "name": "name", "kind": "kind", "path": "path"}
+
+CatalogEntry = collections.namedtuple("CatalogEntry",
+    ["id", "path", "name", "kind", "created_at", "hostname", "git_commit"])
+
+
+def flatten_params(params, prefix=""):
+    """Flatten nested dicts into "a.b" keys. Lists are kept as values."""
+    flat = {}
+    for k, v in params.items():
+        key = prefix + str(k)
+        if isinstance(v, dict) and v and "_dbx" not in v:
+            flat.update(flatten_params(v, key + "."))
+        else:
+            flat[key] = v
+    return flat
+
+
+def _sql_value(v):
+    """Store params the way SQLite can index and compare them: numbers,
+    strings and NULL as they are, everything else as JSON."""
+    if v is None or isinstance(v, (bool, int, float, str)):
+        return v
+    return json.dumps(v, sort_keys=True, default=str)
+
+
+def _is_glob(s):
+    return any(c in s for c in "*?[")
+
+
+class Catalog:
+    """SQLite catalog of the experiments in a local repo.
+
+    repo: a LocalRepo or the path of one
+    path: the SQLite file (default .dbxcatalog.sqlite in the repo)
+    """
+
+    def __init__(self, repo, path=None):
+        self.repo_path = repo if isinstance(repo, str) else repo.path
+        if path is None:
+            path = os.path.join(self.repo_path, CATALOG_FILENAME)
+        self.path = path
+
+        self.db = sqlite3.connect(path, timeout=60)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        version = self.db.execute("PRAGMA user_version").fetchone()[0]
+        if version != CATALOG_VERSION:
+            # older (or newer) layout: the catalog is only a cache, start over
+            with self.db:
+                for table in ("dirs", "exps", "params"):
+                    self.db.execute("DROP TABLE IF EXISTS %s" % table)
+                self.db.execute("PRAGMA user_version = %d" % CATALOG_VERSION)
+        self.db.executescript(_SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def refresh(self):
+        """Bring the catalog up to date with the repo. Returns a dict with
+        the number of experiments added, updated and removed."""
+        counts = {"added": 0, "updated": 0, "removed": 0}
+        with self.db:
+            stack = [""]
+            while stack:
+                stack.extend(self._refresh_dir(stack.pop(), counts))
+        return counts
+
+    def _refresh_dir(self, rel, counts):
+        """Refresh the group directory rel (relative to the repo) and return
+        its subgroups."""
+        full = os.path.join(self.repo_path, rel) if rel else self.repo_path
+        try:
+            mtime_ns = os.stat(full).st_mtime_ns
+        except FileNotFoundError:
+            self._remove_dir(rel, counts)
+            return []
+
+        row = self.db.execute("SELECT mtime_ns FROM dirs WHERE path = ?", (rel,)).fetchone()
+        if row is not None and row[0] == mtime_ns:
+            changed = False
+        else:
+            changed = True
+            if rel and os.path.exists(os.path.join(full, "meta.json")):
+                # a group became an experiment (meta.json is written after
+                # the directory is created)
+                self._remove_dir(rel, counts)
+                if not self._refresh_exp(os.path.dirname(rel), rel, None, counts):
+                    # keep it as a group that is listed again next time
+                    self.db.execute("INSERT INTO dirs (path, parent, mtime_ns) VALUES (?, ?, NULL)",
+                        (rel, os.path.dirname(rel)))
+                return []
+
+        known_groups = set(r[0] for r in self.db.execute(
+            "SELECT path FROM dirs WHERE parent = ?", (rel,)))
+        known_exps = {r[1]: r for r in self.db.execute(
+            "SELECT rowid, path, meta_mtime_ns, meta_size FROM exps WHERE parent = ?", (rel,))}
+
+        if not changed:
+            # no entries added or removed, only check the experiments for
+            # changes to their meta.json
+            for exp_row in known_exps.values():
+                self._refresh_exp(rel, exp_row[1], exp_row, counts)
+            return list(known_groups)
+
+        groups = []
+        seen = set()
+        complete = True
+        with os.scandir(full) as entries:
+            for entry in entries:
+                if entry.name.startswith(".") or not entry.is_dir():
+                    continue
+                path = os.path.join(rel, entry.name) if rel else entry.name
+                seen.add(path)
+                if path in known_exps or os.path.exists(os.path.join(entry.path, "meta.json")):
+                    if path in known_groups:
+                        self._remove_dir(path, counts)
+                    complete &= self._refresh_exp(rel, path, known_exps.get(path), counts)
+                else:
+                    groups.append(path)
+
+        for path in known_groups:
+            if path not in seen:
+                self._remove_dir(path, counts)
+        for path, exp_row in known_exps.items():
+            if path not in seen:
+                self._remove_exp(exp_row[0], counts)
+
+        if not complete or time.time_ns() - mtime_ns < _MTIME_SLACK_NS:
+            # a meta.json that couldn't be read yet, or entries added in the
+            # same mtime tick after the listing, would go unnoticed: list the
+            # directory again next time
+            mtime_ns = None
+        self.db.execute("INSERT OR REPLACE INTO dirs (path, parent, mtime_ns) VALUES (?, ?, ?)",
+            (rel, None if rel == "" else os.path.dirname(rel), mtime_ns))
+        return groups
+
+    def _refresh_exp(self, parent, path, row, counts):
+        """Add, update or remove the experiment at path. Returns False if its
+        meta.json couldn't be read yet."""
+        meta_path = os.path.join(self.repo_path, path, "meta.json")
+        try:
+            st = os.stat(meta_path)
+        except FileNotFoundError:
+            if row is not None:
+                self._remove_exp(row[0], counts)
+            return True
+
+        if row is not None and row[2] == st.st_mtime_ns and row[3] == st.st_size:
+            return True
+
+        try:
+            with open(meta_path, "rb") as f:
+                meta = json.load(f, object_hook=dbx_object_hook)
+        except ValueError:
+            # meta.json still being written, keep the old row (its mtime no
+            # longer matches) and pick it up next time
+            return False
+        if not isinstance(meta, dict):
+            if row is not None:
+                self._remove_exp(row[0], counts)
+            return True
+
+        git = meta.get("git") if isinstance(meta.get("git"), dict) else {}
+        values = (
+            path, parent, meta.get("id") or os.path.basename(path),
+            meta.get("name"), meta.get("kind"), meta.get("createdAt"),
+            _timestamp(meta.get("createdAt")), meta.get("hostname"), meta.get("script"),
+            git.get("branch"), git.get("commit"), git.get("commit_long"),
+            git.get("uncommited_changes"),
+            json.dumps({k: v for k, v in meta.items() if k != "env"}, sort_keys=True),
+            st.st_mtime_ns, st.st_size,
+        )
+
+        if row is None:
+            cur = self.db.execute("""INSERT INTO exps (path, parent, id, name, kind,
+                created_at, created_ts, hostname, script, git_branch, git_commit,
+                git_commit_long, git_dirty, meta, meta_mtime_ns, meta_size)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""", values)
+            rowid = cur.lastrowid
+            counts["added"] += 1
+        else:
+            rowid = row[0]
+            self.db.execute("""UPDATE exps SET path = ?, parent = ?, id = ?, name = ?,
+                kind = ?, created_at = ?, created_ts = ?, hostname = ?, script = ?,
+                git_branch = ?, git_commit = ?, git_commit_long = ?, git_dirty = ?, meta = ?,
+                meta_mtime_ns = ?, meta_size = ? WHERE rowid = ?""", values + (rowid,))
+            self.db.execute("DELETE FROM params WHERE exp = ?", (rowid,))
+            counts["updated"] += 1
+
+        params = meta.get("params")
+        if isinstance(params, dict):
+            self.db.executemany("INSERT INTO params (exp, key, value) VALUES (?, ?, ?)",
+                [(rowid, k, _sql_value(v)) for k, v in flatten_params(params).items()])
+        return True
+
+    def _remove_exp(self, rowid, counts):
+        self.db.execute("DELETE FROM params WHERE exp = ?", (rowid,))
+        self.db.execute("DELETE FROM exps WHERE rowid = ?", (rowid,))
+        counts["removed"] += 1
+
+    def _remove_dir(self, rel, counts):
+        """Remove a group directory and everything under it."""
+        for path, in self.db.execute("SELECT path FROM dirs WHERE parent = ?", (rel,)).fetchall():
+            self._remove_dir(path, counts)
+        for rowid, in self.db.execute("SELECT rowid FROM exps WHERE parent = ?", (rel,)).fetchall():
+            self._remove_exp(rowid, counts)
+        self.db.execute("DELETE FROM dirs WHERE path = ?", (rel,))
+
+    def find(self, id=None, kind=None, name=None, hostname=None, commit=None,
+            params=None, created_after=None, created_before=None,
+            order_by="created_at", limit=None):
+        """Return a list of CatalogEntry for the experiments matching all the
+        given conditions. Call refresh() first to see the latest experiments.
+
+        id, kind, name, hostname: exact values, or glob patterns ("resnet*")
+        commit: a git commit hash or a prefix of one
+        params: dict of param name (flattened, "optim.lr") to value; a list,
+            tuple or set of values matches any of them and None matches a
+            param that is null
+        created_after, created_before: datetime or ISO 8601 string, UTC if
+            it has no timezone
+        order_by: created_at (default), id, name, kind or path; prefix with
+            "-" for descending order
+        """
+        where = []
+        args = []
+
+        for column, value in (("id", id), ("kind", kind), ("name", name), ("hostname", hostname)):
+            if value is None:
+                continue
+            if _is_glob(value):
+                where.append("%s GLOB ?" % column)
+            else:
+                where.append("%s = ?" % column)
+            args.append(value)
+
+        if commit is not None:
+            where.append("git_commit LIKE ? ESCAPE '\\'")
+            args.append(commit.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%")
+
+        if created_after is not None:
+            where.append("created_ts >= ?")
+            args.append(_date_arg(created_after))
+        if created_before is not None:
+            where.append("created_ts < ?")
+            args.append(_date_arg(created_before))
+
+        for key, value in (params or {}).items():
+            if value is None:
+                where.append("rowid IN (SELECT exp FROM params WHERE key = ? AND value IS NULL)")
+                args.append(key)
+            elif isinstance(value, (list, tuple, set, frozenset)):
+                value = list(value)
+                where.append("rowid IN (SELECT exp FROM params WHERE key = ? AND value IN (%s))"
+                    % ", ".join("?" * len(value)))
+                args.append(key)
+                args.extend(_sql_value(v) for v in value)
+            else:
+                where.append("rowid IN (SELECT exp FROM params WHERE key = ? AND value = ?)")
+                args.append(key)
+                args.append(_sql_value(value))
+
+        order = order_by.lstrip("-")
+        if order not in _ORDER_COLUMNS:
+            raise Exception("cannot order catalog results by %s" % order_by)
+
+        query = "SELECT id, path, name, kind, created_at, hostname, git_commit FROM exps"
+        if where:
+            query += " WHERE " + " AND ".join(where)
+        query += " ORDER BY %s %s" % (_ORDER_COLUMNS[order], "DESC" if order_by.startswith("-") else "ASC")
+        if limit is not None:
+            query += " LIMIT %d" % limit
+
+        return [CatalogEntry(r[0], os.path.join(self.repo_path, r[1]), *r[2:])
+            for r in self.db.execute(query, args)]
+
+    def _rowid(self, entry):
+        if isinstance(entry, CatalogEntry):
+            rel = os.path.relpath(entry.path, self.repo_path)
+            row = self.db.execute("SELECT rowid FROM exps WHERE path = ?", (rel,)).fetchone()
+        else:
+            row = self.db.execute("SELECT rowid FROM exps WHERE id = ?", (entry,)).fetchone()
+        if row is None:
+            raise KeyError(entry)
+        return row[0]
+
+    def meta(self, entry):
+        """The meta.json contents of an experiment (a CatalogEntry or id) as
+        stored in the catalog, without env."""
+        row = self.db.execute("SELECT meta FROM exps WHERE rowid = ?", (self._rowid(entry),)).fetchone()
+        return json.loads(row[0], object_hook=dbx_object_hook)
+
+    def params(self, entry):
+        """The flattened params of an experiment (a CatalogEntry or id)."""
+        return {k: v for k, v in self.db.execute(
+            "SELECT key, value FROM params WHERE exp = ?", (self._rowid(entry),))}
+
+    def param_values(self, key, kind=None):
+        """The distinct values of a param across the catalog, optionally only
+        for experiments of a kind."""
+        if kind is None:
+            rows = self.db.execute("SELECT DISTINCT value FROM params WHERE key = ?", (key,))
+        else:
+            rows = self.db.execute("""SELECT DISTINCT value FROM params
+                JOIN exps ON exps.rowid = params.exp
+                WHERE key = ? AND exps.kind = ?""", (key, kind))
+        return [r[0] for r in rows]
+
+    def __len__(self):
+        return self.db.execute("SELECT COUNT(*) FROM exps").fetchone()[0]
+
+
+def _timestamp(d):
+    """Seconds since the epoch of a datetime or ISO 8601 string, UTC if it has
+    no timezone. None if it can't be parsed."""
+    if isinstance(d, str):
+        try:
+            d = datetime.datetime.fromisoformat(d[:-1] + "+00:00" if d.endswith("Z") else d)
+        except ValueError:
+            return None
+    if not isinstance(d, datetime.datetime):
+        return None
+    if d.tzinfo is None:
+        d = d.replace(tzinfo=datetime.timezone.utc)
+    return d.timestamp()
+
+
+def _date_arg(d):
+    ts = _timestamp(d)
+    if ts is None:
+        raise Exception("invalid date %r, use a datetime or an ISO 8601 string" % (d,))
+    return ts
@@ -0,0 +1,208 @@
+"""
+Checkpoints written in the background, with retention policies.
+
+    ckpt = exp.checkpoints(keep_last=2, keep_best=3, metric="val_loss", mode="min")
+    for epoch in range(epochs):
+        ...
+        buf = io.BytesIO()
+        torch.save(model.state_dict(), buf)
+        ckpt.save(epoch, buf, val_loss=val_loss)
+    ckpt.close()
+
+save() copies the data (bytes, a buffer or a BytesIO) and returns; the file
+is written with exp.file() on a background thread and fsynced together with
+the file index, and then a "checkpoint" event is logged referencing the
+expfile:
+
+    {"event": "checkpoint", "file": {"_dbx": "expfile", ...}, "name": "checkpoint-3",
+     "step": 3, "val_loss": 0.41}
+
+At most max_in_flight checkpoints are pending at once, save() waits for the
+oldest when there are more. Instead of data, save() can take a write
+callback that gets the open file; it runs on the background thread, so it
+must only use data that won't change (e.g. a copy of the state dict).
+
+Retention: with keep_last and/or keep_best only the last keep_last
+checkpoints and the keep_best best ones (by the value of metric given to
+save()) are kept; the others are deleted once a newer checkpoint is durable
+and a "checkpoint_removed" event is logged.
+
+The events are logged on the thread calling save(), wait() and close(), not
+on the background thread, so the logger doesn't need to be thread safe:
+an event shows up in the log with the next of those calls after the
+checkpoint is written.
+"""
+
+import collections
+import concurrent.futures
+import math
+import os
+import sys
+import threading
+
+CHECKPOINT_EVENT = "checkpoint"
+CHECKPOINT_REMOVED_EVENT = "checkpoint_removed"
+
+
+class CheckpointManager:
+    """Writes checkpoints of an experiment in the background, see the module
+    documentation.
+
+    exp: a saved Exp
+    name_format: expfile name, formatted with step
+    max_in_flight: checkpoints that can be pending at once
+    keep_last: keep the last this many checkpoints (by order of save())
+    keep_best: keep the best this many checkpoints by metric
+    metric: name of the save() value keep_best ranks by
+    mode: "min" or "max", whether lower or higher metric is better
+    logger: logger for the checkpoint events (default exp.logger())
+    """
+
+    def __init__(self, exp, name_format="checkpoint-{step}", max_in_flight=2,
+            keep_last=None, keep_best=None, metric=None, mode="min", logger=None):
+        if keep_best is not None and metric is None:
+            raise Exception("keep_best needs a metric")
+        if mode not in ("min", "max"):
+            raise Exception("invalid mode %s, use min or max" % mode)
+        if max_in_flight < 1:
+            raise Exception("max_in_flight must be at least 1")
+
+        self.exp = exp
+        self.name_format = name_format
+        self.max_in_flight = max_in_flight
+        self.keep_last = keep_last
+        self.keep_best = keep_best
+        self.metric = metric
+        self.mode = mode
+        self._logger = logger
+
+        # (name, step, metric value) of the durable checkpoints, oldest first
+        self.checkpoints = []
+        self._slots = threading.Semaphore(max_in_flight)
+        self._pending = []
+        # (event, data) to log on the caller's thread
+        self._events = collections.deque()
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1,
+            thread_name_prefix="dbxlogger-checkpoint")
+        self._closed = False
+
+    @property
+    def logger(self):
+        if self._logger is None:
+            self._logger = self.exp.logger()
+        return self._logger
+
+    def _log_events(self):
+        while self._events:
+            self.logger(*self._events.popleft())
+
+    def save(self, step, data=None, write=None, **values):
+        """Write a checkpoint in the background. Returns a Future of the
+        expfile. Logs the events of the checkpoints written since the last
+        call.
+
+        step: checkpoint step, for the file name and the event
+        data: the checkpoint as bytes, bytearray, memoryview or BytesIO
+        write: instead of data, a function called with the open (binary)
+            file on the background thread
+        values: logged in the checkpoint event; the one named metric is used
+            by keep_best
+        """
+        if self._closed:
+            raise Exception("cannot save a checkpoint with a closed CheckpointManager")
+        if (data is None) == (write is None):
+            raise Exception("give either data or write")
+        if data is not None:
+            if hasattr(data, "getvalue"):
+                data = data.getvalue()
+            elif not isinstance(data, bytes):
+                data = bytes(data)
+
+        name = self.name_format.format(step=step)
+        self._log_events()
+        self._slots.acquire()
+        try:
+            future = self._executor.submit(self._write, name, step, data, write, values)
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda f: self._slots.release())
+        self._pending = [f for f in self._pending if not f.done()]
+        self._pending.append(future)
+        return future
+
+    def _write(self, name, step, data, write, values):
+        try:
+            expfile = self.exp.file(name, "wb")
+            with expfile as f:
+                if data is not None:
+                    f.write(data)
+                else:
+                    write(f)
+                f.flush()
+                os.fsync(f.fileno())
+            # the directory entries and the file index entry, so the
+            # checkpoint is there after a crash once it is logged
+            self.exp._fsync_file(name)
+        except Exception as e:
+            print("WARN: dbxlogger could not write checkpoint %s: %r" % (name, e), file=sys.stderr)
+            raise
+
+        event = dict(values)
+        event.update({"file": expfile, "name": name, "step": step})
+        self._events.append((CHECKPOINT_EVENT, event))
+
+        metric = values.get(self.metric) if self.metric is not None else None
+        self.checkpoints = [c for c in self.checkpoints if c[0] != name]
+        self.checkpoints.append((name, step, metric))
+        self._apply_retention()
+        return expfile
+
+    def _keep(self):
+        """Names of the checkpoints the retention policies keep."""
+        if self.keep_last is None and self.keep_best is None:
+            return set(c[0] for c in self.checkpoints)
+        keep = set()
+        if self.keep_last:
+            keep.update(c[0] for c in self.checkpoints[-self.keep_last:])
+        if self.keep_best:
+            ranked = [c for c in self.checkpoints
+                if isinstance(c[2], (int, float)) and not math.isnan(c[2])]
+            ranked.sort(key=lambda c: c[2], reverse=self.mode == "max")
+            keep.update(c[0] for c in ranked[:self.keep_best])
+        return keep
+
+    def _apply_retention(self):
+        keep = self._keep()
+        for name, step, metric in self.checkpoints:
+            if name in keep:
+                continue
+            try:
+                self.exp._remove_file(name)
+            except OSError as e:
+                print("WARN: dbxlogger could not remove checkpoint %s: %r" % (name, e), file=sys.stderr)
+                continue
+            self._events.append((CHECKPOINT_REMOVED_EVENT, {"name": name, "step": step}))
+        self.checkpoints = [c for c in self.checkpoints if c[0] in keep]
+
+    def wait(self):
+        """Wait until all checkpoints saved so far are written and log their
+        events. Raises the error of the first one that failed."""
+        pending, self._pending = self._pending, []
+        try:
+            for f in pending:
+                f.result()
+        finally:
+            # events of the checkpoints written before the failed one
+            concurrent.futures.wait(pending)
+            self._log_events()
+
+    def close(self):
+        """Wait for the pending checkpoints and stop the background thread."""
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            self.wait()
+        finally:
+            self._executor.shutdown(wait=True)
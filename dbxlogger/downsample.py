@@ -0,0 +1,239 @@
+"""
+Write-time downsampling: instead of every event, log one summary per window
+of events with count, mean, min, max and last of the numeric values.
+
+    log = exp.logger().windowed(every=100)
+    for epoch in range(epochs):
+        for batch_idx, batch in enumerate(loader):
+            ...
+            log.sub("epoch/%d/batch/%d" % (epoch, batch_idx))("stats", {"loss": loss})
+
+writes one "epoch/E/batch/B/stats" event per 100 batches (B is the last batch
+of the window) with data like:
+
+    {"_count": 100, "_first_event": "epoch/0/batch/0/stats",
+     "loss.last": 0.41, "loss.max": 2.3, "loss.mean": 0.9, "loss.min": 0.38}
+
+The keys about the window itself start with an underscore so they don't
+clash with the keys of the events.
+
+Events are grouped into windows by name, ignoring the last numeric path
+component ("epoch/0/batch/*/stats"), so counters in event names work as
+expected. When an event starts a window for a different value of the other
+numeric components (epoch 1 after epoch 0) the old window is written first,
+so windows never mix epochs. Values that are not real numbers (strings,
+bools, lists, complex numbers) are logged with their last value.
+
+Loggers made with sub(), parent(), root() and at() share the windows, since
+they share the writer.
+"""
+
+import math
+import numbers
+import random
+import sys
+import threading
+import time
+
+from .logger import _running_writers, _install_sigterm_handler
+from .reader import event_filter
+
+
+def window_key(event_name):
+    """Return (key, family) for event_name: the window key has the last
+    numeric path component replaced by "*", the family has all of them
+    replaced."""
+    parts = event_name.split("/")
+    numeric = [i for i, p in enumerate(parts) if p.isdigit()]
+    if not numeric:
+        return event_name, event_name
+    key = list(parts)
+    key[numeric[-1]] = "*"
+    family = list(parts)
+    for i in numeric:
+        family[i] = "*"
+    return "/".join(key), "/".join(family)
+
+
+def _is_number(v):
+    return isinstance(v, numbers.Real) and not isinstance(v, bool)
+
+
+class _Stats:
+    __slots__ = ("count", "total", "min", "max", "last", "samples", "seen")
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+        self.last = None
+        self.samples = None
+        self.seen = 0
+
+
+class _Window:
+    """The events of one window key seen since the last summary."""
+
+    def __init__(self, first_event, now):
+        self.first_event = first_event
+        self.last_event = first_event
+        self.started = now
+        self.count = 0
+        self.stats = {}
+        self.other = {}
+
+    def add(self, event_name, data, samples, rng):
+        self.last_event = event_name
+        self.count += 1
+        for k, v in data.items():
+            if not _is_number(v):
+                self.other[k] = v
+                continue
+            s = self.stats.get(k)
+            if s is None:
+                s = self.stats[k] = _Stats()
+            s.last = v
+            if math.isnan(v):
+                continue
+            s.count += 1
+            s.total += v
+            if s.min is None or v < s.min:
+                s.min = v
+            if s.max is None or v > s.max:
+                s.max = v
+            if samples:
+                # reservoir sampling (algorithm R) keeping arrival order
+                if s.samples is None:
+                    s.samples = []
+                if len(s.samples) < samples:
+                    s.samples.append((s.seen, v))
+                else:
+                    j = rng.randrange(s.seen + 1)
+                    if j < samples:
+                        s.samples[j] = (s.seen, v)
+                s.seen += 1
+
+    def summary(self):
+        data = dict(self.other)
+        data["_count"] = self.count
+        data["_first_event"] = self.first_event
+        for k, s in self.stats.items():
+            data[k + ".last"] = s.last
+            if s.count != self.count:
+                data[k + ".count"] = s.count
+            if s.count:
+                data[k + ".mean"] = s.total / s.count
+                data[k + ".min"] = s.min
+                data[k + ".max"] = s.max
+            if s.samples is not None:
+                data[k + ".samples"] = [v for _, v in sorted(s.samples)]
+        return data
+
+
+class WindowedLogWriter:
+    """Wraps a log writer and logs one summary event per window instead of
+    every event. See the module documentation for the summary format.
+
+    writer: the writer the summaries (and events not windowed) go to
+    every: a window ends after this many events
+    interval: a window ends after this many seconds, checked when an event
+        is logged; with both every and interval, whichever comes first
+    samples: also keep a reservoir sample of this many values of each key
+    events: only window these events (see reader.event_filter), the others
+        are logged as they are; default all events
+    seed: seed for the reservoir sampling
+    close_writer: close() also closes writer (default True)
+
+    Open windows are written on flush() only with flush_windows=True and
+    always on close() (also at process exit and on SIGTERM).
+    """
+
+    def __init__(self, writer, every=None, interval=None, samples=0, events=None, seed=None,
+            close_writer=True):
+        if every is None and interval is None:
+            raise Exception("WindowedLogWriter needs every or interval")
+        if every is not None and every < 1:
+            raise Exception("every must be at least 1")
+        self._writer = writer
+        self.every = every
+        self.interval = interval
+        self.samples = samples
+        self._match = event_filter(events)
+        self._rng = random.Random(seed)
+        self.close_writer = close_writer
+
+        self._windows = {}
+        # family -> window key currently open for it
+        self._families = {}
+        self._lock = threading.Lock()
+        self._closed = False
+
+        _running_writers.add(self)
+        _install_sigterm_handler()
+
+    @property
+    def writer(self):
+        return self._writer
+
+    def log(self, event_name, data):
+        if self._match is not None and not self._match(event_name):
+            self._writer.log(event_name, data)
+            return
+
+        key, family = window_key(event_name)
+        now = time.monotonic()
+        with self._lock:
+            if self._closed:
+                raise Exception("cannot log to a closed WindowedLogWriter")
+
+            open_key = self._families.get(family)
+            if open_key is not None and open_key != key:
+                self._emit(open_key)
+
+            w = self._windows.get(key)
+            if w is None:
+                w = self._windows[key] = _Window(event_name, now)
+                self._families[family] = key
+            w.add(event_name, data, self.samples, self._rng)
+
+            if self.every is not None and w.count >= self.every:
+                self._emit(key)
+            elif self.interval is not None and now - w.started >= self.interval:
+                self._emit(key)
+
+    def _emit(self, key):
+        w = self._windows.pop(key)
+        family = window_key(w.last_event)[1]
+        if self._families.get(family) == key:
+            del self._families[family]
+        self._writer.log(w.last_event, w.summary())
+
+    def flush(self, flush_windows=False):
+        """Flush the wrapped writer; with flush_windows=True write the open
+        windows first (they are cut short)."""
+        with self._lock:
+            if flush_windows:
+                for key in list(self._windows):
+                    self._emit(key)
+        self._writer.flush()
+
+    def close(self, timeout=None):
+        """Write the open windows and close the wrapped writer (unless
+        close_writer is False). With a timeout (in seconds, used on SIGTERM)
+        wait at most that long for the lock and leave the wrapped writer to
+        the exit handlers."""
+        if not self._lock.acquire(timeout=-1 if timeout is None else timeout):
+            print("WARN: dbxlogger could not write the open windows in time", file=sys.stderr)
+            return
+        try:
+            if self._closed:
+                return
+            self._closed = True
+            for key in list(self._windows):
+                self._emit(key)
+        finally:
+            self._lock.release()
+        _running_writers.discard(self)
+        if timeout is None and self.close_writer:
+            self._writer.close()
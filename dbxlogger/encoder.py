@@ -1,11 +1,24 @@
+import contextlib
 import json
 import math
-import numbers
 import datetime
+import os
+import threading
 
 DBXCODE_NAN = "nan"
 DBXCODE_INFINITY = "inf"
 DBXCODE_NEG_INFINITY = "-inf"
+DBXCODE_ARRAY = "array"
+
+# event with the hash of a reffile logged before its hash was known
+REFFILE_HASH_EVENT = "_dbx/reffile"
+
+# arrays with more elements than this go to the array file of the log (if
+# it has one) instead of being written inline as JSON lists
+ARRAY_INLINE_SIZE = 256
+ARRAY_FILE_SUFFIX = ".arrays"
+# offsets of arrays in the array file are aligned for memmap
+_ARRAY_ALIGN = 64
 
 def encode_datetime(dt):
     """ Returns UTC date in ISO 8601 format, with Z at the end instead of
@@ -18,26 +31,348 @@ def encode_datetime(dt):
     utcdt = datetime.datetime.fromtimestamp(stamp, tz=datetime.timezone.utc)
     return utcdt.isoformat().replace("+00:00", "Z")
 
+def _as_ndarray(obj):
+    """Return obj as a numpy array if it is a numpy array or scalar or a
+    torch tensor, without importing either of them. Otherwise None."""
+    module = type(obj).__module__
+    if module == "numpy":
+        if hasattr(obj, "dtype") and hasattr(obj, "shape"):
+            return obj
+        return None
+    if module.startswith("torch") and hasattr(obj, "detach") and hasattr(obj, "numpy"):
+        t = obj.detach().cpu()
+        try:
+            return t.numpy()
+        except TypeError:
+            # dtypes numpy doesn't have (bfloat16)
+            return t.float().numpy()
+    return None
+
+
+def copy_arrays(obj):
+    """Return obj with the numpy arrays and torch tensors in (nested) dicts,
+    lists and tuples replaced by numpy copies, for writers that encode
+    events after log() returned. Containers without any are returned as
+    they are, not copied."""
+    module = type(obj).__module__
+    if module == "numpy" or module.startswith("torch"):
+        array = _as_ndarray(obj)
+        if array is None:
+            return obj
+        # a CPU tensor's numpy() shares its memory, copy either way
+        return array.copy()
+    if isinstance(obj, dict):
+        out = None
+        for k, v in obj.items():
+            r = copy_arrays(v)
+            if r is not v:
+                if out is None:
+                    out = dict(obj)
+                out[k] = r
+        return obj if out is None else out
+    if isinstance(obj, (list, tuple)):
+        out = None
+        for i, v in enumerate(obj):
+            r = copy_arrays(v)
+            if r is not v:
+                if out is None:
+                    out = list(obj)
+                out[i] = r
+        return obj if out is None else out
+    return obj
+
+
+class ArrayFile:
+    """Binary file next to a log (log.jsonl.arrays) that large arrays are
+    written to, so the log only has a reference to them:
+
+        {"_dbx": "array", "file": "log.jsonl.arrays", "offset": 4096,
+         "dtype": "<f4", "shape": [100, 100]}
+
+    The data is stored raw in C order at offset (aligned to 64 bytes) and
+    is written through before the event referencing it is encoded.
+    See dbxlogger.reader.load_array to read them back.
+    """
+
+    def __init__(self, path, mode="a"):
+        self.path = path
+        self.name = os.path.basename(path)
+        self.f = open(path, "wb" if mode.startswith("w") else "ab")
+        self._offset = self.f.seek(0, os.SEEK_END)
+        self._lock = threading.Lock()
+
+    def write(self, array):
+        """Append array and return its `_dbx` reference."""
+        import numpy as np
+        array = np.ascontiguousarray(array)
+        with self._lock:
+            pad = -self._offset % _ARRAY_ALIGN
+            if pad:
+                self.f.write(bytes(pad))
+            offset = self._offset + pad
+            self.f.write(array.reshape(-1).view(np.uint8))
+            self.f.flush()
+            self._offset = offset + array.nbytes
+        return {
+            "_dbx": DBXCODE_ARRAY,
+            "file": self.name,
+            "offset": offset,
+            "dtype": array.dtype.str,
+            "shape": list(array.shape),
+        }
+
+    def close(self):
+        self.f.close()
+
+
+def _nonfinite_code(f):
+    if f != f:
+        return {"_dbx": DBXCODE_NAN}
+    return {"_dbx": DBXCODE_INFINITY if f > 0 else DBXCODE_NEG_INFINITY}
+
+
+def replace_nonfinite(obj):
+    """Return obj with NaN and infinite floats in (nested) dicts, lists and
+    tuples replaced by their `_dbx` codes. Containers without any are
+    returned as they are, not copied."""
+    if isinstance(obj, float):
+        if math.isfinite(obj):
+            return obj
+        return _nonfinite_code(obj)
+    if isinstance(obj, dict):
+        out = None
+        for k, v in obj.items():
+            r = replace_nonfinite(v)
+            if r is not v:
+                if out is None:
+                    out = dict(obj)
+                out[k] = r
+        return obj if out is None else out
+    if isinstance(obj, (list, tuple)):
+        out = None
+        for i, v in enumerate(obj):
+            r = replace_nonfinite(v)
+            if r is not v:
+                if out is None:
+                    out = list(obj)
+                out[i] = r
+        return obj if out is None else out
+    return obj
+
+
 class DBXEncoder(json.JSONEncoder):
+    """JSON encoder for log events and meta.json.
 
-    def default(self, obj):
+    NaN and infinities are written as `_dbx` codes, never as the NaN and
+    Infinity literals (which are not JSON).
+
+    arrays: an ArrayFile for arrays larger than inline_size elements;
+        without one all arrays are written inline as lists
+    deferred: a dict; objects with a __dbx_encode_nowait__ method (RefFile)
+        are encoded without waiting for their hash and added to it as
+        id(obj): (obj, future)
+
+    Arrays written to the array file are remembered for the duration of
+    one encoding (see encoding()), so encoding again after replacing NaN
+    doesn't write them twice.
+    """
+
+    def __init__(self, *args, arrays=None, inline_size=ARRAY_INLINE_SIZE, deferred=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.allow_nan = False
+        self.arrays = arrays
+        self.inline_size = inline_size
+        self.deferred = deferred
+        # array references written during the current encoding, per thread
+        self._local = threading.local()
 
-        # handle numbers
-        if isinstance(obj, numbers.Number):
-            if math.isnan(obj):
-                return {"_dbx": DBXCODE_NAN}
-            if math.isinf(obj):
-                if obj < 0:
-                    return {"_dbx": DBXCODE_NEG_INFINITY}
-                elif obj > 0:
-                    return {"_dbx": DBXCODE_INFINITY}
+    @contextlib.contextmanager
+    def encoding(self):
+        """Context for encoding one object, possibly in several attempts:
+        an array is written to the array file once and its reference reused."""
+        if getattr(self._local, "arrays", None) is not None:
+            yield
+            return
+        self._local.arrays = {}
+        try:
+            yield
+        finally:
+            self._local.arrays = None
+
+    def iterencode(self, o, _one_shot=False):
+        # json never calls default() for floats. With allow_nan=False the
+        # (C) encoder raises on the first NaN or infinity instead, which
+        # costs nothing when there are none; only then the data is walked
+        # to replace them and encoded again
+        with self.encoding():
+            try:
+                return list(super().iterencode(o, _one_shot))
+            except ValueError as e:
+                if not str(e).startswith("Out of range float values"):
+                    raise
+            return list(super().iterencode(replace_nonfinite(o), _one_shot))
+
+    def default(self, obj):
 
         # handle dates: make all UTC timestamped with timestamp info removed but encoded with a Z at the end
         if isinstance(obj, datetime.datetime):
             return encode_datetime(obj)
 
-        # many custom loggable objects have a __dbx_encode__ method
+        if self.deferred is not None and hasattr(obj, "__dbx_encode_nowait__"):
+            encoded, future = obj.__dbx_encode_nowait__()
+            if future is not None:
+                self.deferred[id(obj)] = (obj, future)
+            return encoded
+
+        # many custom loggable objects have a __dbx_encode__ method; what
+        # default() returns is encoded as is, so NaN must be replaced here
         if hasattr(obj, "__dbx_encode__"):
-            return obj.__dbx_encode__()
+            return replace_nonfinite(obj.__dbx_encode__())
+
+        array = _as_ndarray(obj)
+        if array is not None:
+            return self._encode_array(obj, array)
 
         return super().default(obj)
+
+    def _encode_array(self, obj, array):
+        if array.ndim == 0:
+            v = array.item()
+            if isinstance(v, float) and not math.isfinite(v):
+                return _nonfinite_code(v)
+            return v
+        if (self.arrays is None or array.size <= self.inline_size
+                or array.dtype.hasobject or array.dtype.fields is not None):
+            values = array.tolist()
+            if array.dtype.hasobject:
+                values = replace_nonfinite(values)
+            elif array.dtype.kind == "f":
+                import numpy as np
+                if not np.isfinite(array).all():
+                    values = replace_nonfinite(values)
+            return values
+        written = getattr(self._local, "arrays", None)
+        if written is None:
+            return self.arrays.write(array)
+        # obj (not array, which may be a new view) is alive for the whole
+        # encoding, so its id can't be reused
+        ref = written.get(id(obj))
+        if ref is None:
+            ref = written[id(obj)] = self.arrays.write(array)
+        return ref
+
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# event names repeat a lot, but with contexts like epoch/N/batch/M they can
+# also be unique so the prefix cache is bounded
+_PREFIX_CACHE_SIZE = 4096
+
+class EventEncoder:
+    """Encodes (event_name, data) into one JSON line in a single pass.
+
+    The output is the same as encoding {"event": event_name, **data} with the
+    "event" key first and the other keys sorted (if sort_keys is True).
+
+    backend: "json" (default) uses the standard library encoder, "orjson" uses
+    orjson (must be installed) and "auto" uses orjson if installed. orjson
+    writes compact separators (no spaces), so the lines are valid JSON but not
+    byte for byte identical to the "json" backend. Events orjson cannot
+    represent exactly (e.g. NaN) are re-encoded with the standard encoder.
+
+    arrays: an ArrayFile for large arrays, passed on to cls.
+    defer_hashes: don't wait for the hashes of reffiles, see resolved().
+    """
+
+    def __init__(self, sort_keys=True, backend="json", cls=DBXEncoder, arrays=None, defer_hashes=False):
+        if backend == "auto":
+            backend = "orjson" if orjson is not None else "json"
+        if backend == "orjson" and orjson is None:
+            raise Exception("orjson backend requested but orjson is not installed")
+        if backend not in ("json", "orjson"):
+            raise Exception("unknown json backend %s" % backend)
+
+        self.sort_keys = sort_keys
+        self.backend = backend
+        self._prefixes = {}
+
+        if backend == "json":
+            self._separators = (", ", ": ")
+        else:
+            self._separators = (",", ":")
+            self._orjson_opts = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS
+            if sort_keys:
+                self._orjson_opts |= orjson.OPT_SORT_KEYS
+
+        # one encoder reused for all events: json.dumps(cls=...) builds a new
+        # encoder object on every call
+        kwargs = {}
+        if arrays is not None:
+            kwargs["arrays"] = arrays
+        self.deferred = None
+        if defer_hashes:
+            self.deferred = kwargs["deferred"] = {}
+        self._json = cls(sort_keys=sort_keys, separators=self._separators, **kwargs)
+
+    def _prefix(self, event_name):
+        prefix = self._prefixes.get(event_name)
+        if prefix is None:
+            if len(self._prefixes) >= _PREFIX_CACHE_SIZE:
+                self._prefixes.clear()
+            prefix = '{"event"' + self._separators[1] + json.dumps(event_name) + self._separators[0]
+            self._prefixes[event_name] = prefix
+        return prefix
+
+    def _encode_data(self, data):
+        if self.backend == "orjson":
+            try:
+                encoded = orjson.dumps(data, default=self._json.default, option=self._orjson_opts)
+                # orjson writes NaN and Infinity as null; only when null shows
+                # up at all we need the (slower) exact encoder
+                if b"null" not in encoded:
+                    return encoded.decode()
+                replaced = replace_nonfinite(data)
+                if replaced is not data:
+                    encoded = orjson.dumps(replaced, default=self._json.default, option=self._orjson_opts)
+                    if b"null" not in encoded:
+                        return encoded.decode()
+            except (TypeError, orjson.JSONEncodeError):
+                pass
+        return self._json.encode(data)
+
+    def resolved(self, wait=False):
+        """Return the (event_name, data) follow-up events for the reffiles
+        encoded without a hash whose hash is now known (with wait=True, for
+        all of them). Each is returned once."""
+        if not self.deferred:
+            return []
+        events = []
+        for key, (obj, future) in list(self.deferred.items()):
+            if not wait and not future.done():
+                continue
+            if self.deferred.pop(key, None) is None:
+                # taken by another thread
+                continue
+            try:
+                future.result()
+                events.append((REFFILE_HASH_EVENT, {"reffile": obj.__dbx_encode__()}))
+            except Exception as e:
+                encoded, _ = obj.__dbx_encode_nowait__()
+                events.append((REFFILE_HASH_EVENT, {"reffile": encoded, "error": repr(e)}))
+        return events
+
+    def encode(self, event_name, data):
+        """Return the JSON line (without newline) for this event. data is not
+        modified; an "event" key in data is ignored."""
+        if "event" in data:
+            data = {k: v for k, v in data.items() if k != "event"}
+
+        prefix = self._prefix(event_name)
+        with self._json.encoding():
+            encoded = self._encode_data(data)
+        if encoded == "{}":
+            return prefix[:-len(self._separators[0])] + "}"
+        return prefix + encoded[1:]
@@ -3,6 +3,7 @@ import socket
 import json
 import os
 import sys
+import threading
 
 import nanoid
 
@@ -18,6 +19,7 @@ RESERVED_KEYS = set([
     "name",
     "git",
     "env",
+    "partialMeta",
     "_dbx",
 ])
 
@@ -34,7 +36,8 @@ class CustomMetaKeyNotSupportedError(Exception):
 def params_from_args(args):
     return {k: v for k,v in vars(args).items()}
 
-def exp_from_args(args, kind=None, args_to_ignore=None, params=None, extra_meta=None, env=True, git=True):
+def exp_from_args(args, kind=None, args_to_ignore=None, params=None, extra_meta=None, env=True, git=True,
+        prefetch=False, meta_timeout=None):
     """Shortcut to use savedir and name from command line args.
 
     Params
@@ -43,6 +46,7 @@ def exp_from_args(args, kind=None, args_to_ignore=None, params=None, extra_meta=
         args_to_ignore: array of arg names not to add as experiment params,
         params: params to add to the args (overrides ones parsed from args if already exist)
         extra_meta: extra metadata for the experiment
+        prefetch, meta_timeout: see Exp
     """
 
     repo = get_repo(args)
@@ -72,12 +76,24 @@ def exp_from_args(args, kind=None, args_to_ignore=None, params=None, extra_meta=
         name=name,
         extra_meta=extra_meta,
         env=env,
-        git=git)
+        git=git,
+        prefetch=prefetch,
+        meta_timeout=meta_timeout)
 
 
 class Exp:
+    """An experiment to be saved in repo.
+
+    Collecting the hostname, environment and git info for meta.json can take a
+    while (e.g. git in a large worktree). With prefetch=True (or by calling
+    prefetch()) they are collected on a background thread, so save() only
+    waits for what's still running. With meta_timeout save() waits at most
+    that many seconds and saves what's there; the missing keys are listed in
+    meta["partialMeta"].
+    """
 
-    def __init__(self, repo, kind, params=None, name=None, extra_meta=None, env=True, git=True):
+    def __init__(self, repo, kind, params=None, name=None, extra_meta=None, env=True, git=True,
+            prefetch=False, meta_timeout=None):
         self._id = _generate_random_id()
         self._repo = repo
         self._kind = kind
@@ -94,6 +110,7 @@ class Exp:
 
         # empty loggers dict
         self._loggers = {}
+        self._checkpoints = None
 
         # execution environment
         self._cmd = None
@@ -107,6 +124,13 @@ class Exp:
         self._files = {}
         self._saved = False # whether this experiment was saved in the repo
 
+        self.meta_timeout = meta_timeout
+        self._prefetch_thread = None
+        self._prefetched = {}
+
+        if prefetch:
+            self.prefetch()
+
     @property
     def id(self):
         return self._id
@@ -180,6 +204,24 @@ class Exp:
         return locals()
     created_at = property(**created_at())
 
+    def prefetch(self):
+        """Start collecting hostname, environment and git info on a background
+        thread. Does nothing if already started or the meta is computed."""
+        if self._prefetch_thread is not None or self._meta is not None:
+            return
+        self._prefetch_thread = threading.Thread(target=self._prefetch,
+            name="dbxlogger-exp-meta", daemon=True)
+        self._prefetch_thread.start()
+
+    def _prefetch(self):
+        # each value is stored as soon as it's ready, so a save() that times
+        # out still gets the ones that finished
+        self._prefetched["hostname"] = socket.gethostname()
+        if self._save_env:
+            self._prefetched["env"] = _get_env()
+        if self._save_git:
+            self._prefetched["git"] = _get_git()
+
     @property
     def kind(self):
         return self._kind
@@ -212,7 +254,43 @@ class Exp:
         """Set experiment param shortcut."""
         self._params[k] = v
 
+    def _collect_meta(self):
+        """Return ({hostname, env, git}, missing) with the values collected by
+        prefetch() or computed now. missing lists the values prefetch() didn't
+        finish within meta_timeout."""
+        wanted = ["hostname"]
+        if self._save_env:
+            wanted.append("env")
+        if self._save_git:
+            wanted.append("git")
+
+        values = {}
+        timed_out = False
+        if self._prefetch_thread is not None:
+            self._prefetch_thread.join(self.meta_timeout)
+            timed_out = self._prefetch_thread.is_alive()
+            values.update(self._prefetched)
+        if self._hostname is not None:
+            values["hostname"] = self._hostname
+
+        missing = [k for k in wanted if k not in values]
+        if timed_out:
+            return values, missing
+
+        # not prefetched, or the thread failed
+        compute = {"hostname": lambda: self.hostname, "env": _get_env, "git": _get_git}
+        for k in missing:
+            values[k] = compute[k]()
+        return values, []
+
     def _compute_meta(self):
+        values, missing = self._collect_meta()
+        if self._hostname is None:
+            self._hostname = values.get("hostname")
+        if missing:
+            print("WARN: timed out collecting %s, saving partial meta" % ", ".join(missing),
+                file=sys.stderr)
+
         meta = {
             "id": self._id,
             "createdAt": self.created_at,
@@ -221,17 +299,20 @@ class Exp:
             "name": self.name,
             "cmd": self.cmd,
             "pwd": self.pwd,
-            "hostname": self.hostname,
+            "hostname": values.get("hostname"),
             "script": self.script,
         }
 
         meta = self._add_extra_meta(meta)
 
-        if self._save_env:
-            meta["env"] = _get_env()
+        if missing:
+            meta["partialMeta"] = missing
 
-        if self._save_git:
-            git_info = _get_git()
+        if "env" in values:
+            meta["env"] = values["env"]
+
+        if "git" in values:
+            git_info = values["git"]
             if not git_info:
                 # print something out on stderr instead of failing the run
                 print("WARN: no git repo found, omitting meta['git']", file=sys.stderr)
@@ -266,7 +347,10 @@ class Exp:
 
         self._saved = True
 
-    def logger(self, name=None):
+    def logger(self, name=None, **writer_kwargs):
+        """Get the logger with the given name (default log.jsonl). The logger
+        is created the first time it is requested; writer_kwargs (e.g.
+        buffered=True) can only be given then."""
         if not self._saved:
             raise Exception("cannot get logger for unsaved experiment")
 
@@ -279,9 +363,12 @@ class Exp:
                 raise Exception("invalid log name %s: log name cannot contain slashes", name)
 
         if name not in self._loggers:
-            logger = self._repo.logger(self, name)
+            logger = self._repo.logger(self, name, **writer_kwargs)
             self._loggers[name] = logger
             return logger
+        if writer_kwargs:
+            raise Exception("logger %s already exists, writer arguments can only be given "
+                "the first time it is requested" % name)
 
         return self._loggers[name].root()
 
@@ -292,7 +379,7 @@ class Exp:
 
         return self._repo.expfile(self, name, mode=mode)
 
-    def filepath(self, name : str):
+    def filepath(self, name : str, src=None):
         """Create an exp file by name. For local repos it simply gives you the
         correct path to save an exp file at. For remote repos if there's no
         local repo used as well, it creates a temp file and returns it.
@@ -309,15 +396,53 @@ class Exp:
             with exp.filepath("checkpoint3.tar.pth") as path:
                 model.save(path)
 
+        src: a file that already exists (e.g. written on another disk) to
+            move into the experiment as name, instead of a new path. See
+            dbxlogger.repo.LocalExpFilePath.
         """
-        raise NotImplementedError()
+        if not self._saved:
+            raise Exception("cannot create a file in unsaved experiment")
+
+        return self._repo.expfile_path(self, name, src=src)
+
+    def checkpoints(self, **kwargs):
+        """Get the CheckpointManager of this experiment (see
+        dbxlogger.checkpoint). It is created the first time it is requested;
+        kwargs (keep_last, keep_best, metric, ...) can only be given then."""
+        if not self._saved:
+            raise Exception("cannot save checkpoints for unsaved experiment")
+        if self._checkpoints is None:
+            from .checkpoint import CheckpointManager
+            self._checkpoints = CheckpointManager(self, **kwargs)
+        elif kwargs:
+            raise Exception("checkpoint manager already exists, its arguments can only be "
+                "given the first time it is requested")
+        return self._checkpoints
 
     def _add_file(self, name, hash):
         """This method is called after a new file has been added to the
         experiment."""
 
         self._files[name] = hash
-        self._repo.save_fileindex(self)
+        self._repo.add_to_fileindex(self, name, hash)
+
+    def _remove_file(self, name):
+        self._files.pop(name, None)
+        self._repo.remove_file(self, name)
+
+    def _fsync_file(self, name):
+        """Make the expfile name and its file index entry durable (the file
+        content must already be fsynced)."""
+        self._repo.fsync_file(self, name)
+
+    def close(self):
+        """Wait for pending checkpoints and compact the file index of this
+        experiment into files.json. Call it when done adding files (it's
+        also fine to add more afterwards)."""
+        if self._checkpoints is not None:
+            self._checkpoints.close()
+        if self._saved:
+            self._repo.compact_fileindex(self)
 
     def print_info(self):
         print("Exp(%s) -> %s" % (self.id, self.repo))
@@ -0,0 +1,137 @@
+"""
+The file index of an experiment: which expfiles it has and their sha256.
+
+The index is a snapshot, files.json ({name: sha256}), plus a journal,
+files.json.journal, with one JSON line per file added since the snapshot:
+
+    {"name": "checkpoint-3.pth", "sha256": "9f86d0..."}
+
+A null sha256 removes the file from the index.
+
+Adding a file appends one line, so it costs the same for the first and the
+thousandth file, and a crash can at worst leave a torn last line, which is
+ignored. compact() folds the journal into a new snapshot (written to a temp
+file and renamed over files.json) and empties the journal. It runs when the
+experiment is closed and when the index is read with compact=True.
+
+Appends and compaction lock the journal (flock, where available), so a
+reader compacting the index of a running experiment doesn't lose entries,
+and read() takes a shared lock so it doesn't see a new snapshot together
+with the journal that was just folded into it.
+"""
+
+import json
+import os
+
+FILEINDEX_FILENAME = "files.json"
+JOURNAL_FILENAME = "files.json.journal"
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+def _lock(fd, shared=False):
+    if fcntl is not None:
+        fcntl.flock(fd, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+
+
+def append(exp_path, name, sha256):
+    """Add (or replace) the file name in the index of the experiment at
+    exp_path. sha256 None removes it."""
+    line = (json.dumps({"name": name, "sha256": sha256}, sort_keys=True) + "\n").encode()
+    fd = os.open(os.path.join(exp_path, JOURNAL_FILENAME), os.O_RDWR | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        _lock(fd)
+        size = os.fstat(fd).st_size
+        if size and hasattr(os, "pread") and os.pread(fd, 1, size - 1) != b"\n":
+            # the last append was torn, don't glue this entry to it
+            line = b"\n" + line
+        os.write(fd, line)
+    finally:
+        os.close(fd)
+
+
+def fsync(exp_path):
+    """fsync the journal, so the entries appended so far survive a crash
+    (the directory entry of a new journal is not synced)."""
+    try:
+        fd = os.open(os.path.join(exp_path, JOURNAL_FILENAME), os.O_RDONLY)
+    except FileNotFoundError:
+        return
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _read_snapshot(exp_path):
+    try:
+        with open(os.path.join(exp_path, FILEINDEX_FILENAME)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def _replay(index, data):
+    """Apply the complete journal lines in data to index."""
+    for line in data.split(b"\n")[:-1]:
+        try:
+            entry = json.loads(line)
+        except ValueError:
+            # torn write
+            continue
+        if entry["sha256"] is None:
+            index.pop(entry["name"], None)
+        else:
+            index[entry["name"]] = entry["sha256"]
+    return index
+
+
+def read(exp_path, compact=False):
+    """Return the file index {name: sha256} of the experiment at exp_path.
+    With compact=True the journal is compacted into files.json first."""
+    if compact:
+        return compact_index(exp_path)
+    try:
+        f = open(os.path.join(exp_path, JOURNAL_FILENAME), "rb")
+    except FileNotFoundError:
+        return _read_snapshot(exp_path)
+    with f:
+        _lock(f.fileno(), shared=True)
+        index = _read_snapshot(exp_path)
+        data = f.read()
+    return _replay(index, data)
+
+
+def write(exp_path, index):
+    """Write index as the snapshot (atomically)."""
+    path = os.path.join(exp_path, FILEINDEX_FILENAME)
+    tmp = "%s.%d.tmp" % (path, os.getpid())
+    with open(tmp, "w") as f:
+        json.dump(index, f, indent=4, sort_keys=True)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+def compact_index(exp_path):
+    """Fold the journal of the experiment at exp_path into files.json and
+    return the index."""
+    journal = os.path.join(exp_path, JOURNAL_FILENAME)
+    try:
+        fd = os.open(journal, os.O_RDWR)
+    except FileNotFoundError:
+        return _read_snapshot(exp_path)
+    try:
+        _lock(fd)
+        with os.fdopen(os.dup(fd), "rb") as f:
+            data = f.read()
+        index = _replay(_read_snapshot(exp_path), data)
+        if data:
+            write(exp_path, index)
+            os.ftruncate(fd, 0)
+        return index
+    finally:
+        os.close(fd)
@@ -0,0 +1,197 @@
+"""
+sha256 of referenced files (:py:class:`dbxlogger.repo.RefFile`), cached per
+host so the same dataset file is hashed once, not once per event or process.
+
+The cache is a SQLite file keyed by (path, device, inode, size, mtime_ns): a
+file that changed in any of those is hashed again. It's kept in
+`~/.cache/dbxlogger/hashes-<hostname>.sqlite` (one per host, home
+directories are often shared), or at the path in the DBX_HASH_CACHE
+environment variable ("" to only cache in memory).
+
+    from dbxlogger import hashcache
+
+    digest = hashcache.sha256("data/train.bin")          # waits
+    future = hashcache.submit("data/train.bin")          # hashes on a thread pool
+"""
+
+import concurrent.futures
+import hashlib
+import os
+import socket
+import sqlite3
+import threading
+
+HASH_CACHE_ENV = "DBX_HASH_CACHE"
+
+# threads hashing files, hashlib releases the GIL for large updates
+HASH_WORKERS = 4
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS hashes (
+    path TEXT PRIMARY KEY,
+    dev INTEGER,
+    ino INTEGER,
+    size INTEGER,
+    mtime_ns INTEGER,
+    sha256 TEXT
+);
+"""
+
+_hostname = None
+
+
+def hostname():
+    """socket.gethostname(), resolved once per process."""
+    global _hostname
+    if _hostname is None:
+        _hostname = socket.gethostname()
+    return _hostname
+
+
+def default_path():
+    path = os.environ.get(HASH_CACHE_ENV)
+    if path is not None:
+        return path or None
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(cache_home, "dbxlogger", "hashes-%s.sqlite" % hostname())
+
+
+def _hash_file(path):
+    h = hashlib.sha256()
+    b = bytearray(1024*1024)
+    mv = memoryview(b)
+    with open(path, "rb", buffering=0) as f:
+        for n in iter(lambda: f.readinto(mv), 0):
+            h.update(mv[:n])
+    return h.hexdigest()
+
+
+class HashCache:
+    """Persistent cache of file hashes.
+
+    path: the SQLite file, None to only cache in memory
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self._memory = {}
+        self._lock = threading.Lock()
+        self._db = None
+        self._pid = None
+        self._executor = None
+        self._executor_pid = None
+
+    def _connect(self):
+        # connections can't be used across fork()
+        if self.path is None:
+            return None
+        if self._db is None or self._pid != os.getpid():
+            try:
+                os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+                self._db = sqlite3.connect(self.path, timeout=10, check_same_thread=False)
+                # not WAL: its shared memory index doesn't work on network
+                # filesystems, where home directories often are
+                self._db.execute("PRAGMA journal_mode=DELETE")
+                self._db.executescript(_SCHEMA)
+            except (OSError, sqlite3.Error):
+                # read-only home or similar, keep going with the memory cache
+                self.path = None
+                self._db = None
+                return None
+            self._pid = os.getpid()
+        return self._db
+
+    def get(self, path, st=None):
+        """Return the cached sha256 of path or None. st: os.stat(path) if
+        already known."""
+        path = os.path.abspath(path)
+        if st is None:
+            st = os.stat(path)
+        key = (path, st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+        with self._lock:
+            digest = self._memory.get(key)
+            if digest is not None:
+                return digest
+            db = self._connect()
+            if db is None:
+                return None
+            try:
+                row = db.execute("SELECT sha256 FROM hashes WHERE path = ? AND dev = ? AND ino = ? "
+                    "AND size = ? AND mtime_ns = ?", key).fetchone()
+            except sqlite3.Error:
+                return None
+            if row is not None:
+                self._memory[key] = row[0]
+                return row[0]
+        return None
+
+    def put(self, path, st, digest):
+        path = os.path.abspath(path)
+        key = (path, st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+        with self._lock:
+            self._memory[key] = digest
+            db = self._connect()
+            if db is None:
+                return
+            try:
+                with db:
+                    db.execute("INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?, ?)", key + (digest,))
+            except sqlite3.Error:
+                pass
+
+    def sha256(self, path):
+        """Return the sha256 of path, hashing it if not cached."""
+        st = os.stat(path)
+        digest = self.get(path, st)
+        if digest is None:
+            digest = _hash_file(path)
+            # a file changed while hashing is not cached
+            after = os.stat(path)
+            if (after.st_size, after.st_mtime_ns) == (st.st_size, st.st_mtime_ns):
+                self.put(path, st, digest)
+        return digest
+
+    def submit(self, path):
+        """Return a concurrent.futures.Future of the sha256 of path. Cache
+        hits are resolved right away, misses are hashed on a thread pool."""
+        try:
+            digest = self.get(path)
+        except OSError as e:
+            f = concurrent.futures.Future()
+            f.set_exception(e)
+            return f
+        if digest is not None:
+            f = concurrent.futures.Future()
+            f.set_result(digest)
+            return f
+        with self._lock:
+            if self._executor is None or self._executor_pid != os.getpid():
+                self._executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=HASH_WORKERS, thread_name_prefix="dbxlogger-hash")
+                self._executor_pid = os.getpid()
+            executor = self._executor
+        return executor.submit(self.sha256, path)
+
+
+_default = None
+_default_lock = threading.Lock()
+
+
+def default_cache():
+    """The HashCache of this process, at default_path()."""
+    global _default
+    with _default_lock:
+        if _default is None:
+            _default = HashCache(default_path())
+        return _default
+
+
+def sha256(path):
+    """sha256 of path using the default cache, see HashCache.sha256."""
+    return default_cache().sha256(path)
+
+
+def submit(path):
+    """Future of the sha256 of path using the default cache, see
+    HashCache.submit."""
+    return default_cache().submit(path)
@@ -0,0 +1,251 @@
+"""
+Sidecar index for logs: `log.jsonl.idx` next to `log.jsonl`.
+
+The index is an append-only JSON lines file. The first line is a header and
+every other line describes a run of consecutive log lines with the same key:
+
+    {"dbxindex": 1, "level": null}
+    ["epoch/0/batch/0/stats", 0, 4312, 50]      # key, offset, bytes, lines
+    ["epoch/0/eval", 4312, 61, 1]
+
+The key is the event name, or with `level` set, its first `level` path
+components ("epoch" for level 1). Logs with counters in event names
+(epoch/N/batch/M) should use a level, otherwise almost every line is a
+run. Runs are contiguous from offset 0, so the index always describes a
+prefix of the log; readers scan whatever comes after the last run. A run
+that goes past the end of the log (truncated log) ends the usable part of
+the index.
+
+If the index goes missing or doesn't match the log, :py:func:`build_index`
+rebuilds it from the log. Writers rebuild it automatically when they open
+a log with an out of date index.
+"""
+
+import fnmatch
+import json
+import os
+
+INDEX_SUFFIX = ".idx"
+INDEX_VERSION = 1
+
+# completed runs kept in memory before they are written out in unbuffered mode
+_MAX_PENDING_RUNS = 256
+
+
+def index_path(log_path):
+    return log_path + INDEX_SUFFIX
+
+
+def index_key(event_name, level=None):
+    """The index key for event_name: the name itself or its first level
+    path components."""
+    if level is None:
+        return event_name
+    return "/".join(event_name.split("/", level)[:level])
+
+
+def _header(level):
+    return json.dumps({"dbxindex": INDEX_VERSION, "level": level}) + "\n"
+
+
+def read_index(log_path):
+    """Return (level, runs) for the index of log_path, or None if there is
+    no index. runs is a generator of (key, offset, bytes, lines) tuples that
+    stops at the end of the usable part of the index: a partial line, a gap
+    between runs or a run past the end of the log."""
+    path = index_path(log_path)
+    try:
+        with open(path, "rb") as f:
+            header = json.loads(f.readline())
+            start = f.tell()
+    except (FileNotFoundError, ValueError):
+        return None
+    if not isinstance(header, dict) or header.get("dbxindex") != INDEX_VERSION:
+        return None
+
+    def runs():
+        log_size = os.path.getsize(log_path)
+        end = 0
+        with open(path, "rb") as f:
+            f.seek(start)
+            for line in f:
+                if not line.endswith(b"\n"):
+                    return
+                try:
+                    key, offset, nbytes, lines = json.loads(line)
+                except ValueError:
+                    return
+                if offset != end or offset + nbytes > log_size:
+                    return
+                end = offset + nbytes
+                yield key, offset, nbytes, lines
+
+    return header.get("level"), runs()
+
+
+def index_end(log_path, level=None):
+    """Return the log offset covered by the index of log_path, or None if
+    there is no index, it was built with a different level or some of its
+    runs are not usable (e.g. the log was truncated or overwritten)."""
+    idx = read_index(log_path)
+    if idx is None or idx[0] != level:
+        return None
+    end = 0
+    count = 0
+    for key, offset, nbytes, lines in idx[1]:
+        end = offset + nbytes
+        count += 1
+    with open(index_path(log_path), "rb") as f:
+        total = sum(1 for _ in f) - 1
+    if count != total:
+        return None
+    return end
+
+
+def _event_name(line):
+    from .reader import line_event_name
+    name = line_event_name(line)
+    if name is None:
+        name = json.loads(line).get("event") or ""
+    return name
+
+
+def build_index(log_path, level=None):
+    """(Re)build the index of log_path by scanning the log. Only the event
+    names are read, lines are not decoded unless the name is escaped. The
+    new index replaces the old one atomically."""
+    w = IndexWriter(index_path(log_path) + ".tmp", level, new=True)
+    if os.path.exists(log_path):
+        with open(log_path, "rb") as f:
+            for line in f:
+                if not line.endswith(b"\n"):
+                    # partial last line, not part of the log yet
+                    break
+                w.add(_event_name(line), len(line))
+    w.close()
+    os.replace(w.path, index_path(log_path))
+
+
+def open_index(log_path, level=None):
+    """Return an IndexWriter that appends to the index of log_path. The
+    index is rebuilt first if it is missing or doesn't cover the whole log.
+    Call this after opening the log for writing."""
+    size = os.path.getsize(log_path) if os.path.exists(log_path) else 0
+    if index_end(log_path, level) != size:
+        build_index(log_path, level)
+    return IndexWriter(index_path(log_path), level, offset=size)
+
+
+class IndexWriter:
+    """Keeps an index up to date while the log is written.
+
+    Call add() for every line appended to the log and flush() after the log
+    file itself was flushed, so the index never points at unwritten data.
+    Use open_index() to get one for an existing log.
+
+    path: the index file
+    level: see index_key
+    offset: log size when the index writer is created
+    new: create a new index file (with header) instead of appending
+    """
+
+    def __init__(self, path, level=None, offset=0, new=False):
+        self.path = path
+        self.level = level
+        self._offset = offset
+        if new:
+            self.f = open(path, "w", encoding="utf-8")
+            self.f.write(_header(level))
+        else:
+            self.f = open(path, "a", encoding="utf-8")
+
+        self._key = None
+        self._start = 0
+        self._bytes = 0
+        self._lines = 0
+        self._pending = []
+
+    def add(self, event_name, nbytes):
+        key = index_key(event_name, self.level)
+        if key != self._key:
+            self._end_run()
+            self._key = key
+            self._start = self._offset
+        self._bytes += nbytes
+        self._lines += 1
+        self._offset += nbytes
+
+    def _end_run(self):
+        if self._lines:
+            self._pending.append(json.dumps([self._key, self._start, self._bytes, self._lines]) + "\n")
+        self._key = None
+        self._bytes = 0
+        self._lines = 0
+
+    def maybe_flush(self):
+        """Write completed runs if many are pending. Only use this when all
+        lines passed to add() are already written to the log."""
+        if len(self._pending) >= _MAX_PENDING_RUNS:
+            self.f.write("".join(self._pending))
+            self._pending.clear()
+            self.f.flush()
+
+    def flush(self):
+        """Write all runs, including the current one which is continued in
+        a new run by the next add()."""
+        self._end_run()
+        if self._pending:
+            self.f.write("".join(self._pending))
+            self._pending.clear()
+        self.f.flush()
+
+    def close(self):
+        self.flush()
+        self.f.close()
+
+
+def key_filter(events, level=None):
+    """Return a function that tells, for an index key, whether the run can
+    contain events selected by `events` (see reader.event_filter). It is
+    conservative: True means "maybe"."""
+    if events is None:
+        return lambda key: True
+
+    if callable(events):
+        if level is None:
+            return events
+        # can't reason about prefixes of a function
+        return lambda key: True
+
+    if isinstance(events, str):
+        events = [events]
+
+    if level is None:
+        names = set()
+        patterns = []
+        for e in events:
+            if any(c in e for c in "*?["):
+                patterns.append(e)
+            else:
+                names.add(e)
+        return lambda key: key in names or any(fnmatch.fnmatchcase(key, p) for p in patterns)
+
+    # with prefix keys compare path components up to the first one with a
+    # glob character (a * can match several components)
+    prefixes = []
+    for e in events:
+        prefix = []
+        for part in e.split("/")[:level]:
+            if any(c in part for c in "*?["):
+                break
+            prefix.append(part)
+        prefixes.append(prefix)
+
+    def could_match(key):
+        parts = key.split("/")
+        for prefix in prefixes:
+            n = min(len(prefix), len(parts))
+            if prefix[:n] == parts[:n]:
+                return True
+        return False
+    return could_match
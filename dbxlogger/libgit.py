@@ -1,14 +1,670 @@
-"""Simple utility to check git exit codes, etc.
+"""Read git metadata (branch, commit, uncommitted changes) for experiment meta.
 
-Has many limitations but it is good enough for now.
+Everything is read directly from the .git directory, without running git:
+HEAD, loose and packed refs, commit objects (loose or in pack files) and the
+index. Uncommitted changes are found like `git diff` does: files whose stat
+data (mtime, size, mode) matches the index are skipped, only the others are
+hashed. Results are cached per process and working directory, call
+clear_cache() after changing the repo.
+
+If the repo uses something this reader doesn't understand (e.g. SHA-256
+object names or an old index format) it falls back to running git. So does
+the changes check when the worktree content can differ from the blobs for
+unchanged files (clean/smudge filters, text/eol attributes, core.autocrlf),
+when the index is split or sparse and when there are submodules.
 """
 
+import binascii
+import collections
+import configparser
+import datetime
+import hashlib
+import mmap
+import os
+import stat
+import struct
 import subprocess
+import threading
+import zlib
+
+
+class GitReadError(Exception):
+    """The repository can't be read without git."""
+
+
+Commit = collections.namedtuple("Commit", ["sha", "tree", "parents", "author", "committer", "message"])
+
+_OBJ_COMMIT = 1
+_OBJ_TREE = 2
+_OBJ_BLOB = 3
+_OBJ_TAG = 4
+_OBJ_OFS_DELTA = 6
+_OBJ_REF_DELTA = 7
+_TYPE_NAMES = {b"commit": _OBJ_COMMIT, b"tree": _OBJ_TREE, b"blob": _OBJ_BLOB, b"tag": _OBJ_TAG}
+
+_S_IFGITLINK = 0o160000
+
+# attributes that make the worktree content of a file differ from its blob
+_CONVERTING_ATTRIBUTES = set(["filter", "text", "eol", "crlf", "ident", "working-tree-encoding"])
+# index extensions that change what the entries mean: split index, sparse
+# index (directories as entries)
+_UNSUPPORTED_INDEX_EXTENSIONS = set([b"link", b"sdir"])
+
+_cache = {}
+_cache_lock = threading.Lock()
+
+
+def find_git_dir(path="."):
+    """Return (git_dir, worktree) for the repository containing path, or
+    None if path is not in a git repository."""
+    env = os.environ.get("GIT_DIR")
+    if env:
+        return os.path.abspath(env), os.path.abspath(os.environ.get("GIT_WORK_TREE", "."))
+
+    path = os.path.abspath(path)
+    while True:
+        dotgit = os.path.join(path, ".git")
+        if os.path.isdir(dotgit):
+            return dotgit, path
+        if os.path.isfile(dotgit):
+            # worktrees and submodules: "gitdir: <path>"
+            with open(dotgit) as f:
+                line = f.readline().strip()
+            if line.startswith("gitdir:"):
+                git_dir = line[len("gitdir:"):].strip()
+                return os.path.normpath(os.path.join(path, git_dir)), path
+        parent = os.path.dirname(path)
+        if parent == path:
+            return None
+        path = parent
+
+
+class GitRepo:
+    """Read-only access to the parts of a git repository needed for
+    experiment meta."""
+
+    def __init__(self, git_dir, worktree=None):
+        self.git_dir = git_dir
+        self.worktree = worktree
+
+        # linked worktrees keep refs and objects in the main repository
+        self.common_dir = git_dir
+        commondir = os.path.join(git_dir, "commondir")
+        if os.path.exists(commondir):
+            with open(commondir) as f:
+                self.common_dir = os.path.normpath(os.path.join(git_dir, f.read().strip()))
+
+        self.config = configparser.ConfigParser(strict=False, interpolation=None)
+        try:
+            self.config.read(os.path.join(self.common_dir, "config"))
+        except configparser.Error:
+            pass
+        object_format = self._config("extensions", "objectformat", "sha1")
+        if object_format != "sha1":
+            raise GitReadError("unsupported object format %s" % object_format)
+
+        self._packs = None
+        self._packed_refs = None
+
+    def _config(self, section, key, default=None):
+        try:
+            return self.config.get(section, key).strip().lower()
+        except (configparser.Error, KeyError):
+            return default
+
+    # refs
+
+    def head(self):
+        """Return (ref, sha) for HEAD. ref is None for a detached HEAD and sha
+        is None on a branch without commits."""
+        with open(os.path.join(self.git_dir, "HEAD")) as f:
+            head = f.read().strip()
+        if head.startswith("ref:"):
+            ref = head[len("ref:"):].strip()
+            return ref, self.resolve(ref)
+        return None, head
+
+    def resolve(self, ref, depth=0):
+        """Return the sha a ref points to, following symbolic refs, or None."""
+        if depth > 10:
+            raise GitReadError("symbolic ref loop at %s" % ref)
+        for base in (self.git_dir, self.common_dir):
+            try:
+                with open(os.path.join(base, ref)) as f:
+                    value = f.read().strip()
+            except (FileNotFoundError, NotADirectoryError, IsADirectoryError):
+                continue
+            if value.startswith("ref:"):
+                return self.resolve(value[len("ref:"):].strip(), depth + 1)
+            return value
+        return self.packed_refs().get(ref)
+
+    def packed_refs(self):
+        if self._packed_refs is None:
+            refs = {}
+            try:
+                with open(os.path.join(self.common_dir, "packed-refs")) as f:
+                    for line in f:
+                        if line.startswith("#") or line.startswith("^"):
+                            continue
+                        parts = line.split()
+                        if len(parts) == 2:
+                            refs[parts[1]] = parts[0]
+            except FileNotFoundError:
+                pass
+            self._packed_refs = refs
+        return self._packed_refs
+
+    # objects
+
+    def read_object(self, sha):
+        """Return (type, data) of an object."""
+        path = os.path.join(self.common_dir, "objects", sha[:2], sha[2:])
+        try:
+            with open(path, "rb") as f:
+                raw = zlib.decompress(f.read())
+        except FileNotFoundError:
+            return self._read_packed(binascii.unhexlify(sha))
+        header, _, data = raw.partition(b"\0")
+        type_name = header.split(b" ")[0]
+        return _TYPE_NAMES[type_name], data
+
+    def _pack_list(self):
+        if self._packs is None:
+            self._packs = []
+            pack_dir = os.path.join(self.common_dir, "objects", "pack")
+            try:
+                names = sorted(os.listdir(pack_dir))
+            except FileNotFoundError:
+                names = []
+            for name in names:
+                if name.endswith(".idx"):
+                    self._packs.append(_Pack(os.path.join(pack_dir, name[:-4])))
+        return self._packs
+
+    def _read_packed(self, binsha):
+        for pack in self._pack_list():
+            offset = pack.find(binsha)
+            if offset is not None:
+                return pack.read(offset, self)
+        raise GitReadError("object %s not found" % binascii.hexlify(binsha).decode())
+
+    def commit(self, sha):
+        """Parse the commit object sha."""
+        obj_type, data = self.read_object(sha)
+        if obj_type != _OBJ_COMMIT:
+            raise GitReadError("%s is not a commit" % sha)
+        headers, _, message = data.partition(b"\n\n")
+        tree = None
+        parents = []
+        author = committer = None
+        for line in headers.split(b"\n"):
+            if line.startswith(b" "):
+                # continuation of a multi-line header (gpgsig)
+                continue
+            key, _, value = line.partition(b" ")
+            if key == b"tree":
+                tree = value.decode()
+            elif key == b"parent":
+                parents.append(value.decode())
+            elif key == b"author":
+                author = value.decode(errors="replace")
+            elif key == b"committer":
+                committer = value.decode(errors="replace")
+        return Commit(sha, tree, parents, author, committer, message.decode(errors="replace"))
+
+    def tree_entries(self, sha, prefix=""):
+        """Yield (path, mode, sha) for all files under the tree sha."""
+        obj_type, data = self.read_object(sha)
+        if obj_type != _OBJ_TREE:
+            raise GitReadError("%s is not a tree" % sha)
+        pos = 0
+        while pos < len(data):
+            space = data.index(b" ", pos)
+            nul = data.index(b"\0", space)
+            mode = int(data[pos:space], 8)
+            name = data[space + 1:nul].decode("utf-8", "surrogateescape")
+            entry_sha = binascii.hexlify(data[nul + 1:nul + 21]).decode()
+            pos = nul + 21
+            path = prefix + name
+            if stat.S_ISDIR(mode):
+                yield from self.tree_entries(entry_sha, path + "/")
+            else:
+                yield path, mode, entry_sha
+
+    # changes
+
+    def read_index(self):
+        return _Index(os.path.join(self.git_dir, "index"))
+
+    def has_changes(self):
+        """Whether tracked files differ from HEAD, staged or not (like
+        `git diff --exit-code` and `git diff --cached --exit-code`). Raises
+        GitReadError if that can't be told without git."""
+        index = self.read_index()
+        self._check_comparable(index)
+        return self._has_unstaged(index) or self._has_staged(index)
+
+    def _check_comparable(self, index):
+        """Raise GitReadError if comparing stat data and raw file hashes with
+        the index isn't what git would do."""
+        unsupported = index.extensions & _UNSUPPORTED_INDEX_EXTENSIONS
+        if unsupported:
+            raise GitReadError("unsupported index extension %s" % b", ".join(sorted(unsupported)).decode())
+        autocrlf = self._config("core", "autocrlf", "false")
+        if autocrlf not in ("false", "no", "off", "0", ""):
+            raise GitReadError("core.autocrlf is set")
+        attribute_files = [os.path.join(self.common_dir, "info", "attributes")]
+        attributes_file = self._config("core", "attributesfile")
+        if attributes_file:
+            attribute_files.append(os.path.expanduser(attributes_file))
+        config_home = os.environ.get("XDG_CONFIG_HOME") or os.path.join(os.path.expanduser("~"), ".config")
+        attribute_files.append(os.path.join(config_home, "git", "attributes"))
+        for e in index.entries:
+            if e.mode == _S_IFGITLINK:
+                raise GitReadError("submodules are not supported")
+            if os.path.basename(e.path) == ".gitattributes":
+                attribute_files.append(os.path.join(self.worktree, e.path))
+        for path in attribute_files:
+            if _has_converting_attributes(path):
+                raise GitReadError("%s sets filter, text or eol attributes" % path)
+
+    def _has_unstaged(self, index):
+        check_mode = self._config("core", "filemode", "true") != "false"
+        for e in index.entries:
+            if e.stage != 0:
+                # unresolved merge conflict
+                return True
+            if e.skip_worktree or e.assume_valid or e.mode == _S_IFGITLINK:
+                continue
+            path = os.path.join(self.worktree, e.path)
+            try:
+                st = os.lstat(path)
+            except (FileNotFoundError, NotADirectoryError):
+                return True
+
+            if stat.S_ISLNK(e.mode) != stat.S_ISLNK(st.st_mode):
+                return True
+            if check_mode and not stat.S_ISLNK(e.mode):
+                if bool(e.mode & 0o100) != bool(st.st_mode & 0o100):
+                    return True
+
+            mtime_s, mtime_ns = divmod(st.st_mtime_ns, 10**9)
+            same_stat = (e.size == st.st_size & 0xffffffff
+                and e.mtime_s == mtime_s & 0xffffffff
+                and (e.mtime_ns == 0 or e.mtime_ns == mtime_ns))
+            # a file changed in the same second the index was written can
+            # still have the same stat data ("racily clean"), hash those
+            racy = (mtime_s, mtime_ns) >= index.mtime
+            if same_stat and not racy:
+                continue
+            if e.size != st.st_size & 0xffffffff and not stat.S_ISLNK(st.st_mode):
+                return True
+            if _hash_worktree_file(path, st) != e.sha:
+                return True
+        return False
+
+    def _has_staged(self, index):
+        ref, head = self.head()
+        head_tree = self.commit(head).tree if head else None
+        if head_tree is not None and index.root_tree == head_tree:
+            # cache-tree extension is valid and matches HEAD
+            return False
+
+        staged = {e.path: (e.mode, e.sha) for e in index.entries if e.stage == 0}
+        if head_tree is None:
+            return bool(staged)
+        count = 0
+        for path, mode, sha in self.tree_entries(head_tree):
+            if staged.get(path) != (mode, sha):
+                return True
+            count += 1
+        return count != len(staged)
+
+
+def _has_converting_attributes(path):
+    """Whether the gitattributes file at path sets any of the attributes
+    that convert file content (filter, text, eol, ...)."""
+    try:
+        with open(path, "rb") as f:
+            lines = f.read().decode("utf-8", "replace").splitlines()
+    except (FileNotFoundError, NotADirectoryError, IsADirectoryError):
+        return False
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        # the first token is the pattern (or [attr]macro)
+        for token in line.split()[1:]:
+            if token.startswith("-") or token.startswith("!"):
+                # unset or unspecified, no conversion
+                continue
+            if token.split("=", 1)[0] in _CONVERTING_ATTRIBUTES:
+                return True
+    return False
+
+
+def _hash_worktree_file(path, st):
+    if stat.S_ISLNK(st.st_mode):
+        data = os.fsencode(os.readlink(path))
+        h = hashlib.sha1(b"blob %d\0" % len(data))
+        h.update(data)
+        return h.hexdigest()
+    h = hashlib.sha1(b"blob %d\0" % st.st_size)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(chunk)
+    return h.hexdigest()
 
-def has_changes():
+
+_IndexEntry = collections.namedtuple("_IndexEntry",
+    ["path", "mode", "sha", "size", "mtime_s", "mtime_ns", "stage", "assume_valid", "skip_worktree"])
+
+_INDEX_ENTRY = struct.Struct(">10I20sH")
+
+
+class _Index:
+    """The parts of .git/index used for the changes check."""
+
+    def __init__(self, path):
+        self.entries = []
+        self.root_tree = None
+        self.extensions = set()
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+                mtime = os.fstat(f.fileno()).st_mtime_ns
+        except FileNotFoundError:
+            self.mtime = (0, 0)
+            return
+        self.mtime = divmod(mtime, 10**9)
+
+        if data[:4] != b"DIRC":
+            raise GitReadError("not a git index")
+        version, count = struct.unpack_from(">II", data, 4)
+        if version not in (2, 3, 4):
+            raise GitReadError("unsupported index version %d" % version)
+
+        pos = 12
+        prev_path = b""
+        for _ in range(count):
+            (ctime_s, ctime_ns, mtime_s, mtime_ns, dev, ino, mode, uid, gid, size,
+                sha, flags) = _INDEX_ENTRY.unpack_from(data, pos)
+            start = pos
+            pos += _INDEX_ENTRY.size
+            extended = 0
+            if flags & 0x4000 and version >= 3:
+                extended = struct.unpack_from(">H", data, pos)[0]
+                pos += 2
+
+            if version == 4:
+                # path is prefix compressed against the previous one
+                strip, n = 0, 0
+                while True:
+                    c = data[pos]
+                    pos += 1
+                    strip = (strip << 7) | (c & 0x7f)
+                    if not c & 0x80:
+                        break
+                    strip += 1
+                nul = data.index(b"\0", pos)
+                path = prev_path[:len(prev_path) - strip] + data[pos:nul]
+                pos = nul + 1
+            else:
+                nul = data.index(b"\0", pos)
+                path = data[pos:nul]
+                # entries are padded with 1-8 NULs to a multiple of 8 bytes
+                pos = start + ((nul - start + 8) // 8) * 8
+            prev_path = path
+
+            self.entries.append(_IndexEntry(
+                path.decode("utf-8", "surrogateescape"), mode,
+                binascii.hexlify(sha).decode(), size, mtime_s, mtime_ns,
+                (flags >> 12) & 3, bool(flags & 0x8000), bool(extended & 0x4000)))
+
+        # extensions, only the cache tree (TREE) is used
+        end = len(data) - 20
+        while pos + 8 <= end:
+            name = data[pos:pos + 4]
+            size = struct.unpack_from(">I", data, pos + 4)[0]
+            self.extensions.add(name)
+            if name == b"TREE":
+                self.root_tree = _cache_tree_root(data[pos + 8:pos + 8 + size])
+            pos += 8 + size
+
+
+def _cache_tree_root(ext):
+    """sha of the root tree in a TREE extension, or None if invalid."""
+    nul = ext.find(b"\0")
+    if nul != 0:
+        return None
+    newline = ext.index(b"\n", nul)
+    entry_count = int(ext[nul + 1:newline].split(b" ")[0])
+    if entry_count < 0:
+        return None
+    return binascii.hexlify(ext[newline + 1:newline + 21]).decode()
+
+
+class _Pack:
+    """A pack file and its (version 2) index."""
+
+    def __init__(self, base):
+        self.base = base
+        with open(base + ".idx", "rb") as f:
+            self.idx = f.read()
+        if self.idx[:4] != b"\xfftOc" or struct.unpack_from(">I", self.idx, 4)[0] != 2:
+            raise GitReadError("unsupported pack index %s.idx" % base)
+        self.fanout = struct.unpack_from(">256I", self.idx, 8)
+        self.count = self.fanout[255]
+        self._shas = 8 + 256 * 4
+        self._offsets = self._shas + self.count * 24
+        self._large = self._offsets + self.count * 4
+        self._pack = None
+
+    def find(self, binsha):
+        lo = self.fanout[binsha[0] - 1] if binsha[0] else 0
+        hi = self.fanout[binsha[0]]
+        while lo < hi:
+            mid = (lo + hi) // 2
+            pos = self._shas + mid * 20
+            cur = self.idx[pos:pos + 20]
+            if cur < binsha:
+                lo = mid + 1
+            elif cur > binsha:
+                hi = mid
+            else:
+                offset = struct.unpack_from(">I", self.idx, self._offsets + mid * 4)[0]
+                if offset & 0x80000000:
+                    offset = struct.unpack_from(">Q", self.idx, self._large + (offset & 0x7fffffff) * 8)[0]
+                return offset
+        return None
+
+    def _data(self):
+        if self._pack is None:
+            with open(self.base + ".pack", "rb") as f:
+                self._pack = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._pack
+
+    def read(self, offset, repo):
+        """Return (type, data) of the object at offset, applying deltas."""
+        pack = self._data()
+        c = pack[offset]
+        obj_type = (c >> 4) & 7
+        size = c & 15
+        shift = 4
+        pos = offset + 1
+        while c & 0x80:
+            c = pack[pos]
+            pos += 1
+            size |= (c & 0x7f) << shift
+            shift += 7
+
+        if obj_type == _OBJ_OFS_DELTA:
+            c = pack[pos]
+            pos += 1
+            rel = c & 0x7f
+            while c & 0x80:
+                c = pack[pos]
+                pos += 1
+                rel = ((rel + 1) << 7) | (c & 0x7f)
+            base_type, base = self.read(offset - rel, repo)
+            return base_type, _apply_delta(base, _inflate(pack, pos, size))
+        if obj_type == _OBJ_REF_DELTA:
+            base_sha = binascii.hexlify(pack[pos:pos + 20]).decode()
+            base_type, base = repo.read_object(base_sha)
+            return base_type, _apply_delta(base, _inflate(pack, pos + 20, size))
+        return obj_type, _inflate(pack, pos, size)
+
+
+def _inflate(buf, pos, size):
+    d = zlib.decompressobj()
+    out = []
+    n = 0
+    chunk = max(size, 64) * 2
+    while not d.eof and pos < len(buf):
+        part = d.decompress(buf[pos:pos + chunk])
+        out.append(part)
+        n += len(part)
+        pos += chunk
+    return b"".join(out)
+
+
+def _delta_size(delta, pos):
+    size = shift = 0
+    while True:
+        c = delta[pos]
+        pos += 1
+        size |= (c & 0x7f) << shift
+        shift += 7
+        if not c & 0x80:
+            return size, pos
+
+
+def _apply_delta(base, delta):
+    src_size, pos = _delta_size(delta, 0)
+    dst_size, pos = _delta_size(delta, pos)
+    if src_size != len(base):
+        raise GitReadError("bad delta base size")
+    out = bytearray()
+    while pos < len(delta):
+        op = delta[pos]
+        pos += 1
+        if op & 0x80:
+            offset = size = 0
+            for i in range(4):
+                if op & (1 << i):
+                    offset |= delta[pos] << (8 * i)
+                    pos += 1
+            for i in range(3):
+                if op & (0x10 << i):
+                    size |= delta[pos] << (8 * i)
+                    pos += 1
+            if size == 0:
+                size = 0x10000
+            out += base[offset:offset + size]
+        elif op:
+            out += delta[pos:pos + op]
+            pos += op
+        else:
+            raise GitReadError("bad delta opcode")
+    if len(out) != dst_size:
+        raise GitReadError("bad delta result size")
+    return bytes(out)
+
+
+def _format_person(value):
+    """ "Name <email> 1600000000 +0100" -> ("Name <email>", git's default date)"""
+    who, _, when = value.rpartition("> ")
+    timestamp, _, tz = when.partition(" ")
+    sign = -1 if tz.startswith("-") else 1
+    offset = datetime.timedelta(hours=int(tz[1:3]), minutes=int(tz[3:5])) * sign
+    dt = datetime.datetime.fromtimestamp(int(timestamp), datetime.timezone(offset))
+    date = "%s %s %d %s %s" % (dt.strftime("%a"), dt.strftime("%b"), dt.day,
+        dt.strftime("%H:%M:%S %Y"), tz)
+    return who + ">", date
+
+
+def format_commit(commit):
+    """Format a commit like `git log --pretty=fuller -1`."""
+    author, author_date = _format_person(commit.author)
+    committer, commit_date = _format_person(commit.committer)
+    lines = [
+        "commit %s" % commit.sha,
+        "Author:     %s" % author,
+        "AuthorDate: %s" % author_date,
+        "Commit:     %s" % committer,
+        "CommitDate: %s" % commit_date,
+        "",
+    ]
+    lines.extend("    " + l for l in commit.message.rstrip("\n").split("\n"))
+    return "\n".join(lines) + "\n"
+
+
+def _repo(path="."):
+    """The GitRepo for path (cached), or None outside a git repository."""
+    path = os.path.abspath(path)
+    with _cache_lock:
+        key = ("repo", path)
+        if key not in _cache:
+            found = find_git_dir(path)
+            _cache[key] = GitRepo(*found) if found is not None else None
+        return _cache[key]
+
+
+def _cached(name, path, compute):
+    key = (name, os.path.abspath(path))
+    with _cache_lock:
+        if key in _cache:
+            return _cache[key]
+    value = compute()
+    with _cache_lock:
+        _cache[key] = value
+    return value
+
+
+def clear_cache():
+    """Forget cached repositories and results, e.g. after a commit."""
+    with _cache_lock:
+        _cache.clear()
+
+
+def has_changes(path="."):
     """Returns whether the current directory has uncommitted changes to any
     track files."""
 
+    def compute():
+        try:
+            repo = _repo(path)
+            if repo is None:
+                return False
+            return repo.has_changes()
+        except (GitReadError, OSError, ValueError, KeyError, zlib.error, struct.error, IndexError):
+            return _has_changes_git()
+    return _cached("has_changes", path, compute)
+
+
+def current(path="."):
+    """Returns the current branch, the current commit SHA, the commit header
+    (formatted like `git log --pretty=fuller -1`) and whether this is a git
+    repo."""
+
+    def compute():
+        try:
+            repo = _repo(path)
+            if repo is None:
+                return "", "", "", False
+            ref, sha = repo.head()
+            if sha is None:
+                # no commits yet
+                return "", "", "", False
+            branch = ref[len("refs/heads/"):] if ref and ref.startswith("refs/heads/") else ""
+            return branch, sha, format_commit(repo.commit(sha)), True
+        except (GitReadError, OSError, ValueError, KeyError, zlib.error, struct.error, IndexError):
+            return _current_git()
+    return _cached("current", path, compute)
+
+
+def _has_changes_git():
     unstaged = subprocess.Popen('git diff --exit-code', shell=True, stderr=subprocess.DEVNULL, stdout=subprocess.DEVNULL)
     unstaged.communicate()
     unstaged_code = unstaged.returncode
@@ -25,9 +681,8 @@ def has_changes():
 
     return False
 
-def current():
-    """Returns the current branch and the current commit SHA"""
 
+def _current_git():
     p = subprocess.Popen("git show", shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
     commit, err = p.communicate()
 
@@ -1,47 +1,96 @@
+import atexit
+import collections
 import json
 import os
 import multiprocessing
+import signal
+import struct
+import sys
 import threading
-from contextlib import contextmanager
+import time
+import weakref
+from multiprocessing import shared_memory
 
-from .encoder import DBXEncoder
-from .stopwatch import stopwatch
+from .encoder import EventEncoder, ArrayFile, ARRAY_FILE_SUFFIX, copy_arrays
+from .index import open_index
+from .reader import line_event_name
 
 class LogContext:
     """Helper class to keep track of Logger context without polluting the Logger
-    class too much. Not indented for use outisde of the Logger class."""
+    class too much. Not indented for use outisde of the Logger class.
+
+    The path is kept as a tuple together with its joined form ("a/b/c", the
+    prefix of event names), so copies share both and event names are built
+    with a single string concatenation."""
+
+    __slots__ = ("_path", "_prefix")
 
     def __init__(self, path=None):
-        self._path = []
+        self._path = ()
+        self._prefix = ""
         if path is not None:
             self.sub(path)
 
     def sub(self, path):
         if type(path) is str:
             if "/" in path:
-                self._path.extend(path.split("/"))
+                self._path += tuple(path.split("/"))
             else:
-                self._path.append(path)
+                self._path += (path,)
+            joined = path
         else: # assume some iterable
-            self._path.extend(path)
+            parts = tuple(path)
+            if not parts:
+                return self
+            self._path += parts
+            joined = "/".join(parts)
+        self._prefix = self._prefix + "/" + joined if self._prefix else joined
         return self
 
     def parent(self):
-        if len(self._path) > 0:
+        if len(self._path) > 1:
+            # the prefix is the parts joined with "/", drop "/<last part>"
+            self._prefix = self._prefix[:-len(self._path[-1]) - 1]
             self._path = self._path[:-1]
+        elif self._path:
+            self.root()
         return self
 
     def root(self):
-        self._path.clear()
+        self._path = ()
+        self._prefix = ""
         return self
 
     def copy(self):
-        return LogContext(self._path)
+        ctx = LogContext.__new__(LogContext)
+        ctx._path = self._path
+        ctx._prefix = self._prefix
+        return ctx
+
+    def restore(self, other):
+        """Set this context to the path of other (e.g. a copy made earlier)."""
+        self._path = other._path
+        self._prefix = other._prefix
+
+    @property
+    def prefix(self):
+        """The path joined with "/"."""
+        return self._prefix
+
+    def event_name(self, event):
+        """Full event name of event (a name or a list of path parts) in this
+        context."""
+        if type(event) is not str:
+            # assume array of strings
+            event = "/".join(event)
+        if self._prefix:
+            return self._prefix + "/" + event
+        return event
 
     def path():
         doc = "Get and set the path of this context."
         def fget(self):
-            return self._path
+            return list(self._path)
         def fset(self, value):
             self.root()
             self.sub(value)
@@ -50,6 +99,8 @@ class LogContext:
 
 
 class Event:
+    __slots__ = ("full_name", "_data", "_save_duration", "_start", "_computed")
+
     def __init__(self, full_name, data=None, save_duration=True):
         self.full_name = full_name
         if data is None:
@@ -57,7 +108,7 @@ class Event:
         self._data = data
         self._save_duration = save_duration
         if self._save_duration:
-            self._stopwatch = stopwatch()
+            self._start = time.perf_counter_ns()
         self._computed = False
 
     def delete(self, key):
@@ -91,7 +142,8 @@ class Event:
 
         self._computed = True
         if self._save_duration:
-            self._data["duration"] = self._stopwatch()
+            # seconds, like time.time() differences
+            self._data["duration"] = (time.perf_counter_ns() - self._start) / 1e9
 
         return self._data
 
@@ -147,38 +199,41 @@ class Logger:
     at :py:class:`dbxlogger.Logger` as a shortcut.
     """
 
-    def new(file_path, mode="w", context=None):
+    def new(file_path, mode="w", context=None, **writer_kwargs):
         """Create a new logger at the given file path.
 
         mode: is the file opening mode.
         context: a LogContext object or None to create a new one automatically.
+        writer_kwargs: passed to FileLogWriter, e.g. buffered=True.
         """
 
         if context is None:
             context = LogContext()
-        w = LogWriter(file_path, mode)
+        w = FileLogWriter(file_path, mode, **writer_kwargs)
         return Logger(writer=w, context=context)
 
-    def new_subprocess(file_path, mode="w", context=None):
+    def new_subprocess(file_path, mode="w", context=None, **writer_kwargs):
         """Same as new() but creates a logger that launches the LogWriter on a
         different process to minimize I/O blocking. See SubprocessLogWriter for
-        details."""
+        details, writer_kwargs are passed to it (e.g. buffer_size)."""
 
-        w = SubprocessLogWriter(file_path, mode)
+        w = SubprocessLogWriter(file_path, mode, **writer_kwargs)
         if context is None:
             context = LogContext()
         return Logger(writer=w, context=context)
 
-    def new_thread(file_path, mode="w", context=None):
+    def new_thread(file_path, mode="w", context=None, **writer_kwargs):
         """Same as new() but creates a logger that launches the LogWriter on a
         different thread to minimize I/O blocking. See ThreadLogWriter for
-        details."""
+        details, writer_kwargs are passed to it (e.g. full_policy)."""
 
-        w = ThreadLogWriter(file_path, mode)
+        w = ThreadLogWriter(file_path, mode, **writer_kwargs)
         if context is None:
             context = LogContext()
         return Logger(writer=w, context=context)
 
+    __slots__ = ("_writer", "_context")
+
     def __init__(self, writer=None, context=None):
         self._writer = writer
         if context is None:
@@ -206,70 +261,82 @@ class Logger:
         """Copy this logger and set the context to path (relative to current
         context)."""
 
-        ctx = self.ctx.copy()
-        ctx.sub(path)
-        return Logger(writer=self._writer, context=ctx)
+        return self._derive(self._context.copy().sub(path))
 
     def parent(self):
         """Copy this logger and set the context to one level higher than the
         current context path."""
-        ctx = self.ctx.copy()
-        ctx.parent()
-        return Logger(writer=self._writer, context=ctx)
+        return self._derive(self._context.copy().parent())
 
     def root(self):
         """Copy this logger and set the context to the root level."""
-        ctx = self.ctx.copy()
-        ctx.root()
-        return Logger(writer=self._writer, context=ctx)
+        return self._derive(LogContext())
+
+    def _derive(self, ctx):
+        """A logger of the same class and writer with context ctx, without
+        going through __init__ (sub() is called a lot in loops)."""
+        logger = object.__new__(type(self))
+        logger._writer = self._writer
+        logger._context = ctx
+        return logger
+
+    def windowed(self, every=None, interval=None, samples=0, events=None, seed=None,
+            close_writer=True):
+        """Return a logger of the same class with the same context that logs
+        one summary event (count, mean, min, max, last) per window of `every`
+        events or `interval` seconds instead of every event. See
+        WindowedLogWriter in dbxlogger.downsample for the arguments.
+
+        Close the returned logger to write the open windows; that also
+        closes this logger's writer, unless close_writer is False."""
+        w = self._windowed_writer(every=every, interval=interval, samples=samples,
+            events=events, seed=seed, close_writer=close_writer)
+        return type(self)(writer=w, context=self.ctx.copy())
+
+    def _windowed_writer(self, **kwargs):
+        from .downsample import WindowedLogWriter
+        return WindowedLogWriter(self._writer, **kwargs)
 
     def local_event_name(self, event):
-        full_event = []
-        full_event.extend(self.ctx.path)
-        if type(event) == str:
-            if "/" in event:
-                full_event.extend(event.split("/"))
-            else:
-                full_event.append(event)
-        else:
-            # assume array of strings
-            full_event.extend(event)
-        return "/".join(full_event)
+        return self._context.event_name(event)
 
-    def log(self, event, data=None):
+    def _event_and_data(self, event, data):
+        """Resolve what log(event, data) should write: (full event name, data)."""
         if isinstance(event, Event):
             if data is not None:
                 event.add(data)
-            data = event._get_data()
-            self.writer.log(event.full_name, data)
-        else:
-            if data is None:
-                raise Exception("cannot use None data for inline events")
-            event = self.local_event_name(event)
-            self.writer.log(event, data)
+            return event.full_name, event._get_data()
+
+        if data is None:
+            raise Exception("cannot use None data for inline events")
+        return self.local_event_name(event), data
+
+    def log(self, event, data=None):
+        if type(event) is str and data is not None:
+            # the common case, without the extra calls of _event_and_data
+            prefix = self._context._prefix
+            self._writer.log(prefix + "/" + event if prefix else event, data)
+            return
+        event, data = self._event_and_data(event, data)
+        self._writer.log(event, data)
+
+    def flush(self):
+        """Make sure everything logged so far is written to the log."""
+        self.writer.flush()
 
     def close(self):
         self.writer.close()
 
-    @contextmanager
     def at(self, path):
-        current_path = [p for p in self.ctx.path]
-
-        if path.startswith("/"):
-            path = path[1:]
-            self.ctx.path = path
-        else:
-            self.ctx.sub(path)
-
-        try:
-            yield
-        finally:
-            self.ctx.path = current_path
+        """Context manager that changes the context of this logger to path
+        (relative, or absolute if it starts with /) while the with block
+        runs."""
+        return _At(self._context, path)
 
     def at_iter(self, iterator, path_lambda_or_fmt):
-        current_path = [p for p in self.ctx.path]
+        saved = self.ctx.copy()
         for obj in iterator:
-            self.ctx.path = current_path
+            self.ctx.restore(saved)
 
             if type(path_lambda_or_fmt) == str:
                 path = path_lambda_or_fmt % obj
@@ -284,108 +351,618 @@ class Logger:
 
             yield obj
 
-        self.ctx.path = current_path
+        self.ctx.restore(saved)
+
+
+class _At:
+    """Context manager returned by Logger.at(). A plain class rather than
+    @contextmanager since it is used around every batch in training loops."""
+
+    __slots__ = ("_context", "_path", "_saved")
+
+    def __init__(self, context, path):
+        self._context = context
+        self._path = path
+
+    def __enter__(self):
+        self._saved = self._context.copy()
+        path = self._path
+        if path.startswith("/"):
+            self._context.path = path[1:]
+        else:
+            self._context.sub(path)
+
+    def __exit__(self, *args):
+        self._context.restore(self._saved)
+
+
+FSYNC_NEVER = "never"
+FSYNC_CLOSE = "close"
+
+# buffered writers that still have to be drained at exit or on SIGTERM
+_open_writers = weakref.WeakSet()
+# writers with a background thread or process; closed at exit or on SIGTERM
+_running_writers = weakref.WeakSet()
+_sigterm_installed = False
+
+# seconds each background writer gets to finish on SIGTERM; the handler may
+# have interrupted the thread that holds a writer's lock, so it can't wait
+# forever for the writer thread or process
+SIGTERM_CLOSE_TIMEOUT = 5
+
+def _drain_open_writers():
+    for w in list(_open_writers):
+        try:
+            w.flush()
+        except (OSError, ValueError):
+            # file already closed or not writable anymore, nothing to do
+            pass
+        except Exception as e:
+            print("WARN: dbxlogger could not flush log: %r" % e, file=sys.stderr)
+
+def _close_running_writers(timeout=None):
+    writers = list(_running_writers)
+    # writers that wrap another one (WindowedLogWriter) log to it on close, so
+    # they are closed first
+    wrapped = set(id(getattr(w, "_writer", None)) for w in writers)
+    for w in sorted(writers, key=lambda w: id(w) in wrapped):
+        try:
+            w.close(timeout=timeout)
+        except Exception as e:
+            # one broken writer should not keep the others from closing
+            print("WARN: dbxlogger could not close log writer: %r" % e, file=sys.stderr)
+
+# atexit runs handlers in reverse order: close background writers first since
+# they flush their own file writers
+atexit.register(_drain_open_writers)
+atexit.register(_close_running_writers)
+
+def _on_sigterm(signum, frame):
+    _close_running_writers(timeout=SIGTERM_CLOSE_TIMEOUT)
+    _drain_open_writers()
+    # behave as if we never installed a handler
+    signal.signal(signum, signal.SIG_DFL)
+    os.kill(os.getpid(), signum)
+
+def _install_sigterm_handler():
+    """Drain buffered writers on SIGTERM, but only if nobody else installed a
+    handler already and we are allowed to (main thread only)."""
+    global _sigterm_installed
+    if _sigterm_installed:
+        return
+    if threading.current_thread() is not threading.main_thread():
+        return
+    if signal.getsignal(signal.SIGTERM) is not signal.SIG_DFL:
+        return
+    signal.signal(signal.SIGTERM, _on_sigterm)
+    _sigterm_installed = True
 
 
 class FileLogWriter:
-    def __init__(self, file_path, mode="w"):
+    def __init__(self, file_path, mode="w", buffered=False, flush_every=None,
+            flush_bytes=None, flush_interval=None, fsync=FSYNC_NEVER,
+            sort_keys=True, json_backend="json", index=False, index_level=None,
+            arrays=False, defer_hashes=False):
         """Create a LogWriter.
 
         file_path: path to a file as string or a file object
         mode: if file_path is a string, the mode used to open the file
+        buffered: if False (default) every event is written and flushed
+            immediately. If True, events are kept in memory and written in
+            one go when one of the flush triggers below fires, on flush(),
+            close(), process exit or SIGTERM.
+        flush_every: (buffered only) flush after this many events.
+        flush_bytes: (buffered only) flush when the buffer has at least this
+            many bytes. Defaults to 64KiB if no other trigger is given.
+        flush_interval: (buffered only) flush when this many seconds passed
+            since the last flush. Checked when events are logged.
+        fsync: "never" (default), "close" to fsync once when closing or a
+            number of milliseconds to fsync at most that often after a flush.
+        sort_keys: sort the keys of the event data (default True).
+        json_backend: "json", "orjson" or "auto", see EventEncoder.
+        index: keep a sidecar index (file_path + ".idx") of where each event
+            is in the log, see dbxlogger.index. Needs a file path.
+        index_level: index by the first index_level parts of the event name
+            instead of the full name.
+        arrays: write large numpy arrays and torch tensors to a binary file
+            next to the log (file_path + ".arrays") instead of inline, see
+            dbxlogger.encoder.ArrayFile. Needs a file path.
+        defer_hashes: log reffiles whose hash isn't cached right away with
+            sha256 null and hash them in the background. Each hash is
+            written in a "_dbx/reffile" event when it's ready (checked when
+            events are logged) or on flush().
         """
         if type(file_path) == str:
             self.file_path = file_path
-            self.f = open(file_path, mode)
+            # no newline translation when indexing and always utf-8 (what
+            # readers and the index byte offsets assume), offsets must be exact
+            self.f = open(file_path, mode, encoding="utf-8", newline="\n" if index else None)
         else:
+            if index:
+                raise Exception("index=True needs a file path, not a file object")
             self.f = file_path
 
-        self._encoder = DBXEncoder
+        self._index = None
+        if index:
+            self._index = open_index(file_path, index_level)
+
+        self._arrays = None
+        if arrays:
+            if type(file_path) != str:
+                raise Exception("arrays=True needs a file path, not a file object")
+            self._arrays = ArrayFile(file_path + ARRAY_FILE_SUFFIX, mode)
+
+        self._encoder = EventEncoder(sort_keys=sort_keys, backend=json_backend, arrays=self._arrays,
+            defer_hashes=defer_hashes)
+
+        if fsync != FSYNC_NEVER and fsync != FSYNC_CLOSE:
+            if not isinstance(fsync, (int, float)) or fsync < 0:
+                raise Exception("invalid fsync policy %s: use 'never', 'close' or milliseconds" % fsync)
+        self._fsync = fsync
+        self._last_fsync = time.monotonic()
+
+        self._buffered = buffered
+        if buffered and flush_every is None and flush_bytes is None and flush_interval is None:
+            flush_bytes = 64 * 1024
+        self._flush_every = flush_every
+        self._flush_bytes = flush_bytes
+        self._flush_interval = flush_interval
+        self._buffer = []
+        self._buffer_size = 0
+        self._last_flush = time.monotonic()
+
+        if buffered:
+            _open_writers.add(self)
+            _install_sigterm_handler()
 
     def log(self, event_name, data):
-        if "event" in data:
-            del data["event"]
-        encoded = json.dumps(data, sort_keys=True, cls=self._encoder)
-        event_encoded = json.dumps({"event": event_name})
-        print(event_encoded[:-1], ", ", encoded[1:], file=self.f, sep="")
+        line = self._encoder.encode(event_name, data) + "\n"
+
+        if self._index is not None:
+            self._index.add(event_name, len(line) if line.isascii() else len(line.encode()))
+
+        if not self._buffered:
+            self.f.write(line)
+            self.f.flush()
+            self._maybe_fsync()
+            if self._index is not None:
+                self._index.maybe_flush()
+        else:
+            self._buffer.append(line)
+            self._buffer_size += len(line)
+
+            if self._flush_every is not None and len(self._buffer) >= self._flush_every:
+                self._flush()
+            elif self._flush_bytes is not None and self._buffer_size >= self._flush_bytes:
+                self._flush()
+            elif self._flush_interval is not None and time.monotonic() - self._last_flush >= self._flush_interval:
+                self._flush()
+
+        if self._encoder.deferred:
+            for ev in self._encoder.resolved():
+                self.log(*ev)
+
+    def flush(self):
+        """Write all buffered events (and the hashes still being computed,
+        with defer_hashes) and flush the underlying file."""
+        if self._encoder.deferred:
+            for ev in self._encoder.resolved(wait=True):
+                self.log(*ev)
+        self._flush()
+
+    def _flush(self):
+        if self._buffer:
+            self.f.write("".join(self._buffer))
+            self._buffer.clear()
+            self._buffer_size = 0
         self.f.flush()
+        self._last_flush = time.monotonic()
+        self._maybe_fsync()
+        if self._index is not None:
+            self._index.flush()
+
+    def _maybe_fsync(self):
+        if self._fsync == FSYNC_NEVER or self._fsync == FSYNC_CLOSE:
+            return
+        now = time.monotonic()
+        if (now - self._last_fsync) * 1000 >= self._fsync:
+            self._do_fsync()
+            self._last_fsync = now
+
+    def _do_fsync(self):
+        try:
+            os.fsync(self.f.fileno())
+        except (AttributeError, OSError):
+            # not a real file (e.g. a tty or StringIO), can't be synced
+            pass
 
     def close(self):
-        self.f.flush()
+        self.flush()
+        if self._fsync != FSYNC_NEVER:
+            self._do_fsync()
+        _open_writers.discard(self)
         self.f.close()
+        if self._index is not None:
+            self._index.close()
+        if self._arrays is not None:
+            self._arrays.close()
+
+
+# shared memory layout: a header with three counters followed by the ring.
+# head and tail are the total number of bytes written to / consumed from the
+# ring since it was created, positions in the ring are counter % capacity.
+_RING_HEADER = struct.Struct("QQQ") # head, tail, closed
+_RING_HEAD = 0
+_RING_TAIL = 8
+_RING_CLOSED = 16
+_RING_DATA_OFFSET = 64
+_U64 = struct.Struct("Q")
+
+
+def _index_lines(index, data):
+    for line in data.splitlines(keepends=True):
+        name = line_event_name(line)
+        if name is None:
+            name = json.loads(line).get("event") or ""
+        index.add(name, len(line))
+
+
+def _subprocess_writer_main(shm_name, capacity, lock, file_path, poll_interval, fsync, index_level):
+    """Runs in the writer process: copies everything between tail and head to
+    the log file in one write (two if the data wraps around the ring)."""
+
+    # the child only exits when the parent closes the writer
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    # the child shares the parent's resource tracker, which already tracks
+    # this segment; the parent unlinks it in close()
+    shm = shared_memory.SharedMemory(name=shm_name)
+    buf = shm.buf
+    f = open(file_path, "ab")
+    last_fsync = time.monotonic()
+    index = None
+    if index_level is not False:
+        index = open_index(file_path, index_level)
+
+    while True:
+        with lock:
+            head, tail, closed = _RING_HEADER.unpack_from(buf, 0)
+
+        if head == tail:
+            if closed:
+                break
+            time.sleep(poll_interval)
+            continue
+
+        start = _RING_DATA_OFFSET + tail % capacity
+        end = start + (head - tail)
+        if end <= _RING_DATA_OFFSET + capacity:
+            chunks = (buf[start:end],)
+        else:
+            chunks = (buf[start:_RING_DATA_OFFSET + capacity], buf[_RING_DATA_OFFSET:end - capacity])
+        f.writelines(chunks)
+        f.flush()
+
+        if index is not None:
+            # the ring always holds whole lines but one may wrap around
+            _index_lines(index, b"".join(chunks))
+            index.flush()
+        del chunks
+
+        if fsync != FSYNC_NEVER and fsync != FSYNC_CLOSE:
+            now = time.monotonic()
+            if (now - last_fsync) * 1000 >= fsync:
+                os.fsync(f.fileno())
+                last_fsync = now
+
+        with lock:
+            _U64.pack_into(buf, _RING_TAIL, head)
+
+    if fsync != FSYNC_NEVER:
+        os.fsync(f.fileno())
+    f.close()
+    if index is not None:
+        index.close()
+
+    del buf
+    shm.close()
+
+
+QUEUE_BLOCK = "block"
+QUEUE_DROP_OLDEST = "drop-oldest"
+QUEUE_DROP_NEWEST = "drop-newest"
+QUEUE_COALESCE = "coalesce"
+
+_QUEUE_POLICIES = (QUEUE_BLOCK, QUEUE_DROP_OLDEST, QUEUE_DROP_NEWEST, QUEUE_COALESCE)
 
 
 class SubprocessLogWriter:
-    def __init__(self, file_path, mode="w", writer_class=None):
-        """file_path and mode are passed to LogWriter() in another process."""
+    """Writes events from a separate process.
+
+    Events are encoded in the calling process and the bytes are copied into a
+    ring buffer in shared memory. The writer process copies whatever is in
+    the ring to the log file in one write, so nothing is pickled and the
+    caller only waits if the ring is full.
+
+    buffer_size: size of the ring buffer in bytes (default 8MiB). An event
+        cannot be larger than this.
+    full_policy: "block" (default) waits for the writer process to make room,
+        "drop-newest" drops the event being logged and counts it in `dropped`.
+    poll_interval: how long the writer process sleeps when there is nothing to
+        write, in seconds.
+    fsync, sort_keys, json_backend, index, index_level, arrays, defer_hashes:
+        same as for FileLogWriter. The index is maintained by the writer
+        process, arrays are written by the calling process while encoding.
+    """
+
+    def __init__(self, file_path, mode="w", buffer_size=8 * 1024 * 1024,
+            full_policy=QUEUE_BLOCK, poll_interval=0.01, fsync=FSYNC_NEVER,
+            sort_keys=True, json_backend="json", index=False, index_level=None,
+            arrays=False, defer_hashes=False):
+        if type(file_path) != str:
+            raise Exception("SubprocessLogWriter needs a file path, not a file object")
+        if full_policy not in (QUEUE_BLOCK, QUEUE_DROP_NEWEST):
+            raise Exception("invalid full_policy %s for SubprocessLogWriter, use block or drop-newest" % full_policy)
+
         self.file_path = file_path
         self.mode = mode
+        self.capacity = buffer_size
+        self.full_policy = full_policy
+        self.poll_interval = poll_interval
+        self.dropped = 0
+
+        # open here so a bad path or mode fails in the caller; the writer
+        # process only ever appends
+        open(file_path, mode).close()
+
+        self._arrays = ArrayFile(file_path + ARRAY_FILE_SUFFIX, mode) if arrays else None
+        self._encoder = EventEncoder(sort_keys=sort_keys, backend=json_backend, arrays=self._arrays,
+            defer_hashes=defer_hashes)
+
+        self._shm = shared_memory.SharedMemory(create=True, size=_RING_DATA_OFFSET + buffer_size)
+        self._buf = self._shm.buf
+        _RING_HEADER.pack_into(self._buf, 0, 0, 0, 0)
+
+        # head is only written by this process, so it is kept locally; the
+        # last seen tail is cached so the shared lock is only taken to
+        # publish the new head or when the ring looks full
+        self._head = 0
+        self._tail = 0
+        self._lock = multiprocessing.Lock()
+        self._producer_lock = threading.Lock()
+        self._closed = False
 
-        if writer_class is None:
-            self.writer_class = FileLogWriter
-        else:
-            self.writer_class = writer_class
-
-        self.queue = multiprocessing.Queue(10)
         self.proc = multiprocessing.Process(
-            target=SubprocessLogWriter.writer_main,
-            args=(self.writer_class, self.file_path, self.mode, self.queue)
+            target=_subprocess_writer_main,
+            args=(self._shm.name, buffer_size, self._lock, file_path, poll_interval, fsync,
+                index_level if index else False),
+            daemon=True,
         )
         self.proc.start()
+        _running_writers.add(self)
+        _install_sigterm_handler()
 
-    def writer_main(writer_class, file_path, mode, queue):
-        w = writer_class(file_path, mode)
-        for message in queue:
-            if message is None:
-                w.flush()
-                w.close()
-                return
-            event, data = message
-            w.log(event, data)
-
-        # shouldn't get here, but if it does, close the file
-        w.close()
+    def _read_tail(self):
+        with self._lock:
+            self._tail = _U64.unpack_from(self._buf, _RING_TAIL)[0]
+        return self._tail
 
     def log(self, event, data):
-        self.queue.put((event, data))
+        line = (self._encoder.encode(event, data) + "\n").encode()
+        n = len(line)
+        if n > self.capacity:
+            raise Exception("event %s is %d bytes, larger than the buffer size %d" % (event, n, self.capacity))
+
+        with self._producer_lock:
+            if self._closed:
+                raise Exception("cannot log to a closed SubprocessLogWriter")
+
+            while self._head + n - self._tail > self.capacity:
+                if self._head + n - self._read_tail() <= self.capacity:
+                    break
+                if self.full_policy == QUEUE_DROP_NEWEST:
+                    self.dropped += 1
+                    return
+                if not self.proc.is_alive():
+                    raise Exception("log writer process exited with code %s" % self.proc.exitcode)
+                time.sleep(self.poll_interval / 10)
+
+            start = _RING_DATA_OFFSET + self._head % self.capacity
+            first = min(n, _RING_DATA_OFFSET + self.capacity - start)
+            self._buf[start:start + first] = line[:first]
+            if first < n:
+                self._buf[_RING_DATA_OFFSET:_RING_DATA_OFFSET + n - first] = line[first:]
+            self._head += n
+
+            with self._lock:
+                _U64.pack_into(self._buf, _RING_HEAD, self._head)
+
+        if self._encoder.deferred:
+            for ev in self._encoder.resolved():
+                self.log(*ev)
+
+    def flush(self):
+        """Wait until the writer process wrote everything logged so far."""
+        if self._encoder.deferred:
+            for ev in self._encoder.resolved(wait=True):
+                self.log(*ev)
+        while self._read_tail() < self._head and self.proc.is_alive():
+            time.sleep(self.poll_interval / 10)
+
+    def close(self, timeout=None):
+        """Wait for the writer process to write everything and stop. With a
+        timeout (in seconds) give up after that long, leaving the rest to
+        the daemon process; reffile hashes still being computed are then
+        not written."""
+        if self._encoder.deferred and not self._closed and timeout is None:
+            for ev in self._encoder.resolved(wait=True):
+                self.log(*ev)
+        if not self._producer_lock.acquire(timeout=-1 if timeout is None else timeout):
+            print("WARN: dbxlogger could not close log %s in time" % self.file_path, file=sys.stderr)
+            return
+        try:
+            if self._closed:
+                return
+            self._closed = True
+            with self._lock:
+                _U64.pack_into(self._buf, _RING_CLOSED, 1)
+        finally:
+            self._producer_lock.release()
 
-    def close(self):
-        self.queue.put(None)
-        self.proc.join()
+        self.proc.join(timeout)
+        if self.proc.is_alive():
+            print("WARN: dbxlogger could not close log %s in time" % self.file_path, file=sys.stderr)
+            return
+        _running_writers.discard(self)
+
+        self._buf.release()
+        self._shm.close()
+        self._shm.unlink()
+        if self._arrays is not None:
+            self._arrays.close()
 
 class ThreadLogWriter:
-    def __init__(self, file_path, mode="w", writer_class=None, queue_size=10):
-        """file_path and mode are passed to LogWriter() in another process."""
+    """Writes events on a background thread.
+
+    log() only puts the event in an in-memory queue. The writer thread takes
+    everything queued at once, hands it to the wrapped writer and flushes
+    once per batch, so a batch of events costs one write.
+
+    Events are encoded on the writer thread, so don't modify a data dict after
+    logging it. Numpy arrays and torch tensors in it are copied by log(), so
+    those can be updated in place.
+
+    When the queue is full (queue_size events pending) the full_policy decides
+    what happens:
+
+        "block"         wait for the writer thread to make room (default)
+        "drop-oldest"   drop the oldest pending event
+        "drop-newest"   drop the event being logged
+        "coalesce"      replace the data of the newest pending event with the
+                        same name; if there is none, drop the oldest event
+
+    Dropped and coalesced events are counted in the `dropped` attribute.
+    """
+
+    def __init__(self, file_path, mode="w", writer_class=None, queue_size=10000,
+            full_policy=QUEUE_BLOCK, **writer_kwargs):
+        """file_path, mode and writer_kwargs are passed to writer_class
+        (default FileLogWriter, buffered) on the writer thread."""
         self.file_path = file_path
         self.mode = mode
 
         if writer_class is None:
             self.writer_class = FileLogWriter
+            writer_kwargs.setdefault("buffered", True)
         else:
             self.writer_class = writer_class
 
-        self.queue = threading.Queue(queue_size)
-        self.thread = threading.Thread(
-            target=ThreadLogWriter.writer_main,
-            args=(self.writer_class, self.file_path, self.mode, self.queue)
-        )
-        self.thread.start()
+        if full_policy not in _QUEUE_POLICIES:
+            raise Exception("invalid full_policy %s, use one of %s" % (full_policy, ", ".join(_QUEUE_POLICIES)))
+        if queue_size < 1:
+            raise Exception("queue_size must be at least 1")
 
-    def writer_main(writer_class, file_path, mode, queue):
-        w = writer_class(file_path, mode)
-        for message in queue:
-            if message is None:
-                w.close()
-                return
-            event, data = message
-            w.log(event, data)
+        self.queue_size = queue_size
+        self.full_policy = full_policy
+        self.dropped = 0
 
-        # shouldn't get here, but if it does, close the file
-        w.close()
+        # pending events are [event, data] lists so coalescing can replace the
+        # data in place; _latest maps event name to its newest pending entry
+        self._queue = collections.deque()
+        self._latest = {}
+        self._writing = False
+        self._closed = False
 
-    def log(self, event, data):
-        self.queue.put((event, data))
+        self._lock = threading.RLock()
+        self._not_empty = threading.Condition(self._lock)
+        self._not_full = threading.Condition(self._lock)
+        self._idle = threading.Condition(self._lock)
 
-    def close(self):
-        self.queue.put(None)
-        self.proc.join()
+        # the writer is created here so errors opening the file surface in
+        # the caller, not on the writer thread
+        self._writer = self.writer_class(file_path, mode, **writer_kwargs)
+
+        self.thread = threading.Thread(target=self._writer_main, name="dbxlogger-writer", daemon=True)
+        self.thread.start()
+        _running_writers.add(self)
+        _install_sigterm_handler()
+
+    def _writer_main(self):
+        while True:
+            with self._lock:
+                while not self._queue and not self._closed:
+                    self._not_empty.wait()
+                if not self._queue and self._closed:
+                    break
+                batch = self._queue
+                self._queue = collections.deque()
+                self._latest = {}
+                self._writing = True
+                self._not_full.notify_all()
+
+            for event, data in batch:
+                try:
+                    self._writer.log(event, data)
+                except Exception as e:
+                    # a bad event should not stop the writer thread
+                    print("WARN: dbxlogger could not write event %s: %r" % (event, e), file=sys.stderr)
+            try:
+                self._writer.flush()
+            except Exception as e:
+                print("WARN: dbxlogger could not flush log: %r" % e, file=sys.stderr)
+
+            with self._lock:
+                self._writing = False
+                self._idle.notify_all()
+
+        self._writer.close()
+
+    def log(self, event, data):
+        data = copy_arrays(data)
+        with self._lock:
+            if self._closed:
+                raise Exception("cannot log to a closed ThreadLogWriter")
+
+            if len(self._queue) >= self.queue_size:
+                if self.full_policy == QUEUE_BLOCK:
+                    while len(self._queue) >= self.queue_size and not self._closed:
+                        self._not_full.wait()
+                    if self._closed:
+                        raise Exception("cannot log to a closed ThreadLogWriter")
+                elif self.full_policy == QUEUE_DROP_NEWEST:
+                    self.dropped += 1
+                    return
+                elif self.full_policy == QUEUE_COALESCE and event in self._latest:
+                    self._latest[event][1] = data
+                    self.dropped += 1
+                    return
+                else:
+                    oldest = self._queue.popleft()
+                    if self._latest.get(oldest[0]) is oldest:
+                        del self._latest[oldest[0]]
+                    self.dropped += 1
+
+            entry = [event, data]
+            self._queue.append(entry)
+            self._latest[event] = entry
+            self._not_empty.notify()
+
+    def flush(self):
+        """Wait until all events logged so far are written and flushed."""
+        with self._lock:
+            self._not_empty.notify()
+            while (self._queue or self._writing) and self.thread.is_alive():
+                self._idle.wait()
+
+    def close(self, timeout=None):
+        """Write the pending events and stop the writer thread. With a
+        timeout (in seconds) give up waiting for the thread after that long."""
+        with self._lock:
+            self._closed = True
+            self._not_empty.notify()
+            self._not_full.notify_all()
+        self.thread.join(timeout)
+        if self.thread.is_alive():
+            print("WARN: dbxlogger could not close log %s in time" % self.file_path, file=sys.stderr)
+            return
+        _running_writers.discard(self)
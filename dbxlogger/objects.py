@@ -0,0 +1,203 @@
+"""
+Content-addressed storage of expfiles, shared by all the experiments of a
+:py:class:`dbxlogger.repo.LocalRepo` (see its `objects` argument).
+
+Each distinct file content is stored once, as
+`.objects/<sha256[:2]>/<sha256>` in the repo, read-only. Experiment directories get a hardlink to the object
+(or a reflink, or a copy, where the filesystem can't hardlink) and files.json
+maps the file name to the sha256, so files shared by the experiments of a
+sweep (dataset splits, vocabularies, initial checkpoints) take the space of
+one.
+
+Objects are never removed when they are written, use gc() (or
+`LocalRepo.gc()`) to remove the ones no files.json references anymore.
+
+The store is a dot directory, so it can't be an experiment or group name,
+and it has a marker file (`.objects/dbxobjects`) written when the store is
+created; LocalRepo only uses a store by default when the marker is there.
+"""
+
+import errno
+import os
+import re
+import shutil
+import stat
+import time
+import uuid
+
+from . import fileindex
+
+OBJECTS_DIRNAME = ".objects"
+# written when a store is created, so an existing directory is only used as
+# a store if it is one
+MARKER_FILENAME = "dbxobjects"
+
+# objects and temp files younger than this are kept by gc(): they may belong
+# to a file that is being added right now and isn't in files.json yet
+GC_GRACE_SECONDS = 3600
+
+# what gc() may remove: objects (<sha256[:2]>/<sha256>) and temp files
+_PREFIX_RE = re.compile(r"[0-9a-f]{2}")
+_OBJECT_RE = re.compile(r"[0-9a-f]{64}")
+_TMP_RE = re.compile(r"[0-9a-f]{32}")
+
+# linux/fs.h FICLONE
+_FICLONE = 0x40049409
+
+
+def reflink(src, dst):
+    """Make dst a copy-on-write clone of src (btrfs, xfs, ...). Raises
+    OSError if the filesystem (or platform) can't."""
+    try:
+        import fcntl
+    except ImportError:
+        raise OSError(errno.EOPNOTSUPP, "reflink not supported")
+    with open(src, "rb") as s, open(dst, "wb") as d:
+        try:
+            fcntl.ioctl(d.fileno(), _FICLONE, s.fileno())
+        except OSError:
+            d.close()
+            os.remove(dst)
+            raise
+
+
+def link_or_copy(src, dst):
+    """Put the content of src at dst with a hardlink, a reflink or a copy,
+    whichever works first. Returns "link", "reflink" or "copy"."""
+    try:
+        os.link(src, dst)
+        return "link"
+    except OSError:
+        pass
+    try:
+        reflink(src, dst)
+        return "reflink"
+    except OSError:
+        pass
+    shutil.copyfile(src, dst)
+    return "copy"
+
+
+def is_store(path):
+    """Whether path is an object store (has the marker file)."""
+    return os.path.isfile(os.path.join(path, MARKER_FILENAME))
+
+
+class ObjectStore:
+    """The objects directory of a repo.
+
+    path: the objects directory (usually `<repo>/.objects`), created with
+        its marker file if it doesn't exist
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._tmp = os.path.join(path, "tmp")
+        if not is_store(path):
+            os.makedirs(path, exist_ok=True)
+            with open(os.path.join(path, MARKER_FILENAME), "w") as f:
+                f.write("1\n")
+
+    def object_path(self, sha256):
+        return os.path.join(self.path, sha256[:2], sha256)
+
+    def __contains__(self, sha256):
+        return os.path.exists(self.object_path(sha256))
+
+    def tempfile(self):
+        """Return the path of a new temporary file in the store, to be
+        written and then passed to add(). It's on the same filesystem as the
+        objects, so add() is a rename."""
+        os.makedirs(self._tmp, exist_ok=True)
+        return os.path.join(self._tmp, uuid.uuid4().hex)
+
+    def add(self, path, sha256):
+        """Move the file at path (with content hash sha256) into the store
+        and return the object path. If the object already exists path is
+        removed instead."""
+        obj = self.object_path(sha256)
+        if os.path.exists(obj):
+            os.remove(path)
+            # gc() keeps young objects, this one is about to be referenced
+            os.utime(obj)
+            return obj
+        os.makedirs(os.path.dirname(obj), exist_ok=True)
+        # read-only, so writes through a hardlink in an experiment can't
+        # change the content of other experiments' files
+        os.chmod(path, 0o444)
+        os.replace(path, obj)
+        return obj
+
+    def link(self, sha256, dst):
+        """Make dst (replacing it if it exists) a file with the content of
+        object sha256. Returns how, see link_or_copy()."""
+        tmp = "%s.%s.tmp" % (dst, uuid.uuid4().hex[:8])
+        how = link_or_copy(self.object_path(sha256), tmp)
+        os.replace(tmp, dst)
+        return how
+
+    def gc(self, repo_path, grace=GC_GRACE_SECONDS, dry_run=False):
+        """Remove the objects not referenced by the file index of any
+        experiment in repo_path, and temp files left by crashed writers.
+        Objects and temp files modified less than grace seconds ago are kept,
+        anything else in the store directory is never touched.
+
+        Returns a dict with the number of objects kept ("referenced"),
+        removed ("removed", or would be with dry_run) and the bytes freed
+        ("freed", objects still linked from experiment directories free
+        nothing)."""
+        refs = {}
+        for exp_path in experiment_dirs(repo_path):
+            for sha in fileindex.read(exp_path).values():
+                refs[sha] = refs.get(sha, 0) + 1
+
+        counts = {"referenced": 0, "removed": 0, "freed": 0}
+        cutoff = time.time() - grace
+        try:
+            prefixes = os.listdir(self.path)
+        except FileNotFoundError:
+            return counts
+
+        for prefix in prefixes:
+            d = os.path.join(self.path, prefix)
+            is_tmp = prefix == "tmp"
+            if not (is_tmp or _PREFIX_RE.fullmatch(prefix)) or not os.path.isdir(d):
+                continue
+            for name in os.listdir(d):
+                p = os.path.join(d, name)
+                if is_tmp:
+                    if not _TMP_RE.fullmatch(name):
+                        continue
+                elif not _OBJECT_RE.fullmatch(name) or not name.startswith(prefix):
+                    continue
+                elif refs.get(name, 0) > 0:
+                    counts["referenced"] += 1
+                    continue
+                st = os.lstat(p)
+                if not stat.S_ISREG(st.st_mode) or st.st_mtime > cutoff:
+                    continue
+                counts["removed"] += 1
+                if st.st_nlink == 1:
+                    # still hardlinked from an experiment directory otherwise
+                    counts["freed"] += st.st_size
+                if not dry_run:
+                    os.remove(p)
+            if not dry_run and not is_tmp and not os.listdir(d):
+                os.rmdir(d)
+        return counts
+
+
+def experiment_dirs(repo_path):
+    """Yield the experiment directories (with a meta.json) of a repo,
+    skipping entries starting with a dot (like the object store)."""
+    stack = [repo_path]
+    while stack:
+        d = stack.pop()
+        with os.scandir(d) as entries:
+            for entry in entries:
+                if entry.name.startswith(".") or not entry.is_dir():
+                    continue
+                if os.path.exists(os.path.join(entry.path, "meta.json")):
+                    yield entry.path
+                else:
+                    stack.append(entry.path)
@@ -0,0 +1,349 @@
+"""
+Read logs written by :py:class:`dbxlogger.Logger` back into Python.
+
+Events are read lazily one line at a time, so memory use does not depend on
+the size of the log:
+
+    from dbxlogger.reader import read_log
+
+    for ev in read_log("output/abc/log.jsonl", events="epoch/*/eval", keys=["val_acc"]):
+        print(ev["event"], ev["val_acc"])
+
+Values encoded by :py:class:`dbxlogger.encoder.DBXEncoder` as `{"_dbx": ...}`
+are decoded back: NaN and infinities into floats, reffiles into
+:py:class:`RefFileRef`, expfiles into :py:class:`ExpFileRef` and arrays
+stored in the array file of the log into :py:class:`ArrayRef` (use
+:py:func:`load_array` to get the data).
+
+Reffiles logged by a writer with defer_hashes=True can have sha256 None; their
+hash is in a later "_dbx/reffile" event with the complete reffile as "reffile".
+"""
+
+import collections
+import fnmatch
+import json
+import mmap
+import multiprocessing
+import os
+import re
+
+from .encoder import DBXCODE_NAN, DBXCODE_INFINITY, DBXCODE_NEG_INFINITY, DBXCODE_ARRAY
+from .index import read_index, key_filter
+
+RefFileRef = collections.namedtuple("RefFileRef", ["path", "hostname", "sha256"])
+ExpFileRef = collections.namedtuple("ExpFileRef", ["exp", "name", "sha256"])
+ArrayRef = collections.namedtuple("ArrayRef", ["file", "offset", "dtype", "shape"])
+
+_FLOAT_CODES = {
+    DBXCODE_NAN: float("nan"),
+    DBXCODE_INFINITY: float("inf"),
+    DBXCODE_NEG_INFINITY: float("-inf"),
+}
+
+
+def dbx_object_hook(obj):
+    """json object_hook that decodes `{"_dbx": ...}` objects. Unknown codes
+    are returned as they are."""
+    code = obj.get("_dbx")
+    if code is None:
+        return obj
+    if code in _FLOAT_CODES:
+        return _FLOAT_CODES[code]
+    if code == "reffile":
+        return RefFileRef(obj.get("path"), obj.get("hostname"), obj.get("sha256"))
+    if code == "expfile":
+        return ExpFileRef(obj.get("exp"), obj.get("name"), obj.get("sha256"))
+    if code == DBXCODE_ARRAY:
+        return ArrayRef(obj.get("file"), obj.get("offset"), obj.get("dtype"), tuple(obj.get("shape")))
+    return obj
+
+
+def decode_dbx(obj):
+    """Decode `_dbx` values in an already parsed JSON object (e.g. a dict
+    loaded without dbx_object_hook)."""
+    if isinstance(obj, dict):
+        return dbx_object_hook({k: decode_dbx(v) for k, v in obj.items()})
+    if isinstance(obj, list):
+        return [decode_dbx(v) for v in obj]
+    return obj
+
+
+def load_array(ref, source, mode="r"):
+    """Load an array referenced from a log as a read-only numpy memmap, so
+    nothing is read until it is used.
+
+    ref: an ArrayRef (or its `_dbx` dict)
+    source: the log the reference was read from (see log_path) or the
+        directory it is in
+    """
+    import numpy as np
+    if isinstance(ref, dict):
+        ref = dbx_object_hook(ref)
+    directory = os.path.dirname(log_path(source))
+    return np.memmap(os.path.join(directory, ref.file), dtype=np.dtype(ref.dtype),
+        mode=mode, offset=ref.offset, shape=tuple(ref.shape))
+
+
+def event_filter(events):
+    """Turn the `events` argument of read_log into a function that takes an
+    event name and returns whether to keep it, or None to keep everything.
+
+    events can be None, an event name, a glob pattern ("epoch/*/eval"), a list
+    of names and patterns or a function.
+    """
+    if events is None or callable(events):
+        return events
+    if isinstance(events, str):
+        events = [events]
+
+    names = set()
+    patterns = []
+    for e in events:
+        if any(c in e for c in "*?["):
+            patterns.append(fnmatch.translate(e))
+        else:
+            names.add(e)
+
+    if not patterns:
+        return names.__contains__
+
+    regex = re.compile("|".join(patterns))
+    return lambda name: name in names or regex.match(name) is not None
+
+
+# lines written by FileLogWriter always start with the event name, so it can
+# be checked before decoding the whole line
+_EVENT_PREFIXES = (b'{"event": "', b'{"event":"')
+
+def line_event_name(line):
+    """Return the event name of a log line (bytes) without decoding the whole
+    line, or None if the line doesn't start with a plain "event" key."""
+    for prefix in _EVENT_PREFIXES:
+        if line.startswith(prefix):
+            end = line.find(b'"', len(prefix))
+            if end < 0:
+                return None
+            name = line[len(prefix):end]
+            if b"\\" in name:
+                # escaped characters, let json deal with it
+                return None
+            return name.decode()
+    return None
+
+
+def parse_line(line, match=None, keys=None, decode=True):
+    """Parse one log line (bytes). Returns the event dict or None if the line
+    is empty or its event doesn't pass match."""
+    if not line.strip():
+        return None
+
+    name = None
+    if match is not None:
+        name = line_event_name(line)
+        if name is not None and not match(name):
+            return None
+
+    if decode:
+        ev = json.loads(line, object_hook=dbx_object_hook)
+    else:
+        ev = json.loads(line)
+
+    if match is not None and name is None and not match(ev.get("event")):
+        return None
+
+    if keys is not None:
+        projected = {"event": ev.get("event")}
+        for k in keys:
+            if k in ev:
+                projected[k] = ev[k]
+        ev = projected
+
+    return ev
+
+
+def log_path(source, name=None):
+    """Find the log file for source: a path to a log file, a path to an
+    experiment directory or an :py:class:`dbxlogger.Exp`."""
+    if isinstance(source, str):
+        if os.path.isdir(source):
+            return os.path.join(source, name or "log.jsonl")
+        return source
+    if hasattr(source, "repo"):
+        return source.repo.logpath(source, name)
+    raise Exception("cannot read log from %r" % (source,))
+
+
+def _parse_lines(lines, match, keys, decode):
+    for line in lines:
+        if not line.endswith(b"\n"):
+            # last line still being written (or a truncated log)
+            return
+        ev = parse_line(line, match, keys, decode)
+        if ev is not None:
+            yield ev
+
+
+def _read_range(f, start, stop):
+    f.seek(start)
+    pos = start
+    while pos < stop:
+        line = f.readline()
+        if not line:
+            return
+        pos += len(line)
+        yield line
+
+
+def _read_indexed(f, level, runs, events, match, keys, decode):
+    """Read the runs of the index that can match events, merging adjacent
+    ones into one read, then scan the part of the log after the index."""
+    key_ok = key_filter(events, level)
+    end = 0
+    start = stop = None
+    for key, offset, nbytes, lines in runs:
+        end = offset + nbytes
+        if not key_ok(key):
+            continue
+        if stop == offset:
+            stop = end
+            continue
+        if start is not None:
+            yield from _parse_lines(_read_range(f, start, stop), match, keys, decode)
+        start, stop = offset, end
+
+    if start is not None:
+        yield from _parse_lines(_read_range(f, start, stop), match, keys, decode)
+
+    f.seek(end)
+    yield from _parse_lines(f, match, keys, decode)
+
+
+def read_log(source, events=None, keys=None, decode=True, name=None, use_index=True):
+    """Iterate over the events of a log, one dict per event with the event
+    name under "event".
+
+    source: path to a log file, an experiment directory, an Exp or an open
+        binary file
+    events: only return these events, see event_filter
+    keys: only keep these keys of the event data
+    decode: decode `_dbx` values (default True)
+    name: log name when source is an experiment (default log.jsonl)
+    use_index: when filtering events, use the sidecar index of the log (see
+        dbxlogger.index) if there is one to only read the matching parts
+    """
+    match = event_filter(events)
+
+    if hasattr(source, "read"):
+        yield from _parse_lines(source, match, keys, decode)
+        return
+
+    path = log_path(source, name)
+    idx = None
+    if use_index and events is not None:
+        idx = read_index(path)
+
+    with open(path, "rb") as f:
+        if idx is not None:
+            yield from _read_indexed(f, idx[0], idx[1], events, match, keys, decode)
+        else:
+            yield from _parse_lines(f, match, keys, decode)
+
+
+def _matching_ranges(path, events, use_index):
+    """Byte ranges of the log that can contain events: everything, or with
+    an index the matching runs (merged) plus the part after the index."""
+    size = os.path.getsize(path)
+    idx = read_index(path) if use_index and events is not None else None
+    if idx is None:
+        return [(0, size)]
+
+    key_ok = key_filter(events, idx[0])
+    ranges = []
+    end = 0
+    for key, offset, nbytes, lines in idx[1]:
+        end = offset + nbytes
+        if not key_ok(key):
+            continue
+        if ranges and ranges[-1][1] == offset:
+            ranges[-1] = (ranges[-1][0], end)
+        else:
+            ranges.append((offset, end))
+    if end < size:
+        ranges.append((end, size))
+    return ranges
+
+
+def _split_ranges(mm, ranges, chunk_size):
+    """Split byte ranges into chunks of about chunk_size bytes that start
+    and end on line boundaries."""
+    for start, stop in ranges:
+        while stop - start > chunk_size:
+            nl = mm.find(b"\n", start + chunk_size, stop)
+            if nl < 0:
+                break
+            yield start, nl + 1
+            start = nl + 1
+        if start < stop:
+            yield start, stop
+
+
+def _parse_chunk(args):
+    path, start, stop, events, keys, decode = args
+    match = event_filter(events)
+    out = []
+    with open(path, "rb") as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            pos = start
+            while pos < stop:
+                nl = mm.find(b"\n", pos, stop)
+                if nl < 0:
+                    # partial last line
+                    break
+                ev = parse_line(mm[pos:nl + 1], match, keys, decode)
+                if ev is not None:
+                    out.append(ev)
+                pos = nl + 1
+    return out
+
+
+def read_log_parallel(source, events=None, keys=None, decode=True, name=None,
+        use_index=True, processes=None, ordered=True, chunk_size=32 * 1024 * 1024):
+    """Like read_log() but parses the log on a pool of processes.
+
+    The log is memory-mapped and split into line aligned chunks of about
+    chunk_size bytes; each process parses whole chunks, applying the events
+    filter and keys projection before sending the events back. With
+    ordered=False events are yielded in the order chunks finish, which can
+    be faster if chunks take very different times.
+
+    events must be names or patterns, not a function, since it is sent to
+    the worker processes. processes defaults to the number of CPUs.
+    """
+    if callable(events):
+        raise Exception("read_log_parallel needs event names or patterns, not a function")
+
+    path = log_path(source, name)
+    if processes is None:
+        processes = os.cpu_count() or 1
+
+    if os.path.getsize(path) == 0:
+        return
+
+    ranges = _matching_ranges(path, events, use_index)
+    with open(path, "rb") as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            chunks = list(_split_ranges(mm, ranges, chunk_size))
+
+    if processes == 1 or len(chunks) == 1:
+        for start, stop in chunks:
+            yield from _parse_chunk((path, start, stop, events, keys, decode))
+        return
+
+    tasks = [(path, start, stop, events, keys, decode) for start, stop in chunks]
+    with multiprocessing.Pool(min(processes, len(tasks))) as pool:
+        if ordered:
+            results = pool.imap(_parse_chunk, tasks)
+        else:
+            results = pool.imap_unordered(_parse_chunk, tasks)
+        for evs in results:
+            yield from evs
@@ -1,10 +1,14 @@
 import os
 import json
+import errno
 import hashlib
-import socket
+import io
+import uuid
 
+from . import fileindex, hashcache
 from .encoder import DBXEncoder
 from .logger import Logger, FileLogWriter
+from .objects import ObjectStore, OBJECTS_DIRNAME, is_store
 
 def parse_path(path):
     return LocalRepo(path)
@@ -33,26 +37,110 @@ def get_repo(args):
     raise NotImplementedError("config file reading for --repo")
 
 
+def _copy_hashing(src, dst):
+    """Copy src to dst and return the sha256 hasher of the content."""
+    h = hashlib.sha256()
+    b = bytearray(1024*1024)
+    mv = memoryview(b)
+    with open(src, "rb", buffering=0) as s, open(dst, "wb", buffering=0) as d:
+        for n in iter(lambda: s.readinto(mv), 0):
+            h.update(mv[:n])
+            d.write(mv[:n])
+    return h
+
+
 # from https://stackoverflow.com/a/44873382/555516
-def sha256sum(filename):
-    h  = hashlib.sha256()
-    b  = bytearray(128*1024)
+def _hash_file(filename):
+    """sha256 hasher of the content of filename."""
+    h = hashlib.sha256()
+    b = bytearray(128*1024)
     mv = memoryview(b)
     with open(filename, 'rb', buffering=0) as f:
         for n in iter(lambda : f.readinto(mv), 0):
             h.update(mv[:n])
-    return h.hexdigest()
+    return h
+
+
+def sha256sum(filename):
+    return _hash_file(filename).hexdigest()
+
+
+class _HashingFileIO(io.RawIOBase):
+    """Raw binary file that updates hasher with the bytes written to it, as
+    long as they are written in order. After a seek() away from the end of
+    the hashed bytes or a truncate() hasher is set to None and the file has
+    to be hashed again."""
+
+    def __init__(self, path, mode, hasher):
+        self._f = io.FileIO(path, mode)
+        self.hasher = hasher
+        self._pos = self._f.tell()
+
+    @property
+    def name(self):
+        return self._f.name
+
+    def readable(self):
+        return False
+
+    def writable(self):
+        return True
+
+    def seekable(self):
+        return self._f.seekable()
+
+    def fileno(self):
+        return self._f.fileno()
+
+    def write(self, b):
+        n = self._f.write(b)
+        if self.hasher is not None and n:
+            with memoryview(b) as mv:
+                self.hasher.update(mv.cast("B")[:n])
+            self._pos += n
+        return n
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        pos = self._f.seek(offset, whence)
+        if pos != self._pos:
+            self.hasher = None
+        return pos
+
+    def tell(self):
+        return self._f.tell()
+
+    def truncate(self, size=None):
+        self.hasher = None
+        return self._f.truncate(size)
+
+    def close(self):
+        if not self.closed:
+            self._f.close()
+        super().close()
 
 
 class RefFile:
+    """A reference to a file outside the repo (e.g. a dataset), logged with
+    its path, hostname and sha256.
+
+    Hashes are cached per host (see dbxlogger.hashcache), so a file is only
+    hashed again when it changes. Log writers with defer_hashes=True don't
+    wait for a hash that isn't cached: the event is written with sha256 null
+    and the hash follows in a "_dbx/reffile" event.
+    """
+
     def __init__(self, path : str):
         self._path = path
         self._sha256 = None
+        self._future = None
 
     @property
     def sha256(self):
         if self._sha256 is None:
-            self._sha256 = sha256sum(self.path)
+            if self._future is not None:
+                self._sha256 = self._future.result()
+            else:
+                self._sha256 = hashcache.sha256(self.path)
         return self._sha256
 
     @property
@@ -63,10 +151,26 @@ class RefFile:
         return {
             "_dbx": "reffile",
             "path": self.path,
-            "hostname": socket.gethostname(),
+            "hostname": hashcache.hostname(),
             "sha256": self.sha256,
         }
 
+    def __dbx_encode_nowait__(self):
+        """Like __dbx_encode__, but if the hash isn't known yet it is
+        computed in the background and sha256 is None. Returns (encoded,
+        future of the hash or None)."""
+        if self._sha256 is None:
+            if self._future is None:
+                self._future = hashcache.submit(self.path)
+            if not self._future.done():
+                return {
+                    "_dbx": "reffile",
+                    "path": self.path,
+                    "hostname": hashcache.hostname(),
+                    "sha256": None,
+                }, self._future
+        return self.__dbx_encode__(), None
+
 
 class _ExpFile:
     def __init__(self, exp, name, mode="w"):
@@ -114,10 +218,22 @@ class LocalExpFile(_ExpFile):
         f = expfile.open()
         # ... f is a file opened with python's open(name, mode) ...
         expfile.close()
+
+    The file is hashed as it's written, so closing it doesn't read it again.
+    Only files written out of order (seek() back, truncate()) and files
+    opened for reading ("r", "+" modes) are read again to hash them.
+    Appending only reads the old content.
+
+    With an object store the file is written to a temp file in the store,
+    which is moved into the store on close() and linked at full_path. In
+    append and update modes the temp file starts as a copy of the current
+    file, so the stored object is never modified.
     """
-    def __init__(self, exp, name, full_path, mode="w"):
+    def __init__(self, exp, name, full_path, mode="w", store=None):
         super().__init__(exp, name, mode)
         self.full_path = full_path
+        self.store = store
+        self._write_path = full_path
 
     def __enter__(self):
         return self.open()
@@ -126,33 +242,177 @@ class LocalExpFile(_ExpFile):
         self.close()
 
     def open(self):
-        self._fd = open(self.full_path, self.mode)
+        mode = self.mode
+        hasher = None
+        if self.store is not None and mode.strip("rbt") != "":
+            if "x" in mode and os.path.exists(self.full_path):
+                raise FileExistsError("expfile %s already exists" % self.name)
+            self._write_path = self.store.tempfile()
+            if ("a" in mode or "+" in mode) and os.path.exists(self.full_path):
+                hasher = _copy_hashing(self.full_path, self._write_path)
+        elif "a" in mode and os.path.exists(self.full_path):
+            hasher = _hash_file(self.full_path)
+
+        self._raw = None
+        if "r" in mode or "+" in mode:
+            # reads and writes anywhere, hash on close
+            self._fd = open(self._write_path, mode)
+            return self._fd
+
+        raw_mode = "a" if "a" in mode else "x" if "x" in mode else "w"
+        if hasher is None:
+            hasher = hashlib.sha256()
+        self._raw = _HashingFileIO(self._write_path, raw_mode, hasher)
+        self._fd = io.BufferedWriter(self._raw)
+        if "b" not in mode:
+            self._fd = io.TextIOWrapper(self._fd)
+            self._fd.mode = mode
         return self._fd
 
     def close(self):
         self._fd.close()
-        self._set_sha256(sha256sum(self.full_path))
+        if self._raw is not None and self._raw.hasher is not None:
+            self._set_sha256(self._raw.hasher.hexdigest())
+        else:
+            self._set_sha256(sha256sum(self._write_path))
+        self._raw = None
+        if self._write_path != self.full_path:
+            self.store.add(self._write_path, self.sha256)
+            self.store.link(self.sha256, self.full_path)
+            self._write_path = self.full_path
+        self._done()
+
+
+def _move_hashing(src, dst):
+    """Move src to dst and return the sha256 hasher of the content. On the
+    same filesystem it's a rename (and one read to hash); across
+    filesystems the content is copied and hashed in the same pass."""
+    try:
+        os.rename(src, dst)
+        return _hash_file(dst)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+    h = _copy_hashing(src, dst)
+    os.remove(src)
+    return h
+
+
+class LocalExpFilePath(_ExpFile):
+    """Context manager giving a path to write an expfile at, for code that
+    only takes a path (see Exp.filepath):
+
+        with exp.filepath("model.pth") as path:
+            torch.save(model, path)
+
+    The path is a temp file next to the experiment (in the object store, if
+    the repo has one). When the block exits the file is moved to its place
+    (a rename, nothing is copied) and hashed, then registered like a file
+    from exp.file(). If the block raises, the temp file is removed and
+    nothing is registered.
+
+    src: an existing path to use instead of a temp file, e.g. a file a
+        library already wrote on a scratch disk. It's moved into the
+        experiment; across filesystems it's copied and hashed in one pass,
+        then removed.
+
+    The file must be written at exactly the given path (e.g. numpy.save adds
+    ".npy" to paths without it).
+    """
+
+    def __init__(self, exp, name, full_path, src=None, store=None):
+        super().__init__(exp, name, mode="w")
+        self.full_path = full_path
+        self.store = store
+        self.src = src
+        self.path = None
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            if self.src is None and os.path.exists(self.path):
+                os.remove(self.path)
+            return
+        self.close()
+
+    def open(self):
+        if self.src is not None:
+            self.path = self.src
+        elif self.store is not None:
+            self.path = self.store.tempfile()
+        else:
+            directory, base = os.path.split(self.full_path)
+            self.path = os.path.join(directory, ".%s.%s.tmp" % (base, uuid.uuid4().hex[:8]))
+        return self.path
+
+    def close(self):
+        if not os.path.exists(self.path):
+            raise Exception("expfile %s was not written at %s" % (self.name, self.path))
+
+        if self.store is not None:
+            if self.src is not None:
+                tmp = self.store.tempfile()
+                h = _move_hashing(self.path, tmp)
+            else:
+                tmp = self.path
+                h = _hash_file(tmp)
+            self._set_sha256(h.hexdigest())
+            self.store.add(tmp, self.sha256)
+            self.store.link(self.sha256, self.full_path)
+        else:
+            h = _move_hashing(self.path, self.full_path)
+            self._set_sha256(h.hexdigest())
         self._done()
 
 
+def _fsync_dir(path):
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        # directories can't be opened on some platforms (windows)
+        return
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
 class LocalRepo:
     """
-    This repo only handles saving experiments and logs locally, it doesn't
-    handle querying the repo. All the querying capabilities will be implemented
-    separately.
+    This repo only handles saving experiments and logs locally. Querying is
+    done separately, see catalog() and :py:mod:`dbxlogger.reader`.
+
+    With objects=True expfiles are stored once per content in `.objects/`
+    in the repo and linked into the experiment directories, see
+    :py:mod:`dbxlogger.objects`. By default (objects=None) the store is only
+    used if the repo already has one, created with objects=True.
     """
 
-    def __init__(self, path: str):
+    def __init__(self, path: str, objects=None):
         self._path = path
+        store_path = os.path.join(path, OBJECTS_DIRNAME)
+        if objects is None:
+            objects = is_store(store_path)
+        self._objects = ObjectStore(store_path) if objects else None
 
     @property
     def path(self):
         return self._path
 
+    @property
+    def objects(self):
+        """The ObjectStore of this repo, or None."""
+        return self._objects
+
     def save(self, exp):
         """Save the experiment."""
 
         output_path = self._pathfor(exp)
+        top = os.path.relpath(output_path, self.path).split(os.sep)[0]
+        if top == OBJECTS_DIRNAME:
+            raise Exception("experiment name %s is reserved for the object store" % exp.name)
 
         if os.path.exists(output_path):
             # this should almost never happen
@@ -169,8 +429,8 @@ class LocalRepo:
 
         return os.path.join(self.path, exp.id)
 
-    def logger(self, exp, name=None):
-        """Get a new logger for exp with given name or default."""
+    def logpath(self, exp, name=None):
+        """Path of the log with the given name (default log.jsonl) of exp."""
 
         if name is None:
             name = "log.jsonl"
@@ -180,23 +440,87 @@ class LocalRepo:
             if "/" in name or "\\" in name:
                 raise Exception("invalid log name %s: log name cannot contain slashes", name)
 
-        logpath = os.path.join(self._pathfor(exp), name)
-        return Logger(writer=FileLogWriter(logpath, mode="a"))
+        return os.path.join(self._pathfor(exp), name)
+
+    def logger(self, exp, name=None, **writer_kwargs):
+        """Get a new logger for exp with given name or default. writer_kwargs
+        are passed to FileLogWriter."""
+
+        logpath = self.logpath(exp, name)
+        return Logger(writer=FileLogWriter(logpath, mode="a", **writer_kwargs))
 
     def expfile(self, exp, name, mode="w"):
         return LocalExpFile(
             exp,
             name,
             full_path=os.path.join(self._pathfor(exp), name),
-            mode=mode)
+            mode=mode,
+            store=self._objects)
 
-    def expfile_path(self, exp, name):
-        raise NotImplementedError()
-
-    def save_fileindex(self, exp):
-        output_path = self._pathfor(exp)
-        with open(os.path.join(output_path, "files.json"), "w") as f:
-            json.dump(exp.files, f, indent=4, sort_keys=True)
+    def expfile_path(self, exp, name, src=None):
+        return LocalExpFilePath(
+            exp,
+            name,
+            full_path=os.path.join(self._pathfor(exp), name),
+            src=src,
+            store=self._objects)
+
+    def add_to_fileindex(self, exp, name, sha256):
+        """Add one file to the file index of exp, see dbxlogger.fileindex."""
+        fileindex.append(self._pathfor(exp), name, sha256)
+
+    def remove_file(self, exp, name):
+        """Delete the expfile name of exp and remove it from the file index.
+        With an object store the object stays until gc()."""
+        path = os.path.join(self._pathfor(exp), name)
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        fileindex.append(self._pathfor(exp), name, None)
+
+    def fsync_file(self, exp, name):
+        """fsync the directory entries of the expfile name of exp (and of its
+        object, with an object store) and the file index journal."""
+        exp_path = self._pathfor(exp)
+        fileindex.fsync(exp_path)
+        dirs = set([exp_path, os.path.dirname(os.path.join(exp_path, name))])
+        sha256 = exp.files.get(name)
+        if self._objects is not None and sha256 is not None:
+            dirs.add(os.path.dirname(self._objects.object_path(sha256)))
+        for d in dirs:
+            _fsync_dir(d)
+
+    def compact_fileindex(self, exp):
+        fileindex.compact_index(self._pathfor(exp))
+
+    def read_fileindex(self, exp_or_path, compact=False):
+        """The file index {name: sha256} of an experiment (an Exp or the path
+        of its directory)."""
+        path = exp_or_path if isinstance(exp_or_path, str) else self._pathfor(exp_or_path)
+        return fileindex.read(path, compact=compact)
+
+    def gc(self, grace=None, dry_run=False):
+        """Remove the objects no experiment references anymore (see
+        ObjectStore.gc). Does nothing without an object store."""
+        if self._objects is None:
+            return {"referenced": 0, "removed": 0, "freed": 0}
+        if grace is None:
+            return self._objects.gc(self.path, dry_run=dry_run)
+        return self._objects.gc(self.path, grace=grace, dry_run=dry_run)
+
+    def sync(self, dst, workers=8):
+        """Copy the experiments of this repo that dst (a LocalRepo or path)
+        doesn't have yet, and what was added to them since the last sync.
+        See dbxlogger.sync."""
+        from .sync import sync
+        return sync(self, dst, workers=workers)
+
+    def catalog(self, path=None):
+        """Open the SQLite catalog of the experiments in this repo (see
+        dbxlogger.catalog). Call refresh() on it to pick up new experiments."""
+        from .catalog import Catalog
+        return Catalog(self, path)
 
     def __str__(self):
         return 'LocalRepo("%s")' % self._path
@@ -0,0 +1,307 @@
+"""
+Incremental sync of one local repo into another.
+
+    from dbxlogger.sync import sync
+
+    counts = sync("./output", "/mnt/archive/output")
+
+Every experiment of the source is copied to the same place in the
+destination. Experiments and files that are already there are skipped, and
+append-only files (logs, their index and array files, the file index
+journal) only get the bytes past the destination's length, so a sync after
+a few more epochs of training copies a few KiB per log.
+
+What the destination has is recorded in a manifest in each destination
+experiment (`.dbxsync.json`): the size and mtime of every file and, for
+append-only files, the sha256 of the last TAIL_CHECK_BYTES before the end
+of what was copied. A file is appended to only if its size grew and that
+window still hashes the same in the source; otherwise it's copied again.
+Files are copied to a temp file and renamed and meta.json is written last,
+so an interrupted sync leaves no half written files and the next one picks
+up where it stopped (files copied before the interruption are recognized by
+size and mtime, which are copied along).
+
+Repos with an object store (see dbxlogger.objects) are synced with one: an
+expfile that is a link to an object is synced by copying the object into the
+destination's store, once, and linking it there, so files shared by many
+experiments are copied and stored once in the destination too.
+
+Nothing is ever deleted from the destination. Experiments are synced on a
+pool of threads (workers).
+"""
+
+import concurrent.futures
+import hashlib
+import json
+import os
+import re
+import shutil
+import uuid
+
+from . import fileindex
+from .encoder import ARRAY_FILE_SUFFIX
+from .fileindex import FILEINDEX_FILENAME, JOURNAL_FILENAME
+from .index import INDEX_SUFFIX
+from .objects import ObjectStore, OBJECTS_DIRNAME, experiment_dirs, is_store
+
+MANIFEST_FILENAME = ".dbxsync.json"
+MANIFEST_VERSION = 1
+
+# bytes before the synced length that must be unchanged to append
+TAIL_CHECK_BYTES = 64 * 1024
+
+_COPY_CHUNK = 1024 * 1024
+
+# temp files of an interrupted sync or object store link (name.<8 hex>.tmp)
+# and of a file index being written (files.json.<pid>.tmp)
+_TEMP_RE = re.compile(r"(\.[0-9a-f]{8}|^%s\.[0-9]+)\.tmp$" % re.escape(FILEINDEX_FILENAME))
+
+
+def _repo_path(repo):
+    return repo if isinstance(repo, str) else repo.path
+
+
+def is_append_only(name):
+    """Whether the file name of an experiment is only ever appended to."""
+    return (name.endswith("log.jsonl")
+        or name.endswith("log.jsonl" + INDEX_SUFFIX)
+        or name.endswith("log.jsonl" + ARRAY_FILE_SUFFIX)
+        or os.path.basename(name) == JOURNAL_FILENAME)
+
+
+def _tail_hash(path, size):
+    """sha256 of the TAIL_CHECK_BYTES bytes of path before offset size."""
+    start = max(0, size - TAIL_CHECK_BYTES)
+    with open(path, "rb") as f:
+        f.seek(start)
+        data = f.read(size - start)
+    if len(data) != size - start:
+        return None
+    return hashlib.sha256(data).hexdigest()
+
+
+def _exp_files(exp_path):
+    """Yield (name, stat) for the files of an experiment, meta.json last.
+    Dot files and the temp files of dbxlogger are left out."""
+    meta = None
+    for root, dirs, files in os.walk(exp_path):
+        dirs[:] = [d for d in dirs if not d.startswith(".")]
+        for f in files:
+            if f.startswith(".") or _TEMP_RE.search(f):
+                continue
+            full = os.path.join(root, f)
+            name = os.path.relpath(full, exp_path)
+            st = os.stat(full)
+            if name == "meta.json":
+                meta = (name, st)
+            else:
+                yield name, st
+    if meta is not None:
+        yield meta
+
+
+def _read_manifest(exp_path):
+    try:
+        with open(os.path.join(exp_path, MANIFEST_FILENAME)) as f:
+            manifest = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+    if manifest.get("version") != MANIFEST_VERSION:
+        return {}
+    return manifest.get("files", {})
+
+
+def _write_manifest(exp_path, files):
+    path = os.path.join(exp_path, MANIFEST_FILENAME)
+    tmp = "%s.%s.tmp" % (path, uuid.uuid4().hex[:8])
+    with open(tmp, "w") as f:
+        json.dump({"version": MANIFEST_VERSION, "files": files}, f, sort_keys=True)
+    os.replace(tmp, path)
+
+
+def _copy(src, dst, st):
+    tmp = "%s.%s.tmp" % (dst, uuid.uuid4().hex[:8])
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    try:
+        shutil.copyfile(src, tmp)
+        os.utime(tmp, ns=(st.st_atime_ns, st.st_mtime_ns))
+        os.replace(tmp, dst)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+def _append(src, dst, offset, st):
+    """Append the bytes of src past offset to dst. Returns the number of
+    bytes copied."""
+    copied = 0
+    with open(src, "rb") as s, open(dst, "ab") as d:
+        s.seek(offset)
+        # only up to the size seen when listing, the source may be growing
+        remaining = st.st_size - offset
+        while remaining > 0:
+            chunk = s.read(min(_COPY_CHUNK, remaining))
+            if not chunk:
+                break
+            d.write(chunk)
+            copied += len(chunk)
+            remaining -= len(chunk)
+    os.utime(dst, ns=(st.st_atime_ns, st.st_mtime_ns))
+    return copied
+
+
+def _entry(st, tail=None):
+    entry = {"size": st.st_size, "mtime_ns": st.st_mtime_ns}
+    if tail is not None:
+        entry["tail_sha256"] = tail
+    return entry
+
+
+def _object_of(src, sha256, stores):
+    """sha256 if src is a link to that object in the source store, else
+    None."""
+    if stores is None or sha256 is None:
+        return None
+    try:
+        if os.path.samefile(src, stores[0].object_path(sha256)):
+            return sha256
+    except OSError:
+        pass
+    return None
+
+
+def _link_object(sha256, dst, stores, counts):
+    """Link dst to object sha256 in the destination store, copying the object
+    from the source store first if it isn't there yet."""
+    src_store, dst_store = stores
+    if sha256 not in dst_store:
+        tmp = dst_store.tempfile()
+        try:
+            shutil.copyfile(src_store.object_path(sha256), tmp)
+            dst_store.add(tmp, sha256)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        counts["objects_copied"] += 1
+        counts["bytes_copied"] += os.path.getsize(dst_store.object_path(sha256))
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    dst_store.link(sha256, dst)
+    counts["files_linked"] += 1
+
+
+def _sync_file(src, dst, name, st, known, counts, sha256=None, stores=None):
+    """Bring dst up to date with src. Returns the manifest entry.
+
+    sha256: the hash of the file in the file index of the experiment
+    stores: (source, destination) ObjectStore, if the source has a store
+    """
+    append_only = is_append_only(name)
+
+    if known is None:
+        # no manifest entry: a new file or one copied by an interrupted sync
+        try:
+            dst_st = os.stat(dst)
+        except FileNotFoundError:
+            dst_st = None
+        if dst_st is not None and (dst_st.st_size, dst_st.st_mtime_ns) == (st.st_size, st.st_mtime_ns):
+            known = _entry(dst_st, _tail_hash(dst, dst_st.st_size) if append_only else None)
+    if known is not None and (known["size"], known["mtime_ns"]) == (st.st_size, st.st_mtime_ns):
+        counts["files_unchanged"] += 1
+        return known
+
+    obj = None if append_only else _object_of(src, sha256, stores)
+    if obj is not None:
+        _link_object(obj, dst, stores, counts)
+        # dst shares the object's mtime, record what was synced instead
+        return _entry(st)
+    if (append_only and known is not None and "tail_sha256" in known
+            and st.st_size > known["size"] and os.path.exists(dst)
+            and os.path.getsize(dst) == known["size"]
+            and _tail_hash(src, known["size"]) == known["tail_sha256"]):
+        counts["bytes_appended"] += _append(src, dst, known["size"], st)
+        counts["files_appended"] += 1
+    else:
+        _copy(src, dst, st)
+        counts["bytes_copied"] += st.st_size
+        counts["files_copied"] += 1
+
+    # the copy can have more than st says if the source is still growing
+    dst_st = os.stat(dst)
+    return _entry(dst_st, _tail_hash(dst, dst_st.st_size) if append_only else None)
+
+
+def _new_counts():
+    return {
+        "exps_new": 0,
+        "exps_updated": 0,
+        "exps_unchanged": 0,
+        "files_copied": 0,
+        "files_appended": 0,
+        "files_linked": 0,
+        "objects_copied": 0,
+        "files_unchanged": 0,
+        "bytes_copied": 0,
+        "bytes_appended": 0,
+    }
+
+
+def sync_exp(src_exp, dst_exp, stores=None):
+    """Sync one experiment directory. Returns its counts (see sync).
+
+    stores: (source, destination) ObjectStore to sync expfiles stored as
+        objects through
+    """
+    counts = _new_counts()
+    is_new = not os.path.exists(os.path.join(dst_exp, "meta.json"))
+    manifest = _read_manifest(dst_exp)
+    hashes = fileindex.read(src_exp) if stores is not None else {}
+    files = {}
+    for name, st in _exp_files(src_exp):
+        src = os.path.join(src_exp, name)
+        dst = os.path.join(dst_exp, name)
+        try:
+            files[name] = _sync_file(src, dst, name, st, manifest.get(name), counts,
+                hashes.get(name), stores)
+        except FileNotFoundError:
+            # removed from the source while syncing (e.g. an old checkpoint)
+            continue
+
+    changed = counts["files_copied"] or counts["files_appended"] or counts["files_linked"]
+    if is_new:
+        counts["exps_new"] = 1
+    elif changed:
+        counts["exps_updated"] = 1
+    else:
+        counts["exps_unchanged"] = 1
+    if changed or files != manifest:
+        _write_manifest(dst_exp, files)
+    return counts
+
+
+def sync(src, dst, workers=8):
+    """Sync all the experiments of the repo src into the repo dst (LocalRepo
+    or paths). Returns a dict of counts: experiments new, updated and
+    unchanged, files copied, appended, linked to an object and unchanged,
+    objects copied and bytes copied and appended. If src has an object
+    store, dst gets one too."""
+    src_path = _repo_path(src)
+    dst_path = _repo_path(dst)
+    os.makedirs(dst_path, exist_ok=True)
+
+    stores = None
+    src_objects = os.path.join(src_path, OBJECTS_DIRNAME)
+    if is_store(src_objects):
+        stores = (ObjectStore(src_objects), ObjectStore(os.path.join(dst_path, OBJECTS_DIRNAME)))
+
+    counts = _new_counts()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = []
+        for src_exp in experiment_dirs(src_path):
+            dst_exp = os.path.join(dst_path, os.path.relpath(src_exp, src_path))
+            futures.append(pool.submit(sync_exp, src_exp, dst_exp, stores))
+        for f in concurrent.futures.as_completed(futures):
+            for k, v in f.result().items():
+                counts[k] += v
+    return counts